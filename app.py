@@ -1,23 +1,155 @@
 import os
 import uuid
 import time
+import heapq
 import threading
 import shutil
-import zipfile
-import io
-from flask import Flask, render_template_string, request, jsonify, send_file, make_response
+import random
+import socket
+import zlib
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, render_template_string, request, jsonify, send_file
 
-app = Flask(__name__)
+import metrics
+from limits import ConcurrencyLimiter, GatedReader, Overloaded
+from assets import Asset, StaticAssets, serve_asset
+from archive import ZipStream, stream_zip, zip_members
+from registry import ReservationExceeded, chunk_received, make_registry
+from storage import make_storage
+
+# Static files are served by static_file() under fingerprinted names
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'default-secret-key')
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024 * 1024  # 100 GB
 
-# In-memory storage for active transfers
-transfers = {}
-transfer_lock = threading.Lock()
-UPLOAD_FOLDER = 'uploads'
+# Transfer expiry: default and maximum lifetime of a transfer in seconds, and
+# how many expired transfers are deleted per batch / how long to pause between
+# batches, so a wave of expirations doesn't turn into an I/O storm
+app.config['TRANSFER_TTL'] = int(os.environ.get('TRANSFER_TTL', 3600))
+app.config['MAX_TRANSFER_TTL'] = int(os.environ.get('MAX_TRANSFER_TTL', 24 * 3600))
+app.config['EXPIRY_BATCH_SIZE'] = int(os.environ.get('EXPIRY_BATCH_SIZE', 16))
+app.config['EXPIRY_BATCH_INTERVAL'] = float(os.environ.get('EXPIRY_BATCH_INTERVAL', 1.0))
+
+# Let the front-end server (nginx X-Accel/X-Sendfile) send files instead of Python
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
+
+# Archive compression: 'auto' stores members that won't compress and deflates
+# the rest, 'deflate' and 'store' force one method for every member
+app.config['ZIP_COMPRESSION'] = os.environ.get('ZIP_COMPRESSION', 'auto')
+app.config['ZIP_COMPRESSION_LEVEL'] = int(os.environ.get('ZIP_COMPRESSION_LEVEL', 6))
+
+# Threads that deflate archive blocks in parallel (zlib releases the GIL);
+# 1 compresses inline in the request thread
+app.config['ZIP_COMPRESSION_WORKERS'] = int(os.environ.get('ZIP_COMPRESSION_WORKERS', os.cpu_count() or 1))
+
+# Build each transfer's archive in the background as its files complete, so
+# download_all can serve a finished file. Costs the archive's size in disk,
+# and twice that while it is built, which admission sets aside up front.
+app.config['PREBUILD_ARCHIVES'] = os.environ.get('PREBUILD_ARCHIVES', '0') == '1'
+app.config['ARCHIVE_BUILD_WORKERS'] = int(os.environ.get('ARCHIVE_BUILD_WORKERS', 2))
+
+# How many chunk uploads a browser may have in flight at once, across all files
+app.config['UPLOAD_WINDOW'] = int(os.environ.get('UPLOAD_WINDOW', 4))
+
+# Bounds for the chunk sizes browsers pick as they measure their link.
+# Received data is tracked in units of the minimum, so every chunk starts at a
+# multiple of it and is a multiple of it long, except at the end of the file.
+app.config['MIN_CHUNK_SIZE'] = int(os.environ.get('MIN_CHUNK_SIZE', 1024 * 1024))
+app.config['MAX_CHUNK_SIZE'] = int(os.environ.get('MAX_CHUNK_SIZE', 64 * 1024 * 1024))
+
+# Report the stages of each request in a Server-Timing header, and log a
+# sample of the requests that take longer than the threshold (in seconds,
+# 0 turns the log off) with the time spent in each stage
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', '1') == '1'
+app.config['SLOW_REQUEST_THRESHOLD'] = float(os.environ.get('SLOW_REQUEST_THRESHOLD', 1.0))
+app.config['SLOW_REQUEST_SAMPLE_RATE'] = float(os.environ.get('SLOW_REQUEST_SAMPLE_RATE', 0.1))
+
+# Transfers reserve their total_size when they are created. DISK_QUOTA caps
+# the bytes reserved by all live transfers (0 for no cap), and a transfer is
+# only admitted if the upload filesystem would still have DISK_HEADROOM bytes
+# free once every reservation has been written.
+app.config['DISK_QUOTA'] = int(os.environ.get('DISK_QUOTA', 0))
+app.config['DISK_HEADROOM'] = int(os.environ.get('DISK_HEADROOM', 1024 ** 3))
+
+# Load shedding, per worker process: at most CHUNK_WRITE_LIMIT chunk buffers
+# are stored and ARCHIVE_BUILD_LIMIT streamed archive builds run at once.
+# Up to the matching *_QUEUE more wait QUEUE_TIMEOUT seconds for a slot, and
+# the rest get an immediate 503 with Retry-After: OVERLOAD_RETRY_AFTER. Chunk
+# slots are only held while data is written, not while it is received.
+app.config['CHUNK_WRITE_LIMIT'] = int(os.environ.get('CHUNK_WRITE_LIMIT', 4))
+app.config['CHUNK_WRITE_QUEUE'] = int(os.environ.get('CHUNK_WRITE_QUEUE', 4))
+app.config['ARCHIVE_BUILD_LIMIT'] = int(os.environ.get('ARCHIVE_BUILD_LIMIT', 2))
+app.config['ARCHIVE_BUILD_QUEUE'] = int(os.environ.get('ARCHIVE_BUILD_QUEUE', 2))
+app.config['QUEUE_TIMEOUT'] = float(os.environ.get('QUEUE_TIMEOUT', 2.0))
+app.config['OVERLOAD_RETRY_AFTER'] = int(os.environ.get('OVERLOAD_RETRY_AFTER', 2))
+
+# One or more folders, separated by os.pathsep (':'), to keep transfers in;
+# give each disk its own folder and new transfers are spread across them
+UPLOAD_FOLDERS = os.environ.get('UPLOAD_FOLDER', 'uploads').split(os.pathsep)
+UPLOAD_FOLDER = UPLOAD_FOLDERS[0]
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# HTML template embedded in the Python code
+# Where transfer files are kept: 'local' in UPLOAD_FOLDERS, 's3' in S3_BUCKET
+# of an S3-compatible object store (object_store.py is a stand-in for
+# development). Credentials are optional; requests are unsigned without them.
+app.config['STORAGE'] = os.environ.get('STORAGE', 'local')
+app.config['S3_ENDPOINT'] = os.environ.get('S3_ENDPOINT', 'http://localhost:9000')
+app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET', 'file-share')
+app.config['S3_REGION'] = os.environ.get('S3_REGION', 'us-east-1')
+app.config['S3_ACCESS_KEY'] = os.environ.get('S3_ACCESS_KEY', os.environ.get('AWS_ACCESS_KEY_ID'))
+app.config['S3_SECRET_KEY'] = os.environ.get('S3_SECRET_KEY', os.environ.get('AWS_SECRET_ACCESS_KEY'))
+
+# Keys are kept under S3_PREFIX, the hostname by default. Each host's registry
+# only knows its own transfers, so hosts sharing a bucket need distinct
+# prefixes, or reclaiming orphans on one deletes the others' uploads.
+app.config['S3_PREFIX'] = os.environ.get('S3_PREFIX', socket.gethostname())
+
+# Where transfer metadata lives: 'sqlite' persists it across restarts and
+# shares it between all worker processes on the host, 'memory' keeps it in
+# this process only (one worker, lost on restart)
+app.config['REGISTRY'] = os.environ.get('REGISTRY', 'sqlite')
+app.config['REGISTRY_PATH'] = os.environ.get('REGISTRY_PATH', os.path.join(UPLOAD_FOLDER, 'registry.db'))
+
+# Transfers of up to MEMORY_TIER_MAX_TRANSFER bytes are kept in memory, up to
+# MEMORY_TIER_BYTES in all (0 turns the tier off), and the least recently
+# used ones spill to storage to make room. The memory is per process, so
+# the tier is only on by default with the 'memory' registry's single worker.
+app.config['MEMORY_TIER_BYTES'] = int(os.environ.get(
+    'MEMORY_TIER_BYTES', 256 * 1024 * 1024 if app.config['REGISTRY'] == 'memory' else 0))
+app.config['MEMORY_TIER_MAX_TRANSFER'] = int(os.environ.get('MEMORY_TIER_MAX_TRANSFER', 4 * 1024 * 1024))
+
+# Chunk size assumed for clients that don't send one, and the buffer size
+# used when copying request data to disk
+CHUNK_SIZE = 5 * 1024 * 1024  # 5MB
+WRITE_BUFFER_SIZE = 1024 * 1024  # 1MB
+
+# Content-Encodings browsers may compress chunks with, as zlib window bits
+CONTENT_ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+# Metrics served at /metrics; gauges are registered once their sources exist
+BYTES_RECEIVED = metrics.counter('file_share_bytes_received', 'Chunk bytes written to disk')
+ENCODED_BYTES_RECEIVED = metrics.counter('file_share_encoded_bytes_received',
+                                         'Compressed chunk bytes received, before decoding')
+BYTES_SERVED = metrics.counter('file_share_bytes_served', 'Bytes sent to receivers', ('route',))
+UPLOAD_STAGE = metrics.histogram('file_share_upload_chunk_seconds',
+                                 'Time spent in each stage of a chunk upload', ('stage',))
+ARCHIVE_BUILD = metrics.histogram('file_share_archive_build_seconds',
+                                  'Time spent building transfer archives', ('mode',))
+ARCHIVE_RATIO = metrics.histogram('file_share_archive_compression_ratio',
+                                  'Archive size relative to the files it holds',
+                                  buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0, 1.05))
+REJECTED = metrics.counter('file_share_overload_rejections', 'Requests turned away by a concurrency limit',
+                           ('limit',))
+PARSE_TIME = UPLOAD_STAGE.labels('parse')
+LOOKUP_TIME = UPLOAD_STAGE.labels('lookup')
+WRITE_TIME = UPLOAD_STAGE.labels('write')
+COMPLETE_TIME = UPLOAD_STAGE.labels('complete')
+
+# Fingerprinted assets never change under the same URL
+STATIC_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# HTML template embedded in the Python code; styles and scripts are in static/
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
@@ -25,605 +157,7 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title> DirectDrop </title>
-    <style>
-        :root {
-            --primary: #6366f1;
-            --primary-light: #818cf8;
-            --secondary: #0ea5e9;
-            --accent: #8b5cf6;
-            --success: #10b981;
-            --error: #ef4444;
-            --dark: #1e293b;
-            --darker: #0f172a;
-            --light: #f1f5f9;
-            --card-bg: rgba(255, 255, 255, 0.08);
-            --card-border: rgba(255, 255, 255, 0.1);
-            --text-primary: #e2e8f0;
-            --text-secondary: #94a3b8;
-        }
-        
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-            font-family: 'Inter', -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, 'Open Sans', 'Helvetica Neue', sans-serif;
-        }
-        
-        body {
-            background: linear-gradient(135deg, var(--darker) 0%, var(--dark) 100%);
-            min-height: 100vh;
-            padding: 20px;
-            color: var(--text-primary);
-            overflow-x: hidden;
-        }
-        
-        body::before {
-            content: "";
-            position: fixed;
-            top: -50%;
-            left: -50%;
-            right: -50%;
-            bottom: -50%;
-            background: radial-gradient(circle at 50% 50%, rgba(99, 102, 241, 0.1) 0%, transparent 60%);
-            z-index: -1;
-            animation: rotate 20s linear infinite;
-        }
-        
-        @keyframes rotate {
-            100% {
-                transform: rotate(360deg);
-            }
-        }
-        
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-        }
-        
-        header {
-            text-align: center;
-            padding: 30px 0 20px;
-            position: relative;
-        }
-        
-        .logo {
-            font-size: 3.5rem;
-            margin-bottom: 15px;
-            background: linear-gradient(45deg, var(--primary), var(--secondary));
-            -webkit-background-clip: text;
-            background-clip: text;
-            -webkit-text-fill-color: transparent;
-            filter: drop-shadow(0 0 15px rgba(99, 102, 241, 0.3));
-        }
-        
-        .tagline {
-            font-size: 1.2rem;
-            max-width: 600px;
-            margin: 0 auto 40px;
-            color: var(--text-secondary);
-            font-weight: 300;
-            line-height: 1.6;
-        }
-        
-        .card-container {
-            display: flex;
-            gap: 30px;
-            flex-wrap: wrap;
-            justify-content: center;
-        }
-        
-        .card {
-            background: var(--card-bg);
-            backdrop-filter: blur(12px);
-            -webkit-backdrop-filter: blur(12px);
-            border-radius: 16px;
-            border: 1px solid var(--card-border);
-            padding: 30px;
-            width: 100%;
-            max-width: 500px;
-            transition: all 0.3s ease;
-            box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
-            position: relative;
-            overflow: hidden;
-        }
-        
-        .card::before {
-            content: "";
-            position: absolute;
-            top: 0;
-            left: 0;
-            right: 0;
-            height: 4px;
-            background: linear-gradient(90deg, var(--primary), var(--secondary));
-            opacity: 0.8;
-        }
-        
-        .card:hover {
-            transform: translateY(-8px);
-            box-shadow: 0 15px 40px rgba(0, 0, 0, 0.3);
-        }
-        
-        .card-header {
-            display: flex;
-            align-items: center;
-            margin-bottom: 25px;
-            padding-bottom: 15px;
-            border-bottom: 1px solid var(--card-border);
-        }
-        
-        .card-icon {
-            width: 48px;
-            height: 48px;
-            background: linear-gradient(135deg, var(--primary), var(--secondary));
-            border-radius: 12px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            margin-right: 15px;
-            box-shadow: 0 4px 10px rgba(99, 102, 241, 0.3);
-        }
-        
-        .card-icon i {
-            font-size: 24px;
-            color: white;
-        }
-        
-        .card-title {
-            font-size: 1.6rem;
-            font-weight: 700;
-            background: linear-gradient(45deg, var(--text-primary), var(--text-secondary));
-            -webkit-background-clip: text;
-            background-clip: text;
-            -webkit-text-fill-color: transparent;
-        }
-        
-        .drop-area {
-            border: 2px dashed var(--card-border);
-            border-radius: 12px;
-            padding: 40px 20px;
-            text-align: center;
-            margin-bottom: 25px;
-            transition: all 0.3s;
-            cursor: pointer;
-            position: relative;
-            overflow: hidden;
-        }
-        
-        .drop-area::before {
-            content: "";
-            position: absolute;
-            top: 0;
-            left: 0;
-            right: 0;
-            bottom: 0;
-            background: rgba(99, 102, 241, 0.05);
-            opacity: 0;
-            transition: opacity 0.3s;
-        }
-        
-        .drop-area:hover::before {
-            opacity: 1;
-        }
-        
-        .drop-area.active {
-            border-color: var(--primary);
-            background-color: rgba(99, 102, 241, 0.08);
-        }
-        
-        .drop-area i {
-            font-size: 3.5rem;
-            margin-bottom: 15px;
-            display: block;
-            color: var(--primary-light);
-            opacity: 0.8;
-        }
-        
-        .drop-area p {
-            margin: 5px 0;
-            color: var(--text-secondary);
-        }
-        
-        .file-input {
-            display: none;
-        }
-        
-        .btn {
-            background: linear-gradient(135deg, var(--primary), var(--secondary));
-            color: white;
-            border: none;
-            padding: 14px 30px;
-            border-radius: 12px;
-            font-size: 1rem;
-            font-weight: 600;
-            cursor: pointer;
-            transition: all 0.3s;
-            display: inline-block;
-            text-align: center;
-            width: 100%;
-            max-width: 240px;
-            position: relative;
-            overflow: hidden;
-            box-shadow: 0 4px 15px rgba(99, 102, 241, 0.3);
-            border: 1px solid rgba(255, 255, 255, 0.1);
-        }
-        
-        .btn::before {
-            content: "";
-            position: absolute;
-            top: 0;
-            left: -100%;
-            width: 100%;
-            height: 100%;
-            background: linear-gradient(90deg, transparent, rgba(255, 255, 255, 0.2), transparent);
-            transition: 0.5s;
-        }
-        
-        .btn:hover::before {
-            left: 100%;
-        }
-        
-        .btn:hover {
-            transform: translateY(-3px);
-            box-shadow: 0 8px 20px rgba(99, 102, 241, 0.4);
-        }
-        
-        .btn:disabled {
-            background: var(--card-border);
-            cursor: not-allowed;
-            transform: none;
-            box-shadow: none;
-        }
-        
-        .btn:disabled:hover::before {
-            left: -100%;
-        }
-        
-        .btn-secondary {
-            background: linear-gradient(135deg, var(--accent), #a78bfa);
-        }
-        
-        .btn-secondary:hover {
-            box-shadow: 0 8px 20px rgba(139, 92, 246, 0.4);
-        }
-        
-        .btn-accent {
-            background: linear-gradient(135deg, var(--success), #34d399);
-        }
-        
-        .btn-accent:hover {
-            box-shadow: 0 8px 20px rgba(16, 185, 129, 0.4);
-        }
-        
-        .progress-container {
-            margin: 25px 0;
-        }
-        
-        .progress-bar {
-            height: 10px;
-            background: rgba(255, 255, 255, 0.1);
-            border-radius: 5px;
-            overflow: hidden;
-            position: relative;
-        }
-        
-        .progress {
-            height: 100%;
-            background: linear-gradient(90deg, var(--primary), var(--secondary));
-            width: 0%;
-            transition: width 0.4s cubic-bezier(0.34, 1.56, 0.64, 1);
-            position: relative;
-        }
-        
-        .progress::after {
-            content: "";
-            position: absolute;
-            top: 0;
-            left: 0;
-            right: 0;
-            bottom: 0;
-            background: linear-gradient(90deg, transparent, rgba(255, 255, 255, 0.2), transparent);
-            background-size: 200% 100%;
-            animation: shimmer 2s infinite;
-        }
-        
-        @keyframes shimmer {
-            0% { background-position: -200% 0; }
-            100% { background-position: 200% 0; }
-        }
-        
-        .file-info {
-            display: flex;
-            justify-content: space-between;
-            margin-top: 12px;
-            font-size: 0.9rem;
-            color: var(--text-secondary);
-        }
-        
-        .id-container {
-            margin: 25px 0;
-            display: none;
-            text-align: center;
-        }
-        
-        .transfer-id {
-            font-size: 1.5rem;
-            font-weight: bold;
-            padding: 16px 30px;
-            background: rgba(99, 102, 241, 0.1);
-            border-radius: 12px;
-            display: inline-block;
-            margin: 20px 0;
-            color: var(--text-primary);
-            border: 1px dashed var(--primary-light);
-            cursor: pointer;
-            position: relative;
-            transition: all 0.3s;
-            font-family: 'Fira Code', monospace;
-            letter-spacing: 1px;
-            backdrop-filter: blur(5px);
-        }
-        
-        .transfer-id:hover {
-            background: rgba(99, 102, 241, 0.2);
-            transform: translateY(-3px);
-            box-shadow: 0 5px 15px rgba(99, 102, 241, 0.2);
-        }
-        
-        .id-tooltip {
-            position: absolute;
-            top: -35px;
-            left: 50%;
-            transform: translateX(-50%);
-            background: rgba(0,0,0,0.8);
-            color: white;
-            padding: 6px 12px;
-            border-radius: 6px;
-            font-size: 0.8rem;
-            opacity: 0;
-            transition: opacity 0.3s;
-            pointer-events: none;
-            backdrop-filter: blur(5px);
-        }
-        
-        .transfer-id:hover .id-tooltip {
-            opacity: 1;
-        }
-        
-        .file-list {
-            margin-top: 20px;
-            max-height: 240px;
-            overflow-y: auto;
-            display: none;
-            border-radius: 12px;
-            background: rgba(0, 0, 0, 0.1);
-            padding: 15px;
-        }
-        
-        /* Scrollbar styling */
-        .file-list::-webkit-scrollbar {
-            width: 8px;
-        }
-        
-        .file-list::-webkit-scrollbar-track {
-            background: rgba(255, 255, 255, 0.05);
-            border-radius: 4px;
-        }
-        
-        .file-list::-webkit-scrollbar-thumb {
-            background: var(--primary);
-            border-radius: 4px;
-        }
-        
-        .file-item {
-            display: flex;
-            justify-content: space-between;
-            padding: 10px 0;
-            border-bottom: 1px solid var(--card-border);
-            align-items: center;
-        }
-        
-        .file-item:last-child {
-            border-bottom: none;
-        }
-        
-        .file-name {
-            overflow: hidden;
-            text-overflow: ellipsis;
-            white-space: nowrap;
-            flex: 1;
-            font-size: 0.95rem;
-        }
-        
-        .file-size {
-            margin-left: 15px;
-            color: var(--text-secondary);
-            font-size: 0.9rem;
-            min-width: 70px;
-            text-align: right;
-        }
-        
-        .file-progress {
-            width: 100%;
-            margin-top: 8px;
-        }
-        
-        .status {
-            padding: 16px;
-            border-radius: 12px;
-            margin: 25px 0;
-            text-align: center;
-            display: none;
-            backdrop-filter: blur(5px);
-        }
-        
-        .status.success {
-            background: rgba(16, 185, 129, 0.1);
-            color: var(--success);
-            border: 1px solid rgba(16, 185, 129, 0.3);
-        }
-        
-        .status.error {
-            background: rgba(239, 68, 68, 0.1);
-            color: var(--error);
-            border: 1px solid rgba(239, 68, 68, 0.3);
-        }
-        
-        .instructions {
-            margin-top: 40px;
-            text-align: center;
-            color: var(--text-secondary);
-            font-size: 1rem;
-            max-width: 800px;
-            margin-left: auto;
-            margin-right: auto;
-        }
-        
-        .instructions h3 {
-            font-size: 1.4rem;
-            margin-bottom: 20px;
-            color: var(--text-primary);
-            font-weight: 600;
-        }
-        
-        .steps {
-            display: grid;
-            grid-template-columns: repeat(auto-fit, minmax(250px, 1fr));
-            gap: 25px;
-            margin-top: 20px;
-        }
-        
-        .step-card {
-            background: var(--card-bg);
-            border-radius: 12px;
-            padding: 25px;
-            text-align: center;
-            border: 1px solid var(--card-border);
-            transition: transform 0.3s;
-        }
-        
-        .step-card:hover {
-            transform: translateY(-5px);
-        }
-        
-        .step-number {
-            width: 40px;
-            height: 40px;
-            background: linear-gradient(135deg, var(--primary), var(--secondary));
-            border-radius: 50%;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            margin: 0 auto 15px;
-            color: white;
-            font-weight: bold;
-            font-size: 1.2rem;
-        }
-        
-        .step-card h4 {
-            margin-bottom: 12px;
-            font-size: 1.1rem;
-            color: var(--text-primary);
-        }
-        
-        .step-card p {
-            color: var(--text-secondary);
-            font-size: 0.95rem;
-            line-height: 1.5;
-        }
-        
-        .file-limit {
-            text-align: center;
-            margin-top: 15px;
-            color: var(--text-secondary);
-            font-size: 0.95rem;
-        }
-        
-        footer {
-            text-align: center;
-            margin-top: 60px;
-            padding: 30px;
-            color: var(--text-secondary);
-            font-size: 0.95rem;
-            border-top: 1px solid var(--card-border);
-        }
-        
-        .link-input {
-            width: 100%;
-            padding: 14px 20px;
-            border-radius: 12px;
-            background: rgba(0, 0, 0, 0.1);
-            border: 1px solid var(--card-border);
-            color: var(--text-primary);
-            font-size: 1rem;
-            transition: all 0.3s;
-            outline: none;
-        }
-        
-        .link-input:focus {
-            border-color: var(--primary);
-            box-shadow: 0 0 0 3px rgba(99, 102, 241, 0.3);
-        }
-        
-        .link-input::placeholder {
-            color: var(--text-secondary);
-        }
-        
-        @media (max-width: 768px) {
-            .card-container {
-                flex-direction: column;
-                align-items: center;
-            }
-            
-            .card {
-                max-width: 100%;
-            }
-            
-            .steps {
-                grid-template-columns: 1fr;
-            }
-        }
-
-                footer {
-            text-align: center;
-            margin-top: 60px;
-            padding: 30px;
-            color: var(--text-secondary);
-            font-size: 0.95rem;
-            border-top: 1px solid var(--card-border);
-        }
-        
-        .contact-email {
-            margin-top: 15px;
-            font-size: 1rem;
-        }
-        
-        .contact-email a {
-            color: var(--primary-light);
-            text-decoration: none;
-            transition: all 0.3s;
-            position: relative;
-        }
-        
-        .contact-email a::after {
-            content: "";
-            position: absolute;
-            bottom: -2px;
-            left: 0;
-            width: 0;
-            height: 1px;
-            background: var(--primary-light);
-            transition: width 0.3s;
-        }
-        
-        .contact-email a:hover {
-            color: white;
-        }
-        
-        .contact-email a:hover::after {
-            width: 100%;
-        }
-        
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('style.css') }}">
     <link href="https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap" rel="stylesheet">
     <link href="https://fonts.googleapis.com/css2?family=Fira+Code:wght@400;500&display=swap" rel="stylesheet">
     <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css">
@@ -665,6 +199,11 @@ HTML_TEMPLATE = """
                     </div>
                 </div>
                 
+                <label class="compress-option" id="compressOption">
+                    <input type="checkbox" id="compressChunks">
+                    Compress while uploading (best for text, logs and CSV files)
+                </label>
+                
                 <button class="btn" id="sendBtn" disabled>Generate Transfer ID</button>
                 
                 <div class="id-container" id="idContainer">
@@ -748,522 +287,857 @@ HTML_TEMPLATE = """
         </footer>
     </div>
 
-    <script>
-        // DOM Elements
-        const dropArea = document.getElementById('dropArea');
-        const fileInput = document.getElementById('fileInput');
-        const browseBtn = document.getElementById('browseBtn');
-        const sendBtn = document.getElementById('sendBtn');
-        const progressContainer = document.getElementById('progressContainer');
-        const totalProgressBar = document.getElementById('totalProgressBar');
-        const totalFiles = document.getElementById('totalFiles');
-        const totalSize = document.getElementById('totalSize');
-        const fileList = document.getElementById('fileList');
-        const idContainer = document.getElementById('idContainer');
-        const transferId = document.getElementById('transferId');
-        const idText = document.getElementById('idText');
-        
-        const peerIdInput = document.getElementById('peerId');
-        const receiveBtn = document.getElementById('receiveBtn');
-        const receiveFileList = document.getElementById('receiveFileList');
-        const receiveProgress = document.getElementById('receiveProgress');
-        const receiveBar = document.getElementById('receiveBar');
-        const receiveStatusText = document.getElementById('receiveStatusText');
-        const receiveStatus = document.getElementById('receiveStatus');
-        const downloadBtn = document.getElementById('downloadBtn');
-        
-        // Variables
-        let selectedFiles = [];
-        let transferIdValue = null;
-        const CHUNK_SIZE = 5 * 1024 * 1024; // 5MB chunks
-        
-        // Event Listeners
-        browseBtn.addEventListener('click', () => fileInput.click());
-        fileInput.addEventListener('change', handleFileSelect);
-        dropArea.addEventListener('dragover', (e) => {
-            e.preventDefault();
-            dropArea.classList.add('active');
-        });
-        dropArea.addEventListener('dragleave', () => {
-            dropArea.classList.remove('active');
-        });
-        dropArea.addEventListener('drop', (e) => {
-            e.preventDefault();
-            dropArea.classList.remove('active');
-            if (e.dataTransfer.files.length) {
-                fileInput.files = e.dataTransfer.files;
-                handleFileSelect();
-            }
-        });
-        
-        sendBtn.addEventListener('click', generateTransferId);
-        transferId.addEventListener('click', copyTransferId);
-        receiveBtn.addEventListener('click', connectToPeer);
-        
-        // Handle file selection
-        function handleFileSelect() {
-            if (fileInput.files.length === 0) return;
-            
-            selectedFiles = Array.from(fileInput.files);
-            updateFileList(selectedFiles);
-            sendBtn.disabled = false;
-        }
-        
-        // Update file list display
-        function updateFileList(files) {
-            fileList.innerHTML = '';
-            fileList.style.display = 'block';
-            progressContainer.style.display = 'block';
-            
-            let totalSizeBytes = 0;
-            
-            files.forEach((file, index) => {
-                totalSizeBytes += file.size;
-                
-                const fileItem = document.createElement('div');
-                fileItem.className = 'file-item';
-                fileItem.innerHTML = `
-                    <div class="file-name">${file.name}</div>
-                    <div class="file-size">${formatFileSize(file.size)}</div>
-                    <div class="file-progress">
-                        <div class="progress-bar">
-                            <div class="progress" id="fileProgress-${index}" style="width: 0%"></div>
-                        </div>
-                    </div>
-                `;
-                fileList.appendChild(fileItem);
-            });
-            
-            totalFiles.textContent = `${files.length} file${files.length > 1 ? 's' : ''}`;
-            totalSize.textContent = formatFileSize(totalSizeBytes);
-            totalProgressBar.style.width = '0%';
-        }
-        
-        // Format file size
-        function formatFileSize(bytes) {
-            if (bytes < 1024) return bytes + ' bytes';
-            else if (bytes < 1048576) return (bytes / 1024).toFixed(1) + ' KB';
-            else if (bytes < 1073741824) return (bytes / 1048576).toFixed(1) + ' MB';
-            else return (bytes / 1073741824).toFixed(1) + ' GB';
-        }
-        
-        // Generate transfer ID
-        function generateTransferId() {
-            if (selectedFiles.length === 0) return;
-            
-            // Show progress
-            totalProgressBar.style.width = '10%';
-            
-            // Create a new transfer on the server
-            fetch('/create_transfer', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    file_count: selectedFiles.length,
-                    total_size: selectedFiles.reduce((sum, file) => sum + file.size, 0)
-                })
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    transferIdValue = data.transfer_id;
-                    // Upload files in chunks
-                    uploadFiles(transferIdValue);
-                } else {
-                    showStatus('Error: ' + data.error, 'error');
-                    totalProgressBar.style.width = '0%';
-                }
-            })
-            .catch(error => {
-                console.error('Error:', error);
-                showStatus('Error creating transfer', 'error');
-                totalProgressBar.style.width = '0%';
-            });
-        }
-        
-        // Upload files in chunks
-        function uploadFiles(transferId) {
-            let uploadedCount = 0;
-            const totalCount = selectedFiles.length;
-            
-            selectedFiles.forEach((file, fileIndex) => {
-                const fileId = uuidv4();
-                const totalChunks = Math.ceil(file.size / CHUNK_SIZE);
-                let chunkIndex = 0;
-                
-                function uploadNextChunk() {
-                    if (chunkIndex >= totalChunks) {
-                        // File upload complete
-                        uploadedCount++;
-                        updateTotalProgress(uploadedCount, totalCount);
-                        
-                        if (uploadedCount === totalCount) {
-                            // All files uploaded
-                            idContainer.style.display = 'block';
-                            idText.textContent = transferId;
-                            sendBtn.disabled = true;
-                            showStatus('All files uploaded! Share the transfer ID.', 'success');
-                            
-                            // Animate ID container
-                            idContainer.style.opacity = '0';
-                            idContainer.style.transform = 'translateY(20px)';
-                            setTimeout(() => {
-                                idContainer.style.transition = 'all 0.5s ease';
-                                idContainer.style.opacity = '1';
-                                idContainer.style.transform = 'translateY(0)';
-                            }, 100);
-                        }
-                        return;
-                    }
-                    
-                    const start = chunkIndex * CHUNK_SIZE;
-                    const end = Math.min(file.size, start + CHUNK_SIZE);
-                    const chunk = file.slice(start, end);
-                    
-                    const formData = new FormData();
-                    formData.append('transfer_id', transferId);
-                    formData.append('file_id', fileId);
-                    formData.append('file_index', fileIndex.toString());
-                    formData.append('chunk_index', chunkIndex.toString());
-                    formData.append('total_chunks', totalChunks.toString());
-                    formData.append('chunk', chunk);
-                    formData.append('file_name', file.name);
-                    formData.append('file_size', file.size.toString());
-                    
-                    fetch('/upload_chunk', {
-                        method: 'POST',
-                        body: formData
-                    })
-                    .then(response => response.json())
-                    .then(data => {
-                        if (data.success) {
-                            // Update progress for this file
-                            const progress = ((chunkIndex + 1) / totalChunks) * 100;
-                            document.getElementById(`fileProgress-${fileIndex}`).style.width = `${progress}%`;
-                            
-                            chunkIndex++;
-                            uploadNextChunk();
-                        } else {
-                            showStatus(`Error uploading ${file.name}: ${data.error}`, 'error');
-                        }
-                    })
-                    .catch(error => {
-                        console.error('Error:', error);
-                        showStatus(`Error uploading ${file.name}`, 'error');
-                    });
-                }
-                
-                // Start uploading chunks for this file
-                uploadNextChunk();
-            });
-        }
-        
-        // Update total progress
-        function updateTotalProgress(uploadedCount, totalCount) {
-            const progress = (uploadedCount / totalCount) * 100;
-            totalProgressBar.style.width = `${progress}%`;
-        }
-        
-        // Simple UUID generator for file chunks
-        function uuidv4() {
-            return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
-                const r = Math.random() * 16 | 0, v = c === 'x' ? r : (r & 0x3 | 0x8);
-                return v.toString(16);
-            });
-        }
-        
-        // Copy transfer ID to clipboard
-        function copyTransferId() {
-            const textArea = document.createElement('textarea');
-            textArea.value = transferIdValue;
-            document.body.appendChild(textArea);
-            textArea.select();
-            document.execCommand('copy');
-            document.body.removeChild(textArea);
-            
-            // Show visual feedback
-            const originalText = idText.textContent;
-            idText.textContent = 'Copied to clipboard!';
-            idText.style.color = '#10b981';
-            
-            setTimeout(() => {
-                idText.textContent = originalText;
-                idText.style.color = '';
-            }, 2000);
-        }
-        
-        // Connect to peer
-        function connectToPeer() {
-            const transferId = peerIdInput.value.trim();
-            if (!transferId) return;
-            
-            receiveBtn.disabled = true;
-            receiveStatus.textContent = 'Connecting to peer...';
-            receiveStatus.className = 'status';
-            receiveStatus.style.display = 'block';
-            
-            // Animate status appearance
-            receiveStatus.style.opacity = '0';
-            receiveStatus.style.transform = 'translateY(10px)';
-            setTimeout(() => {
-                receiveStatus.style.transition = 'all 0.3s ease';
-                receiveStatus.style.opacity = '1';
-                receiveStatus.style.transform = 'translateY(0)';
-            }, 100);
-            
-            // Check if transfer exists
-            fetch(`/transfer/${transferId}`)
-            .then(response => response.json())
-            .then(data => {
-                if (data.exists) {
-                    receiveStatus.textContent = 'Transfer found! Preparing download...';
-                    
-                    // Get file list
-                    fetch(`/transfer/${transferId}/files`)
-                    .then(response => response.json())
-                    .then(fileData => {
-                        if (fileData.success) {
-                            displayReceiveFiles(fileData.files);
-                            receiveStatus.textContent = `Ready to download ${fileData.files.length} files`;
-                            receiveStatus.className = 'status success';
-                            
-                            // Show download button
-                            downloadBtn.href = `/download_all/${transferId}`;
-                            downloadBtn.textContent = `Download All Files (${formatFileSize(fileData.total_size)})`;
-                            downloadBtn.style.display = 'inline-block';
-                            
-                            // Animate download button appearance
-                            downloadBtn.style.opacity = '0';
-                            downloadBtn.style.transform = 'translateY(10px)';
-                            setTimeout(() => {
-                                downloadBtn.style.transition = 'all 0.4s ease';
-                                downloadBtn.style.opacity = '1';
-                                downloadBtn.style.transform = 'translateY(0)';
-                            }, 100);
-                        } else {
-                            receiveStatus.textContent = 'Error: ' + fileData.error;
-                            receiveStatus.className = 'status error';
-                        }
-                    });
-                } else {
-                    receiveStatus.textContent = 'Transfer not found. Please check the ID.';
-                    receiveStatus.className = 'status error';
-                    receiveBtn.disabled = false;
-                }
-            })
-            .catch(error => {
-                console.error('Error:', error);
-                receiveStatus.textContent = 'Error connecting to server';
-                receiveStatus.className = 'status error';
-                receiveBtn.disabled = false;
-            });
-        }
-        
-        // Display files for receiving
-        function displayReceiveFiles(files) {
-            receiveFileList.innerHTML = '';
-            receiveFileList.style.display = 'block';
-            
-            // Animate file list appearance
-            receiveFileList.style.opacity = '0';
-            receiveFileList.style.transform = 'translateY(10px)';
-            setTimeout(() => {
-                receiveFileList.style.transition = 'all 0.4s ease';
-                receiveFileList.style.opacity = '1';
-                receiveFileList.style.transform = 'translateY(0)';
-            }, 100);
-            
-            files.forEach(file => {
-                const fileItem = document.createElement('div');
-                fileItem.className = 'file-item';
-                fileItem.innerHTML = `
-                    <div class="file-name">${file.filename}</div>
-                    <div class="file-size">${formatFileSize(file.filesize)}</div>
-                `;
-                receiveFileList.appendChild(fileItem);
-            });
-        }
-        
-        // Show status message
-        function showStatus(message, type) {
-            // In a real implementation, this would show a status message
-            console.log(`${type}: ${message}`);
-        }
-        
-        // Initialize
-        function init() {
-            // Check if we have a transfer ID in the URL
-            const pathParts = window.location.pathname.split('/');
-            if (pathParts.length > 2 && pathParts[1] === 'receive') {
-                peerIdInput.value = pathParts[2];
-            }
-        }
-        
-        // Start the app
-        init();
-    </script>
+    <script src="{{ asset_url('app.js') }}"></script>
 </body>
 </html>   """
 
+class ExpiryScheduler:
+    """Expire transfers from a single background thread.
+
+    Deadlines are kept in a min-heap, so scheduling a transfer and finding the
+    next one due are O(log n). Due transfers are handed to ``expire`` in
+    batches of at most ``batch_size``, with ``batch_interval`` seconds between
+    full batches. ``load`` returns the (expires_at, transfer_id) pairs that
+    already exist when the scheduler starts.
+    """
+    
+    def __init__(self, expire, batch_size, batch_interval, load=None):
+        self.expire = expire
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.load = load
+        self._heap = []
+        self._cond = threading.Condition()
+        self._pid = None
+    
+    def start(self):
+        """Start the scheduler thread in this process if it isn't running yet.
+
+        Cheap enough to call on every request; a forked worker notices that
+        the thread belongs to its parent and starts its own.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            if self.load is not None:
+                self._heap = list(self.load())
+                heapq.heapify(self._heap)
+            threading.Thread(target=self._run, name='expiry-scheduler', daemon=True).start()
+    
+    def schedule(self, transfer_id, expires_at):
+        self.start()
+        with self._cond:
+            heapq.heappush(self._heap, (expires_at, transfer_id))
+            if self._heap[0][1] == transfer_id:
+                # New earliest deadline, wake the thread up early
+                self._cond.notify()
+    
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+    
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    break
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                batch.append(heapq.heappop(self._heap)[1])
+            return batch
+    
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            for transfer_id in batch:
+                try:
+                    self.expire(transfer_id)
+                except Exception as e:
+                    print(f"Failed to clean up transfer {transfer_id}: {e}")
+            if len(batch) == self.batch_size:
+                time.sleep(self.batch_interval)
+
+def get_transfer(transfer_id):
+    transfer = registry.get(transfer_id)
+    # Expired transfers may wait a little for their batch to be deleted
+    if transfer is not None and transfer['expires_at'] <= time.time():
+        return None
+    return transfer
+
+class DecodingReader:
+    """Decompress a request body as it is read.
+
+    read() never returns more than it is asked for however well the data
+    compressed, so only one buffer of either side is in memory at a time.
+    """
+    
+    def __init__(self, stream, wbits):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj(wbits)
+    
+    def read(self, size):
+        while not self.decompressor.eof:
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                data = self.stream.read(WRITE_BUFFER_SIZE)
+                if not data:
+                    # Cut short; the caller sees fewer bytes than it expected
+                    break
+                ENCODED_BYTES_RECEIVED.inc(len(data))
+            decoded = self.decompressor.decompress(data, size)
+            if decoded:
+                return decoded
+        return b''
+
+def request_body():
+    """The request body, decoded if the client compressed it.
+
+    Returns None for a Content-Encoding we can't decode.
+    """
+    encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+    if encoding == 'identity':
+        return request.stream
+    if encoding not in CONTENT_ENCODINGS:
+        return None
+    return DecodingReader(request.stream, CONTENT_ENCODINGS[encoding])
+
+def archive_space(size):
+    """Disk space set aside to prebuild the archive of ``size`` bytes of files.
+
+    The segments stay on disk until the archive assembled from them has
+    been written, so both are counted.
+    """
+    return size * 2 if app.config['PREBUILD_ARCHIVES'] else 0
+
+def space_needed(size):
+    """Disk space that ``size`` bytes of uploads will take, archives included"""
+    return size + archive_space(size)
+
+def space_outstanding(usage):
+    """Bytes of a volume's reservations not written yet, from its usage()"""
+    return usage['reserved'] - usage['allocated'] + usage['archive_pending']
+
+def has_space_for(total_size, volume, outstanding):
+    """Whether ``volume`` can take a new transfer on top of its reservations.
+
+    Files are preallocated when registered, so only the part of each
+    reservation not yet allocated, and the archive space not yet written
+    (``outstanding``, per volume), still has to come out of free space,
+    leaving DISK_HEADROOM.
+    """
+    room = storage.room(volume, space_needed(total_size), outstanding)
+    # Only DISK_QUOTA limits what an object store or memory takes
+    return room is None or room >= 0
+
+def retry_after():
+    """Seconds until the next transfer expires and frees its space"""
+    next_expiry = registry.next_expiry()
+    if next_expiry is None:
+        return 60
+    return max(1, min(int(next_expiry - time.time()) + 1, 3600))
+
+def register_file(transfer_id, volume, file_id, file_index, file_name, file_size, total_chunks, chunk_size):
+    """Record a file's metadata and create its output file, once per file_id.
+
+    Returns the file's registry entry, or None if the transfer is gone.
+    Raises ReservationExceeded if the transfer's files outgrow its total_size.
+    """
+    file_info = registry.get_file(transfer_id, file_id)
+    if file_info is not None:
+        return file_info
+    
+    # The file is created before it is registered, since object storage
+    # only knows its location once the upload has been started
+    try:
+        location = storage.create_file(transfer_id, f'file_{file_index}_{file_name}', file_size, volume)
+    except FileNotFoundError:
+        return None
+    try:
+        file_info, created = registry.add_file(transfer_id, file_id, {
+            'file_name': file_name,
+            'file_size': file_size,
+            'total_chunks': total_chunks,
+            'chunk_size': chunk_size,
+            'file_index': file_index,
+            'filepath': location
+        })
+    except ReservationExceeded:
+        storage.delete(location)
+        raise
+    # Another request registered the file first, or the transfer expired
+    if file_info is None or file_info['filepath'] != location:
+        storage.delete(location)
+    if not created:
+        return file_info
+    
+    # Empty files have no chunks to wait for
+    if total_chunks == 0 and registry.complete_file(transfer_id, file_id):
+        file_completed(transfer_id, file_id, file_info)
+    return file_info
+
+def file_completed(transfer_id, file_id, file_info):
+    """Called once for every file whose last chunk has been stored"""
+    if app.config['PREBUILD_ARCHIVES']:
+        archive_pool.submit(build_segment, transfer_id, file_id, file_info)
+
+def build_segment(transfer_id, file_id, file_info):
+    """Compress a completed file into its own archive segment.
+
+    Segments don't depend on their position in the archive, so they can be
+    built by whichever worker process completed the file. The caller that
+    adds the last one assembles the archive.
+    """
+    transfer = registry.get(transfer_id)
+    if transfer is None:
+        return
+    start = perf_counter()
+    try:
+        zs = ZipStream(compresslevel=app.config['ZIP_COMPRESSION_LEVEL'])
+        parts = zip_members(zs, [(storage.source(file_info['filepath']), file_info['file_name'])],
+                            app.config['ZIP_COMPRESSION'], app.config['ZIP_COMPRESSION_LEVEL'],
+                            compression_pool, window=2 * app.config['ZIP_COMPRESSION_WORKERS'] + 2)
+        with storage.create(transfer_id, f"segment_{file_info['file_index']}.zip", transfer['volume']) as out:
+            for part in parts:
+                out.write(part)
+        ARCHIVE_BUILD.labels('segment').observe(perf_counter() - start)
+        segments = registry.add_segment(transfer_id, file_id, {
+            'location': out.location,
+            'size': zs.offset,
+            'entry': zs.entries[0]
+        })
+        if segments is not None:
+            assemble_archive(transfer_id, transfer['volume'], segments)
+    except Exception as e:
+        # download_all falls back to streaming the archive
+        print(f"Failed to build archive for transfer {transfer_id}: {e}")
+        registry.set_archive(transfer_id, None)
+
+def assemble_archive(transfer_id, volume, segments):
+    """Join the segments of a transfer into its final archive"""
+    start = perf_counter()
+    zs = ZipStream()
+    with storage.create(transfer_id, 'archive.zip', volume) as out:
+        for segment in segments:
+            with storage.open(segment['location']) as f:
+                shutil.copyfileobj(f, out, WRITE_BUFFER_SIZE)
+            zs.append_segment(segment['entry'], segment['size'])
+        for part in zs.finish():
+            out.write(part)
+    
+    for segment in segments:
+        storage.delete(segment['location'])
+    registry.set_archive(transfer_id, out.location)
+    
+    ARCHIVE_BUILD.labels('assemble').observe(perf_counter() - start)
+    input_size = sum(segment['entry']['file_size'] for segment in segments)
+    if input_size:
+        ARCHIVE_RATIO.observe(zs.offset / input_size)
+
+def missing_ranges(bitmap, total_chunks):
+    """Return the chunks not yet received as a list of [first, last] ranges"""
+    ranges = []
+    start = None
+    for chunk_index in range(total_chunks):
+        # Skip over whole bytes of received chunks
+        if start is None and chunk_index & 7 == 0 and bitmap[chunk_index >> 3] == 0xFF:
+            continue
+        if chunk_received(bitmap, chunk_index):
+            if start is not None:
+                ranges.append([start, chunk_index - 1])
+                start = None
+        elif start is None:
+            start = chunk_index
+    if start is not None:
+        ranges.append([start, total_chunks - 1])
+    return ranges
+
+def receive_chunk(transfer_id, file_id, file_info, offset, length, stream):
+    """Write ``length`` bytes at ``offset`` and complete the file once all data is in.
+
+    A chunk covers one or more of the file's chunk_size units: it has to start
+    on a unit boundary and end on one or at the end of the file. Chunks whose
+    units were all received already are ignored, so retries are harmless, even
+    with a different chunk size. Returns an error message, or None if the
+    chunk is stored.
+    """
+    unit = file_info['chunk_size']
+    end = offset + length
+    if offset % unit or not 0 <= offset < end <= file_info['file_size']:
+        return 'Invalid chunk'
+    if end % unit and end != file_info['file_size']:
+        return 'Chunk does not end on a chunk boundary'
+    first = offset // unit
+    last = -(-end // unit) - 1
+    if all(chunk_received(file_info['received'], chunk_index) for chunk_index in range(first, last + 1)):
+        # A retry of a file whose data is all in but that failed to finalize
+        # finalizes it again
+        if not file_info['complete'] and file_info['received_chunks'] == file_info['total_chunks']:
+            with metrics.stage('complete', COMPLETE_TIME):
+                finish_file(transfer_id, file_id, file_info)
+        return None
+    
+    # Only the storing of each buffer takes a chunk write slot, not the wait
+    # for the body; raises Overloaded, before any of the body is read, when
+    # too many chunks are being stored already
+    stream = GatedReader(stream, chunk_writes)
+    try:
+        # Writers of the same units write the same bytes, so no lock is needed
+        with metrics.stage('write', WRITE_TIME):
+            written = storage.write(file_info['filepath'], offset, stream, length, unit)
+        stream.release()
+        if written < 0:
+            return 'Chunk larger than expected'
+        BYTES_RECEIVED.inc(written)
+        if written < length:
+            return 'Chunk smaller than expected'
+        
+        # Once every unit is stored the file is complete
+        with metrics.stage('complete', COMPLETE_TIME):
+            if registry.mark_chunks(transfer_id, file_id, first, last):
+                finish_file(transfer_id, file_id, file_info)
+    finally:
+        stream.release()
+    return None
+
+def finish_file(transfer_id, file_id, file_info):
+    """Finalize a file whose chunks are all stored, then record it complete.
+
+    Completion is recorded only once finalize has succeeded, so a file that
+    failed to finalize isn't listed and a retried chunk tries again.
+    """
+    storage.finalize(file_info['filepath'], file_info['file_size'], file_info['chunk_size'])
+    if registry.complete_file(transfer_id, file_id):
+        file_completed(transfer_id, file_id, file_info)
+
+def indexed_chunk(file_info, chunk_index):
+    """The (offset, length) of a chunk addressed by index rather than offset"""
+    offset = chunk_index * file_info['chunk_size']
+    return offset, min(file_info['chunk_size'], file_info['file_size'] - offset)
+
+def measure_archive(parts, input_size, timer):
+    """Pass a streamed archive through, recording its build time and size.
+
+    The request's timer is passed in because the archive is streamed after
+    the view has returned; the slow-request log sees the stream stage.
+    """
+    start = perf_counter()
+    served = BYTES_SERVED.labels('download_all')
+    output_size = 0
+    for part in parts:
+        output_size += len(part)
+        served.inc(len(part))
+        yield part
+    elapsed = perf_counter() - start
+    ARCHIVE_BUILD.labels('stream').observe(elapsed)
+    timer.add('stream', elapsed)
+    if input_size:
+        ARCHIVE_RATIO.observe(output_size / input_size)
+
 # Flask Routes
 @app.route('/')
 def index():
-    return render_template_string(HTML_TEMPLATE)
+    # Revalidated on every visit, so a new deploy is picked up straight away
+    return serve_asset(request, Response, index_page, 'no-cache')
+
+@app.route('/static/<filename>')
+def static_file(filename):
+    asset = static_assets.get(filename)
+    if asset is None:
+        return "Not found", 404
+    return serve_asset(request, Response, asset, STATIC_CACHE_CONTROL)
 
 @app.route('/create_transfer', methods=['POST'])
 def create_transfer():
-    data = request.json
-    transfer_id = str(uuid.uuid4())
+    with metrics.stage('parse'):
+        data = request.get_json(silent=True)
+        transfer_id = str(uuid.uuid4())
+        try:
+            total_size = int(data['total_size'])
+            file_count = int(data['file_count'])
+            ttl = min(int(data.get('ttl', app.config['TRANSFER_TTL'])), app.config['MAX_TRANSFER_TTL'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Invalid transfer'}), 400
+        created_at = time.time()
     
-    with transfer_lock:
-        transfers[transfer_id] = {
-            'files': [],
-            'total_size': data['total_size'],
-            'file_count': data['file_count'],
-            'created_at': time.time(),
-            'downloaded': False,
-            'chunks': {}
-        }
+    # Turn away what can't fit before any of it is uploaded
+    quota = app.config['DISK_QUOTA'] or None
+    if total_size < 0:
+        return jsonify({'success': False, 'error': 'Invalid transfer size'}), 400
+    if file_count < 0:
+        return jsonify({'success': False, 'error': 'Invalid file count'}), 400
+    if ttl <= 0:
+        return jsonify({'success': False, 'error': 'Invalid ttl'}), 400
+    if quota is not None and total_size > quota:
+        return jsonify({'success': False, 'error': 'Transfer too large'}), 413
+    with metrics.stage('place'):
+        usage = registry.usage_by_volume()
+        outstanding = {volume: space_outstanding(u) for volume, u in usage.items()}
+        pending = {volume: u['reserved'] - u['received'] + u['archive_pending'] for volume, u in usage.items()}
+        volume = storage.place(space_needed(total_size), outstanding, pending)
+    with metrics.stage('space'):
+        has_space = has_space_for(total_size, volume, outstanding)
+    if not has_space:
+        return space_error('Not enough disk space for this transfer right now', 507)
     
-    # Start cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_transfer, args=(transfer_id,))
-    cleanup_thread.daemon = True
-    cleanup_thread.start()
+    with metrics.stage('mkdir'):
+        placed = storage.create_transfer(transfer_id, volume, space_needed(total_size))
+    # A memory tier filled up by concurrent creates puts it elsewhere
+    if placed != volume:
+        volume = placed
+        if not has_space_for(total_size, volume, outstanding):
+            storage.delete_transfer(transfer_id, volume)
+            return space_error('Not enough disk space for this transfer right now', 507)
+    with metrics.stage('register'):
+        created = registry.create(transfer_id, total_size, file_count, created_at, created_at + ttl,
+                                  quota, volume, archive_space(total_size))
+    if not created:
+        storage.delete_transfer(transfer_id, volume)
+        return space_error('Storage quota reached, try again later', 503)
+    
+    # Schedule cleanup
+    with metrics.stage('schedule'):
+        expiry.schedule(transfer_id, created_at + ttl)
     
     return jsonify({
         'success': True,
-        'transfer_id': transfer_id
+        'transfer_id': transfer_id,
+        'upload_window': app.config['UPLOAD_WINDOW'],
+        'min_chunk_size': storage.chunk_unit(0, app.config['MIN_CHUNK_SIZE']),
+        'max_chunk_size': app.config['MAX_CHUNK_SIZE']
     })
 
+def space_error(message, status):
+    retry = retry_after()
+    response = jsonify({'success': False, 'error': message, 'retry_after': retry})
+    response.headers['Retry-After'] = str(retry)
+    return response, status
+
 @app.route('/upload_chunk', methods=['POST'])
 def upload_chunk():
-    transfer_id = request.form.get('transfer_id')
-    file_id = request.form.get('file_id')
-    file_index = int(request.form.get('file_index'))
-    chunk_index = int(request.form.get('chunk_index'))
-    total_chunks = int(request.form.get('total_chunks'))
-    file_name = request.form.get('file_name')
-    file_size = int(request.form.get('file_size'))
-    chunk = request.files['chunk']
+    """Multipart chunk upload, kept for clients that predate the PUT endpoint"""
+    # The whole multipart body, chunk included, is read while parsing
+    with metrics.stage('parse', PARSE_TIME):
+        transfer_id = request.form.get('transfer_id')
+        file_id = request.form.get('file_id')
+        file_index = int(request.form.get('file_index'))
+        chunk_index = int(request.form.get('chunk_index'))
+        total_chunks = int(request.form.get('total_chunks'))
+        file_name = request.form.get('file_name')
+        file_size = int(request.form.get('file_size'))
+        chunk_size = int(request.form.get('chunk_size', CHUNK_SIZE))
+        chunk = request.files['chunk']
     
-    with transfer_lock:
-        if transfer_id not in transfers:
-            return jsonify({'success': False, 'error': 'Invalid transfer ID'}), 400
-        
-        transfer = transfers[transfer_id]
-        
-        # Create directory for chunks if it doesn't exist
-        chunk_dir = os.path.join(UPLOAD_FOLDER, transfer_id, file_id)
-        os.makedirs(chunk_dir, exist_ok=True)
-        
-        # Save chunk
-        chunk_path = os.path.join(chunk_dir, f'chunk_{chunk_index}')
-        chunk.save(chunk_path)
-        
-        # Track chunks
-        if file_id not in transfer['chunks']:
-            transfer['chunks'][file_id] = {
-                'file_name': file_name,
-                'file_size': file_size,
-                'total_chunks': total_chunks,
-                'received_chunks': 0,
-                'file_index': file_index
-            }
-        
-        transfer['chunks'][file_id]['received_chunks'] += 1
-        
-        # Check if all chunks received
-        if transfer['chunks'][file_id]['received_chunks'] == total_chunks:
-            # Combine chunks into a single file
-            output_path = os.path.join(UPLOAD_FOLDER, transfer_id, f'file_{file_index}_{file_name}')
-            with open(output_path, 'wb') as outfile:
-                for i in range(total_chunks):
-                    chunk_path = os.path.join(chunk_dir, f'chunk_{i}')
-                    with open(chunk_path, 'rb') as infile:
-                        shutil.copyfileobj(infile, outfile)
-            
-            # Add to files list
-            transfer['files'].append({
-                'filename': file_name,
-                'filepath': output_path,
-                'filesize': file_size,
-                'file_index': file_index
-            })
-            
-            # Remove chunks
-            shutil.rmtree(chunk_dir)
-            del transfer['chunks'][file_id]
+    with metrics.stage('lookup', LOOKUP_TIME):
+        transfer = get_transfer(transfer_id)
+    if transfer is None:
+        return jsonify({'success': False, 'error': 'Invalid transfer ID'}), 400
+    if file_size < 0 or chunk_size <= 0:
+        return jsonify({'success': False, 'error': 'Invalid chunk'}), 400
+    # Chunks are addressed by index, so their size can't be adjusted here
+    if storage.chunk_unit(file_size, chunk_size) != chunk_size:
+        return jsonify({'success': False, 'error': 'Chunk size not supported by storage'}), 400
+    # The chunk count follows from the sizes; a client's count that disagrees
+    # would mark the file complete early or overrun its bitmap
+    if total_chunks != -(-file_size // chunk_size):
+        return jsonify({'success': False, 'error': 'Invalid chunk count'}), 400
+
+    try:
+        with metrics.stage('register'):
+            file_info = register_file(transfer_id, transfer['volume'], file_id, file_index, file_name,
+                                      file_size, total_chunks, chunk_size)
+    except ReservationExceeded:
+        return jsonify({'success': False, 'error': 'Files larger than the transfer'}), 413
+    if file_info is None:
+        return jsonify({'success': False, 'error': 'Invalid transfer ID'}), 400
+    error = receive_chunk(transfer_id, file_id, file_info, *indexed_chunk(file_info, chunk_index), chunk.stream)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    
+    return jsonify({'success': True})
+
+@app.route('/transfer/<transfer_id>/files', methods=['POST'])
+def add_file(transfer_id):
+    """Register a file once before its chunks are sent to /upload.
+
+    The response gives the chunk_size the file's chunks are counted in,
+    which storage may have raised to a multiple of the one asked for.
+    """
+    data = request.json
+    transfer = get_transfer(transfer_id)
+    if transfer is None:
+        return jsonify({'success': False, 'error': 'Invalid transfer ID'}), 400
+    
+    file_size = int(data['file_size'])
+    chunk_size = int(data.get('chunk_size', CHUNK_SIZE))
+    if file_size < 0 or chunk_size <= 0:
+        return jsonify({'success': False, 'error': 'Invalid file'}), 400
+    chunk_size = storage.chunk_unit(file_size, chunk_size)
+    
+    try:
+        file_info = register_file(transfer_id, transfer['volume'], data['file_id'], int(data['file_index']),
+                                  data['file_name'], file_size, -(-file_size // chunk_size), chunk_size)
+    except ReservationExceeded:
+        return jsonify({'success': False, 'error': 'Files larger than the transfer'}), 413
+    if file_info is None:
+        return jsonify({'success': False, 'error': 'Invalid transfer ID'}), 400
+    return jsonify({'success': True, 'chunk_size': file_info['chunk_size']})
+
+@app.route('/upload/<transfer_id>/<file_id>/<int:chunk_index>', methods=['PUT'])
+def put_chunk(transfer_id, file_id, chunk_index):
+    """Raw chunk upload: the request body is streamed straight to the file"""
+    with metrics.stage('lookup', LOOKUP_TIME):
+        transfer = get_transfer(transfer_id)
+        file_info = registry.get_file(transfer_id, file_id) if transfer is not None else None
+    if transfer is None:
+        return jsonify({'success': False, 'error': 'Invalid transfer ID'}), 400
+    if file_info is None:
+        return jsonify({'success': False, 'error': 'Unknown file ID'}), 404
+    
+    stream = request_body()
+    if stream is None:
+        return jsonify({'success': False, 'error': 'Unsupported Content-Encoding'}), 415
+    try:
+        error = receive_chunk(transfer_id, file_id, file_info, *indexed_chunk(file_info, chunk_index), stream)
+    except zlib.error:
+        error = 'Invalid compressed data'
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
     
     return jsonify({'success': True})
 
+@app.route('/upload/<transfer_id>/<file_id>', methods=['PATCH'])
+def patch_chunk(transfer_id, file_id):
+    """Chunk upload by byte offset, tus style: the body goes at Upload-Offset.
+
+    Chunks can be any size up to MAX_CHUNK_SIZE, so clients can size them to
+    their link; see receive_chunk for how they have to line up. A compressed
+    chunk (Content-Encoding gzip or deflate) gives its decoded length in
+    Upload-Chunk-Length and is decompressed on the way to disk.
+    """
+    with metrics.stage('lookup', LOOKUP_TIME):
+        transfer = get_transfer(transfer_id)
+        file_info = registry.get_file(transfer_id, file_id) if transfer is not None else None
+    if transfer is None:
+        return jsonify({'success': False, 'error': 'Invalid transfer ID'}), 400
+    if file_info is None:
+        return jsonify({'success': False, 'error': 'Unknown file ID'}), 404
+    
+    stream = request_body()
+    if stream is None:
+        return jsonify({'success': False, 'error': 'Unsupported Content-Encoding'}), 415
+    if stream is request.stream:
+        length = request.content_length
+    else:
+        length = request.headers.get('Upload-Chunk-Length', type=int)
+    if length is None:
+        return jsonify({'success': False, 'error': 'Chunk length required'}), 411
+    if length > max(app.config['MAX_CHUNK_SIZE'], file_info['chunk_size']):
+        return jsonify({'success': False, 'error': 'Chunk too large'}), 413
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return jsonify({'success': False, 'error': 'Invalid Upload-Offset'}), 400
+    
+    try:
+        error = receive_chunk(transfer_id, file_id, file_info, offset, length, stream)
+    except zlib.error:
+        error = 'Invalid compressed data'
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    
+    return jsonify({'success': True})
+
+@app.route('/upload/<transfer_id>/<file_id>')
+def upload_status(transfer_id, file_id):
+    """Report which chunks of a file are still missing so uploads can resume.
+
+    HEAD answers with tus-style Upload-Offset/Upload-Length headers, where
+    Upload-Offset is the number of bytes received without a gap from the start.
+    """
+    if get_transfer(transfer_id) is None:
+        return jsonify({'success': False, 'error': 'Invalid transfer ID'}), 404
+    
+    file_info = registry.get_file(transfer_id, file_id)
+    if file_info is None:
+        return jsonify({'success': False, 'error': 'Unknown file ID'}), 404
+    missing = missing_ranges(file_info['received'], file_info['total_chunks'])
+    
+    contiguous = missing[0][0] * file_info['chunk_size'] if missing else file_info['file_size']
+    headers = {
+        'Tus-Resumable': '1.0.0',
+        'Upload-Offset': str(min(contiguous, file_info['file_size'])),
+        'Upload-Length': str(file_info['file_size']),
+        'Cache-Control': 'no-store'
+    }
+    if request.method == 'HEAD':
+        return '', 200, headers
+    
+    return jsonify({
+        'success': True,
+        'file_size': file_info['file_size'],
+        'chunk_size': file_info['chunk_size'],
+        'total_chunks': file_info['total_chunks'],
+        'received_chunks': file_info['received_chunks'],
+        'missing': missing,
+        'complete': file_info['complete']
+    }), 200, headers
+
 @app.route('/transfer/<transfer_id>')
 def check_transfer(transfer_id):
-    with transfer_lock:
-        exists = transfer_id in transfers and not transfers[transfer_id]['downloaded']
+    transfer = get_transfer(transfer_id)
+    exists = transfer is not None and not transfer['downloaded']
     return jsonify({'exists': exists})
 
 @app.route('/transfer/<transfer_id>/files')
 def transfer_files(transfer_id):
-    with transfer_lock:
-        if transfer_id in transfers:
-            transfer = transfers[transfer_id]
-            return jsonify({
-                'success': True,
-                'files': [{
-                    'filename': f['filename'],
-                    'filesize': f['filesize']
-                } for f in transfer['files']],
-                'total_size': transfer['total_size']
-            })
+    transfer = get_transfer(transfer_id)
+    if transfer is not None:
+        return jsonify({
+            'success': True,
+            'files': [{
+                'index': f['file_index'],
+                'filename': f['filename'],
+                'filesize': f['filesize']
+            } for f in registry.files(transfer_id)],
+            'total_size': transfer['total_size']
+        })
     return jsonify({'success': False, 'error': 'Transfer not found'}), 404
 
+@app.route('/transfer/<transfer_id>/file/<int:file_index>')
+def download_file(transfer_id, file_index):
+    """Serve one received file with Range, If-Range and ETag support, so
+    interrupted downloads can resume.
+
+    Files can be fetched one by one until the transfer has been claimed
+    through download_all; from then on they are gone, like the archive.
+    """
+    transfer = get_transfer(transfer_id)
+    if transfer is None:
+        return "Transfer not found", 404
+    if transfer['downloaded']:
+        return "Files already downloaded", 410  # Gone
+    
+    file = next((f for f in registry.files(transfer_id) if f['file_index'] == file_index), None)
+    if file is None:
+        return "File not found", 404
+    try:
+        response = send_stored(file['filepath'], file['filename'])
+    except FileNotFoundError:
+        return "File not found", 404
+    # Counted when handed to the server; Range and 304 responses are smaller
+    BYTES_SERVED.labels('file').inc(response.content_length or 0)
+    return response
+
 @app.route('/download_all/<transfer_id>')
 def download_all(transfer_id):
-    with transfer_lock:
-        if transfer_id not in transfers:
-            return "Transfer not found", 404
-            
-        transfer = transfers[transfer_id]
-        
-        if transfer['downloaded']:
+    with metrics.stage('lookup'):
+        transfer = get_transfer(transfer_id)
+    if transfer is None:
+        return "Transfer not found", 404
+    
+    # Serve the archive built in the background if it is ready
+    if transfer['archive_path'] is not None:
+        if not claim_download(transfer_id):
+            return "Files already downloaded", 410  # Gone
+        response = send_stored(transfer['archive_path'], f'transfer_{transfer_id}.zip', 'application/zip')
+        BYTES_SERVED.labels('download_all').inc(response.content_length or 0)
+        return response
+    
+    # Building the archive takes a slot until the response is closed. It is
+    # taken before the transfer is claimed, so a receiver turned away with a
+    # 503 can still download it later.
+    with metrics.stage('queue'):
+        archive_builds.acquire()
+    try:
+        if not claim_download(transfer_id):
+            archive_builds.release()
             return "Files already downloaded", 410  # Gone
         
-        # Create in-memory zip file
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for file in transfer['files']:
-                # Only add files that actually exist
-                if os.path.exists(file['filepath']):
-                    zf.write(file['filepath'], arcname=file['filename'])
-                else:
-                    print(f"File not found: {file['filepath']}")
-        
-        # Prepare response
-        memory_file.seek(0)
-        response = make_response(memory_file.getvalue())
-        response.headers['Content-Type'] = 'application/zip'
-        response.headers['Content-Disposition'] = f'attachment; filename="transfer_{transfer_id}.zip"'
-        
-        # Mark as downloaded
-        transfer['downloaded'] = True
-        
+        # Stream the zip file straight to the client
+        with metrics.stage('files'):
+            files = registry.files(transfer_id)
+        members = [(storage.source(file['filepath']), file['filename']) for file in files]
+        archive = stream_zip(members, app.config['ZIP_COMPRESSION'], app.config['ZIP_COMPRESSION_LEVEL'],
+                             compression_pool, window=2 * app.config['ZIP_COMPRESSION_WORKERS'] + 2)
+        archive = measure_archive(archive, sum(file['filesize'] for file in files), g.timer)
+        response = Response(archive, mimetype='application/zip')
+    except BaseException:
+        archive_builds.release()
+        raise
+    response.call_on_close(archive_builds.release)
+    response.headers['Content-Disposition'] = f'attachment; filename="transfer_{transfer_id}.zip"'
+    return response
+
+def send_stored(location, download_name, mimetype=None):
+    """Send a stored file as an attachment with Range, If-Range and ETag support.
+
+    Files on local disk go through send_file, which hands the open file to
+    wsgi.file_wrapper so servers like gunicorn can use sendfile(). Other
+    files are read from storage from the start of the requested range.
+    Raises FileNotFoundError if the file is gone.
+    """
+    path = storage.local_path(location)
+    if path is not None:
+        return send_file(path, mimetype=mimetype, as_attachment=True, download_name=download_name,
+                         conditional=True, etag=True, max_age=0)
+    
+    st = storage.stat(location)
+    reader = storage.open(location)
+    response = send_file(reader, mimetype=mimetype, as_attachment=True, download_name=download_name,
+                         conditional=False, etag=st.etag or False, last_modified=st.st_mtime, max_age=0)
+    # The server's file wrapper can't seek, so the reader is the body itself
+    response.response = reader
+    response.content_length = st.st_size
+    return response.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+
+def claim_download(transfer_id):
+    """Mark the transfer as downloaded; only one receiver gets the files"""
+    with metrics.stage('claim'):
+        return registry.mark_downloaded(transfer_id)
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    """Turn a request away quickly, telling the client when to try again.
+
+    download_all is opened by the browser as a page rather than fetched by
+    the upload client, so it gets a page that reloads itself.
+    """
+    REJECTED.labels(e.limiter.name).inc()
+    retry = app.config['OVERLOAD_RETRY_AFTER']
+    if request.endpoint == 'download_all':
+        response = Response(f'<!DOCTYPE html><meta http-equiv="refresh" content="{retry}">'
+                            f'<p>The server is busy, retrying in {retry} seconds...</p>', 503, mimetype='text/html')
+    else:
+        response = jsonify({'success': False, 'error': 'Server busy', 'retry_after': retry})
+        response.status_code = 503
+    response.headers['Retry-After'] = str(retry)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of this worker process's metrics"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.before_request
+def start_background_tasks():
+    expiry.start()
+
+@app.before_request
+def start_timer():
+    g.timer = metrics.StageTimer()
+    g.timer.activate()
+
+@app.after_request
+def report_timing(response):
+    """Add the Server-Timing header and watch for slow requests.
+
+    The slow-request check runs once the response has been sent, so
+    streamed downloads are judged by their full duration.
+    """
+    timer = g.get('timer')
+    if timer is None:
         return response
+    if app.config['SERVER_TIMING'] and timer.stages:
+        response.headers['Server-Timing'] = timer.server_timing()
+    threshold = app.config['SLOW_REQUEST_THRESHOLD']
+    if threshold > 0:
+        description = f'{request.method} {request.path} {response.status_code}'
+        response.call_on_close(lambda: log_slow_request(timer, description, threshold))
+    return response
+
+@app.teardown_request
+def stop_timer(exc):
+    timer = g.get('timer')
+    if timer is not None:
+        timer.deactivate()
+
+def log_slow_request(timer, description, threshold):
+    elapsed = timer.elapsed()
+    if elapsed >= threshold and random.random() < app.config['SLOW_REQUEST_SAMPLE_RATE']:
+        print(f"Slow request: {description} took {elapsed * 1000:.1f}ms {timer.summary()}")
 
 def cleanup_transfer(transfer_id):
-    """Clean up the transfer after 1 hour"""
-    time.sleep(3600)  # Wait for 1 hour
-    
-    with transfer_lock:
-        if transfer_id in transfers:
-            # Delete all files
-            transfer_dir = os.path.join(UPLOAD_FOLDER, transfer_id)
-            if os.path.exists(transfer_dir):
-                shutil.rmtree(transfer_dir)
-            
-            # Remove the transfer record
-            del transfers[transfer_id]
+    """Delete an expired transfer and its files"""
+    # Remove the transfer record
+    transfer = registry.get(transfer_id)
+    if transfer is not None and registry.delete(transfer_id):
+        # Delete all files
+        storage.delete_transfer(transfer_id, transfer['volume'])
+
+def reclaim_orphans():
+    """Delete stored transfers that no transfer in the registry owns.
+
+    Run in the background at startup, at the same pace as expirations, to
+    pick up what a crash or a registry without persistence left behind.
+    """
+    deleted = 0
+    for transfer_id, volume, mtime in storage.transfers():
+        if registry.get(transfer_id) is not None:
+            continue
+        # create_transfer makes the directory just before registering it
+        if mtime > time.time() - 60:
+            continue
+        print(f"Reclaiming orphaned transfer {transfer_id}")
+        storage.delete_transfer(transfer_id, volume)
+        deleted += 1
+        if deleted % app.config['EXPIRY_BATCH_SIZE'] == 0:
+            time.sleep(app.config['EXPIRY_BATCH_INTERVAL'])
+
+registry = make_registry(app.config['REGISTRY'], app.config['REGISTRY_PATH'])
+storage = make_storage(app.config['STORAGE'], UPLOAD_FOLDERS, app.config['S3_ENDPOINT'], app.config['S3_BUCKET'],
+                       app.config['S3_REGION'], app.config['S3_ACCESS_KEY'], app.config['S3_SECRET_KEY'],
+                       app.config['MEMORY_TIER_BYTES'], app.config['MEMORY_TIER_MAX_TRANSFER'],
+                       app.config['DISK_HEADROOM'], app.config['S3_PREFIX'])
+
+chunk_writes = ConcurrencyLimiter('chunk_write', app.config['CHUNK_WRITE_LIMIT'],
+                                  app.config['CHUNK_WRITE_QUEUE'], app.config['QUEUE_TIMEOUT'])
+archive_builds = ConcurrencyLimiter('archive_build', app.config['ARCHIVE_BUILD_LIMIT'],
+                                    app.config['ARCHIVE_BUILD_QUEUE'], app.config['QUEUE_TIMEOUT'])
+
+# The page and its assets don't change between requests, so render and
+# compress them once
+static_assets = StaticAssets(os.path.join(app.root_path, 'static'))
+with app.app_context():
+    index_page = Asset(render_template_string(HTML_TEMPLATE, asset_url=static_assets.url).encode('utf-8'),
+                       'text/html')
+
+# Shared by every archive download; threads are only started on first use
+compression_pool = None
+if app.config['ZIP_COMPRESSION_WORKERS'] > 1:
+    compression_pool = ThreadPoolExecutor(app.config['ZIP_COMPRESSION_WORKERS'], thread_name_prefix='deflate')
+archive_pool = ThreadPoolExecutor(app.config['ARCHIVE_BUILD_WORKERS'], thread_name_prefix='archive')
+
+# Pick up where the last run left off: expire what the registry still
+# holds, and clean up directories it has no record of
+expiry = ExpiryScheduler(cleanup_transfer, app.config['EXPIRY_BATCH_SIZE'],
+                         app.config['EXPIRY_BATCH_INTERVAL'], registry.expirations)
+expiry.start()
+threading.Thread(target=reclaim_orphans, name='reclaim-orphans', daemon=True).start()
+
+metrics.gauge('file_share_active_transfers', 'Transfers in the registry', registry.count)
+metrics.gauge('file_share_pending_expirations', 'Transfers waiting in the expiry schedule', expiry.pending)
+metrics.gauge('file_share_reserved_bytes', 'Bytes reserved by live transfers',
+              lambda: registry.usage()['reserved'])
+metrics.gauge('file_share_allocated_bytes', 'Bytes allocated on disk for registered files',
+              lambda: registry.usage()['allocated'])
+metrics.gauge('file_share_received_bytes', 'Bytes of registered files received so far',
+              lambda: registry.usage()['received'])
+metrics.gauge('file_share_archive_pending_bytes', 'Bytes set aside for prebuilt archives and not written yet',
+              lambda: registry.usage()['archive_pending'])
+if storage.disk_usage() is not None:
+    metrics.gauge('file_share_disk_used_bytes', 'Used space on the upload filesystems',
+                  lambda: storage.disk_usage().used)
+    metrics.gauge('file_share_disk_free_bytes', 'Free space on the upload filesystems',
+                  lambda: storage.disk_usage().free)
+if app.config['MEMORY_TIER_BYTES'] > 0:
+    metrics.gauge('file_share_memory_tier_bytes', 'Bytes reserved by transfers kept in memory',
+                  lambda: storage.used)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
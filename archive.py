@@ -0,0 +1,369 @@
+import os
+import struct
+from collections import deque
+import time
+import zlib
+import zipfile
+
+# Size of the pieces read from disk while streaming a member
+READ_SIZE = 1024 * 1024  # 1MB
+
+# Large members are cut into blocks of this size and deflated in parallel
+BLOCK_SIZE = 1024 * 1024  # 1MB
+
+# Each block is primed with the end of the previous one, as pigz does
+DICTIONARY_SIZE = 32 * 1024
+
+# An empty final deflate block, which ends a stream of sync-flushed blocks
+DEFLATE_END = b'\x03\x00'
+
+# Members are sampled this far to decide whether deflate is worth it
+SAMPLE_SIZE = 64 * 1024  # 64KB
+
+# Deflate must shrink the sample below this fraction of its size to be used
+MIN_DEFLATE_RATIO = 0.9
+
+# Formats that are already compressed, stored as-is without sampling
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.br', '.lz4',
+    '.docx', '.xlsx', '.pptx', '.odt', '.epub', '.jar', '.apk', '.whl'
+}
+
+ZIP64_LIMIT = (1 << 32) - 1
+ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
+
+# General purpose flags: sizes/CRC follow the data, file name is UTF-8
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+DATA_DESCRIPTOR = struct.Struct('<4sL2L')
+DATA_DESCRIPTOR64 = struct.Struct('<4sL2Q')
+END_RECORD = struct.Struct('<4s4H2LH')
+END_RECORD64 = struct.Struct('<4sQ2H2L4Q')
+END_LOCATOR64 = struct.Struct('<4sLQL')
+
+
+def dos_datetime(timestamp):
+    """Convert a unix timestamp to the (date, time) pair stored in ZIP headers"""
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return (1 << 5) | 1, 0
+    date = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dostime = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return date, dostime
+
+
+def _is_path(source):
+    return isinstance(source, (str, os.PathLike))
+
+
+def open_source(source):
+    """Open a member's file for reading, whether given as a path or not.
+
+    Other sources provide a ``name``, stat() (returning ``st_size`` and
+    ``st_mtime`` like os.stat) and open(); stored objects are one.
+    """
+    return open(source, 'rb') if _is_path(source) else source.open()
+
+
+def stat_source(source):
+    """stat() a member; raises FileNotFoundError if it doesn't exist"""
+    return os.stat(source) if _is_path(source) else source.stat()
+
+
+def choose_method(source, policy='auto', sample_size=SAMPLE_SIZE):
+    """Pick the compression method for a member under ``policy``.
+
+    'deflate' and 'store' always use that method. 'auto' stores files whose
+    extension marks them as already compressed, and otherwise deflates a
+    sample from the start of the file at level 1 and stores the file if the
+    sample doesn't shrink enough to pay for the CPU time.
+    """
+    if policy == 'deflate':
+        return zipfile.ZIP_DEFLATED
+    if policy == 'store':
+        return zipfile.ZIP_STORED
+    name = source if _is_path(source) else source.name
+    if os.path.splitext(name)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    with open_source(source) as f:
+        sample = f.read(sample_size)
+    if not sample:
+        return zipfile.ZIP_STORED
+    if len(zlib.compress(sample, 1)) > len(sample) * MIN_DEFLATE_RATIO:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+class ZipStream:
+    """Build a ZIP archive as a sequence of byte strings.
+
+    Members are written with data descriptors, so nothing has to be known
+    about a member before its data has been produced and the output never
+    needs to be seeked or held in memory. Members that may exceed 4 GB get
+    Zip64 headers.
+    """
+
+    def __init__(self, compression=zipfile.ZIP_DEFLATED, compresslevel=6):
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.offset = 0
+        self.entries = []
+        self._member = None
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def write_file(self, source, arcname, method=None, read_size=READ_SIZE):
+        """Yield the local header, data and descriptor for the file at ``source``"""
+        st = stat_source(source)
+        with open_source(source) as f:
+            pieces = iter(lambda: f.read(read_size), b'')
+            yield from self.write_iter(pieces, arcname, st.st_size, st.st_mtime, method)
+
+    def write_iter(self, pieces, arcname, size_hint=0, mtime=None, method=None):
+        """Yield a member whose uncompressed data comes from ``pieces``.
+
+        ``method`` overrides the archive's default compression for this member.
+        """
+        if method is None:
+            method = self.compression
+        yield self.start_member(arcname, size_hint, mtime, method)
+
+        crc = 0
+        file_size = 0
+        compressor = None
+        if method == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+
+        for data in pieces:
+            crc = zlib.crc32(data, crc)
+            file_size += len(data)
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                yield self.member_data(data)
+        if compressor is not None:
+            yield self.member_data(compressor.flush())
+
+        yield self.end_member(crc, file_size)
+
+    def start_member(self, arcname, size_hint=0, mtime=None, method=None):
+        """Return the local header that opens a new member.
+
+        The member's (already compressed) data is then passed through
+        member_data() and closed with end_member().
+        """
+        if method is None:
+            method = self.compression
+        zip64 = size_hint * 1.05 > ZIP64_LIMIT
+        name = arcname.encode('utf-8')
+        date, dostime = dos_datetime(time.time() if mtime is None else mtime)
+        version = 45 if zip64 else 20
+        flags = FLAG_DATA_DESCRIPTOR | FLAG_UTF8
+
+        self._member = {
+            'name': arcname,
+            'version': version,
+            'flags': flags,
+            'method': method,
+            'date': date,
+            'time': dostime,
+            'crc': 0,
+            'compress_size': 0,
+            'file_size': 0,
+            'header_offset': self.offset,
+            'zip64': zip64
+        }
+        extra = struct.pack('<2H2Q', 1, 16, 0, 0) if zip64 else b''
+        size_field = 0xFFFFFFFF if zip64 else 0
+        return self._emit(LOCAL_HEADER.pack(
+            b'PK\x03\x04', version, 0, flags, method, dostime, date,
+            0, size_field, size_field, len(name), len(extra)) + name + extra)
+
+    def member_data(self, data):
+        self._member['compress_size'] += len(data)
+        return self._emit(data)
+
+    def end_member(self, crc, file_size):
+        """Return the data descriptor that closes the current member"""
+        entry = self._member
+        self._member = None
+        entry['crc'] = crc
+        entry['file_size'] = file_size
+        compress_size = entry['compress_size']
+
+        if entry.pop('zip64'):
+            descriptor = DATA_DESCRIPTOR64.pack(b'PK\x07\x08', crc, compress_size, file_size)
+        elif max(file_size, compress_size) > ZIP64_LIMIT:
+            raise zipfile.LargeZipFile(f"{entry['name']} grew past the Zip64 limit")
+        else:
+            descriptor = DATA_DESCRIPTOR.pack(b'PK\x07\x08', crc, compress_size, file_size)
+        self.entries.append(entry)
+        return self._emit(descriptor)
+
+    def append_segment(self, entry, size):
+        """Account for a member that was written as a separate segment.
+
+        ``entry`` is the segment's own entry from a ZipStream that started at
+        offset 0 and ``size`` its length; the caller copies the segment's bytes
+        to the output at the current offset.
+        """
+        self.entries.append(dict(entry, header_offset=self.offset))
+        self.offset += size
+
+    def _central_header(self, entry):
+        name = entry['name'].encode('utf-8')
+        extra_fields = []
+        file_size = entry['file_size']
+        compress_size = entry['compress_size']
+        header_offset = entry['header_offset']
+        if file_size >= ZIP64_LIMIT:
+            extra_fields.append(file_size)
+            file_size = 0xFFFFFFFF
+        if compress_size >= ZIP64_LIMIT:
+            extra_fields.append(compress_size)
+            compress_size = 0xFFFFFFFF
+        if header_offset >= ZIP64_LIMIT:
+            extra_fields.append(header_offset)
+            header_offset = 0xFFFFFFFF
+
+        extra = b''
+        version = entry['version']
+        if extra_fields:
+            extra = struct.pack(f'<2H{len(extra_fields)}Q', 1, 8 * len(extra_fields), *extra_fields)
+            version = 45
+
+        return CENTRAL_HEADER.pack(
+            b'PK\x01\x02', version, 3, version, 0, entry['flags'], entry['method'],
+            entry['time'], entry['date'], entry['crc'], compress_size, file_size,
+            len(name), len(extra), 0, 0, 0,
+            0o100644 << 16, header_offset) + name + extra
+
+    def finish(self):
+        """Yield the central directory and end records"""
+        cd_offset = self.offset
+        for entry in self.entries:
+            yield self._emit(self._central_header(entry))
+        cd_size = self.offset - cd_offset
+        count = len(self.entries)
+
+        if count >= ZIP_FILECOUNT_LIMIT or cd_offset > ZIP64_LIMIT or cd_size > ZIP64_LIMIT:
+            end64_offset = self.offset
+            yield self._emit(END_RECORD64.pack(
+                b'PK\x06\x06', END_RECORD64.size - 12, 45, 45, 0, 0,
+                count, count, cd_size, cd_offset))
+            yield self._emit(END_LOCATOR64.pack(b'PK\x06\x07', 0, end64_offset, 1))
+            count = min(count, ZIP_FILECOUNT_LIMIT)
+            cd_size = min(cd_size, ZIP64_LIMIT)
+            cd_offset = min(cd_offset, ZIP64_LIMIT)
+
+        yield self._emit(END_RECORD.pack(
+            b'PK\x05\x06', 0, 0, count, count, cd_size, cd_offset, 0))
+
+
+def deflate_block(data, level, zdict=b''):
+    """Deflate one block so that it can be concatenated with its neighbours.
+
+    The block is sync-flushed rather than finished, so it ends on a byte
+    boundary without the final-block bit; DEFLATE_END closes the stream.
+    """
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _member_parts(members, policy, compresslevel, executor, block_size):
+    """Break members into the parts of the archive, in order.
+
+    Yields ('start', args) before each member, ('data', bytes) or
+    ('block', future) for its contents and ('end', (crc, size)) after it.
+    Deflated blocks are submitted to ``executor`` as they are read.
+    """
+    for source, arcname in members:
+        # Only add files that actually exist
+        try:
+            st = stat_source(source)
+        except FileNotFoundError:
+            print(f"File not found: {source}")
+            continue
+        method = choose_method(source, policy)
+        yield 'start', (arcname, st.st_size, st.st_mtime, method)
+
+        crc = 0
+        file_size = 0
+        zdict = b''
+        with open_source(source) as f:
+            for data in iter(lambda: f.read(block_size), b''):
+                crc = zlib.crc32(data, crc)
+                file_size += len(data)
+                if method == zipfile.ZIP_DEFLATED:
+                    yield 'block', executor.submit(deflate_block, data, compresslevel, zdict)
+                    zdict = data[-DICTIONARY_SIZE:]
+                else:
+                    yield 'data', data
+        if method == zipfile.ZIP_DEFLATED:
+            yield 'data', DEFLATE_END
+        yield 'end', (crc, file_size)
+
+
+def zip_members(zs, members, policy='auto', compresslevel=6, executor=None,
+                block_size=BLOCK_SIZE, window=8):
+    """Yield the parts of ``zs`` holding ``members``, a list of (source, arcname) pairs.
+
+    A source is a path or an object as described in open_source(). Each
+    member's compression method is picked by choose_method(). With an
+    ``executor``, members are cut into blocks that are deflated in parallel
+    while at most ``window`` parts are buffered, and the results are
+    stitched back together in order. The central directory is left to
+    zs.finish().
+    """
+    if executor is None:
+        for source, arcname in members:
+            # Only add files that actually exist
+            try:
+                stat_source(source)
+            except FileNotFoundError:
+                print(f"File not found: {source}")
+                continue
+            yield from zs.write_file(source, arcname, choose_method(source, policy))
+        return
+
+    def emit(kind, value):
+        if kind == 'start':
+            return zs.start_member(*value)
+        if kind == 'end':
+            return zs.end_member(*value)
+        if kind == 'block':
+            value = value.result()
+        return zs.member_data(value)
+
+    pending = deque()
+    try:
+        for part in _member_parts(members, policy, compresslevel, executor, block_size):
+            pending.append(part)
+            if len(pending) >= window:
+                yield emit(*pending.popleft())
+        while pending:
+            yield emit(*pending.popleft())
+    finally:
+        # The client went away; don't leave queued blocks behind
+        for kind, value in pending:
+            if kind == 'block':
+                value.cancel()
+
+
+def stream_zip(members, policy='auto', compresslevel=6, executor=None,
+               block_size=BLOCK_SIZE, window=8):
+    """Yield a complete ZIP archive of ``members``; see zip_members()"""
+    zs = ZipStream(zipfile.ZIP_DEFLATED, compresslevel)
+    yield from zip_members(zs, members, policy, compresslevel, executor, block_size, window)
+    yield from zs.finish()
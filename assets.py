@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Encodings in the order we prefer them when the client accepts several equally
+ENCODINGS = ('br', 'gzip')
+
+
+class Asset:
+    """A response body built once, with precompressed variants.
+
+    Each variant has its own strong ETag, since the bytes differ; variants
+    that don't come out smaller than the original are dropped.
+    """
+
+    def __init__(self, body, mimetype):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(body).hexdigest()
+        self.variants = {'identity': body}
+        compressed = {'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(body, quality=11)
+        for encoding, data in compressed.items():
+            if len(data) < len(body):
+                self.variants[encoding] = data
+
+    def encodings(self):
+        return [encoding for encoding in ENCODINGS if encoding in self.variants]
+
+    def etag(self, encoding):
+        return self.digest if encoding == 'identity' else f'{self.digest}-{encoding}'
+
+
+class StaticAssets:
+    """The files of a directory, served under names that include their hash.
+
+    A file's URL changes whenever its content does, so responses can be
+    cached forever by browsers and proxies alike.
+    """
+
+    def __init__(self, folder, prefix='/static/'):
+        self.prefix = prefix
+        self.names = {}
+        self.assets = {}
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                asset = Asset(f.read(), mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            root, ext = os.path.splitext(name)
+            hashed = f'{root}.{asset.digest[:12]}{ext}'
+            self.names[name] = hashed
+            self.assets[hashed] = asset
+
+    def url(self, name):
+        return self.prefix + self.names[name]
+
+    def get(self, hashed):
+        return self.assets.get(hashed)
+
+
+def serve_asset(request, response_class, asset, cache_control):
+    """Respond with the variant of ``asset`` the client accepts best.
+
+    Handles If-None-Match, answering 304 when the client's copy is current.
+    """
+    encoding = request.accept_encodings.best_match(asset.encodings(), default='identity')
+    response = response_class(asset.variants[encoding], mimetype=asset.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(asset.etag(encoding))
+    return response.make_conditional(request)
@@ -0,0 +1,90 @@
+"""Archive throughput and size for each compression policy.
+
+Builds a corpus of compressible text and incompressible random data (the
+latter standing in for video, images and archives), streams it through
+stream_zip under every policy and reports MB/s and the compression ratio.
+--workers compares inline compression (1) with the parallel block deflater.
+
+    python benchmarks/bench_archive.py --size-mb 64 --levels 1 6 --workers 1 4
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from archive import stream_zip
+
+POLICIES = ['deflate', 'auto', 'store']
+
+
+def make_corpus(directory, size, text_fraction):
+    """Write one compressible and one incompressible file totalling ``size`` bytes"""
+    text_size = int(size * text_fraction)
+    line = b'2024-01-01T00:00:00Z INFO request handled path=/upload_chunk status=200 bytes=5242880\n'
+    members = []
+
+    path = os.path.join(directory, 'server.log')
+    with open(path, 'wb') as f:
+        f.write((line * (text_size // len(line) + 1))[:text_size])
+    members.append((path, 'server.log'))
+
+    path = os.path.join(directory, 'video.bin')
+    with open(path, 'wb') as f:
+        remaining = size - text_size
+        while remaining > 0:
+            n = min(remaining, 1024 * 1024)
+            f.write(os.urandom(n))
+            remaining -= n
+    members.append((path, 'video.bin'))
+    return members
+
+
+def run(members, policy, level, workers):
+    total = sum(os.path.getsize(path) for path, _ in members)
+    executor = ThreadPoolExecutor(workers) if workers > 1 else None
+    start = time.perf_counter()
+    archive = stream_zip(members, policy, level, executor, window=2 * workers + 2)
+    archive_size = sum(len(piece) for piece in archive)
+    elapsed = time.perf_counter() - start
+    if executor is not None:
+        executor.shutdown()
+    return {
+        'policy': policy,
+        'level': level,
+        'workers': workers,
+        'seconds': round(elapsed, 3),
+        'mb_per_sec': round(total / elapsed / 1024 / 1024, 1),
+        'ratio': round(archive_size / total, 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=64, help='corpus size')
+    parser.add_argument('--text-fraction', type=float, default=0.2,
+                        help='share of the corpus that is compressible')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 6])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        members = make_corpus(tmp, args.size_mb * 1024 * 1024, args.text_fraction)
+        results = [run(members, policy, level, workers)
+                   for policy in POLICIES for level in args.levels for workers in args.workers]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'policy':>8} {'level':>5} {'workers':>7} {'seconds':>8} {'MB/s':>7} {'ratio':>6}")
+    for r in results:
+        print(f"{r['policy']:>8} {r['level']:>5} {r['workers']:>7} {r['seconds']:>8} {r['mb_per_sec']:>7} {r['ratio']:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Chunk upload throughput and latency while transfers compete.
+
+Starts the app under gunicorn in a temporary directory, one worker with
+many threads by default, so the load generator in this process doesn't
+share a GIL with the server. Load shedding is turned off for the run, so
+what is measured is locking rather than 503s. Two measurements:
+
+* throughput: N transfers upload at once, one sender thread each. If they
+  don't contend, chunks/s grows with N until the disk or the CPU is
+  saturated.
+* contention: small transfers upload one-chunk files, first on their own
+  and then while one large transfer is sent in big chunks and completes
+  (archives are prebuilt, so completing it also compresses it). If the
+  large transfer holds nothing the small ones need, their chunk latency
+  stays close to the idle baseline.
+
+--global-lock serialises every chunk upload in the server behind one lock,
+the way upload_chunk used to, for comparison.
+
+    python benchmarks/bench_contention.py --transfers 1 2 4 8 16
+    python benchmarks/bench_contention.py --global-lock --large-size 1G
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.join(BENCHMARKS, '..')
+sys.path.insert(0, REPO)
+
+from bench_load import multipart, parse_size, percentile, request, start_gunicorn
+
+
+def serialised_app():
+    """The app with every chunk upload behind one lock; gunicorn loads this for --global-lock"""
+    import app as file_share
+    lock = threading.Lock()
+    view = file_share.app.view_functions['upload_chunk']
+
+    def locked_upload_chunk():
+        with lock:
+            return view()
+
+    file_share.app.view_functions['upload_chunk'] = locked_upload_chunk
+    return file_share.app
+
+
+def send_transfer(port, chunks, chunk_size, payload, latencies=None):
+    """Upload one file of ``chunks`` chunks, appending each chunk's latency to ``latencies``"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    body = json.dumps({'file_count': 1, 'total_size': chunks * chunk_size})
+    created = json.loads(request(conn, 'POST', '/create_transfer', body, {'Content-Type': 'application/json'}))
+    fields = {
+        'transfer_id': created['transfer_id'],
+        'file_id': str(uuid.uuid4()),
+        'file_index': 0,
+        'total_chunks': chunks,
+        'file_name': 'bench.bin',
+        'file_size': chunks * chunk_size,
+        'chunk_size': chunk_size
+    }
+    for chunk_index in range(chunks):
+        fields['chunk_index'] = chunk_index
+        body, content_type = multipart(fields, payload)
+        start = time.perf_counter()
+        request(conn, 'POST', '/upload_chunk', body, {'Content-Type': content_type})
+        if latencies is not None:
+            latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def throughput(port, transfers, chunks, chunk_size):
+    payload = os.urandom(chunk_size)
+    threads = [threading.Thread(target=send_transfer, args=(port, chunks, chunk_size, payload))
+               for _ in range(transfers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    total = transfers * chunks
+    return {
+        'transfers': transfers,
+        'chunks': total,
+        'seconds': round(elapsed, 3),
+        'chunks_per_sec': round(total / elapsed, 1),
+        'mb_per_sec': round(total * chunk_size / elapsed / 1024 / 1024, 1)
+    }
+
+
+def small_latency(port, senders, small_size, until):
+    """Send one-chunk transfers from ``senders`` threads until ``until()``; returns chunk latencies"""
+    payload = os.urandom(small_size)
+    latencies = []
+
+    def sender():
+        while not until():
+            send_transfer(port, 1, small_size, payload, latencies)
+
+    threads = [threading.Thread(target=sender) for _ in range(senders)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {
+        'chunks': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(max(latencies) * 1000, 2)
+    }
+
+
+def contention(port, args):
+    deadline = time.monotonic() + args.baseline_seconds
+    idle = small_latency(port, args.small_senders, args.small_size, lambda: time.monotonic() > deadline)
+
+    done = threading.Event()
+
+    def large():
+        chunks = -(-args.large_size // args.large_chunk_size)
+        send_transfer(port, chunks, args.large_chunk_size, os.urandom(args.large_chunk_size))
+        done.set()
+
+    sender = threading.Thread(target=large)
+    start = time.perf_counter()
+    sender.start()
+    busy = small_latency(port, args.small_senders, args.small_size, done.is_set)
+    sender.join()
+    return {'idle': idle, 'during_large': busy, 'large_seconds': round(time.perf_counter() - start, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--transfers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--chunks', type=int, default=32, help='chunks per transfer')
+    parser.add_argument('--chunk-size', type=parse_size, default=1024 * 1024)
+    parser.add_argument('--small-senders', type=int, default=4)
+    parser.add_argument('--small-size', type=parse_size, default=64 * 1024, help='size of each small transfer')
+    parser.add_argument('--large-size', type=parse_size, default=512 * 1024 * 1024)
+    parser.add_argument('--large-chunk-size', type=parse_size, default=16 * 1024 * 1024)
+    parser.add_argument('--baseline-seconds', type=float, default=5, help='how long to measure idle latency')
+    parser.add_argument('--gunicorn', metavar='OPTIONS', default='-w 1 --threads 32',
+                        help='gunicorn options; one worker keeps --global-lock meaningful')
+    parser.add_argument('--global-lock', action='store_true', help='serialise all chunk uploads')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   UPLOAD_FOLDER=os.path.join(tmp, 'uploads'),
+                   REGISTRY_PATH=os.path.join(tmp, 'registry.db'),
+                   PREBUILD_ARCHIVES='1',
+                   CHUNK_WRITE_LIMIT='1000',
+                   DISK_HEADROOM='0')
+        target = 'bench_contention:serialised_app()' if args.global_lock else 'app:app'
+        server, port = start_gunicorn(args.gunicorn, tmp, target, [BENCHMARKS], env)
+        try:
+            results = {
+                'throughput': [throughput(port, n, args.chunks, args.chunk_size) for n in args.transfers],
+                'contention': contention(port, args)
+            }
+        finally:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'transfers':>9} {'chunks':>7} {'seconds':>8} {'chunks/s':>9} {'MB/s':>7}")
+    for r in results['throughput']:
+        print(f"{r['transfers']:>9} {r['chunks']:>7} {r['seconds']:>8} {r['chunks_per_sec']:>9} {r['mb_per_sec']:>7}")
+    c = results['contention']
+    print(f"\nsmall transfer chunks ({args.small_senders} senders), large transfer took {c['large_seconds']}s")
+    print(f"{'':>13} {'chunks':>7} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for label, key in (('idle', 'idle'), ('during large', 'during_large')):
+        r = c[key]
+        print(f"{label:>13} {r['chunks']:>7} {r['p50_ms']:>8} {r['p99_ms']:>8} {r['max_ms']:>8}")
+
+
+if __name__ == '__main__':
+    main()
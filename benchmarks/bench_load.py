@@ -0,0 +1,426 @@
+"""Load test of the upload and download paths.
+
+N sender threads each run transfers through /create_transfer and
+/upload_chunk (or the PUT endpoint with --upload put), with file sizes drawn
+from a weighted list; once a transfer is complete it is handed to one of M
+receiver threads, which downloads it with /download_all. The server is the
+app on a threaded server in this process, a gunicorn started for the run
+(--gunicorn), or one already running (--url).
+
+Reports throughput, p50/p99 latency per request type, the server's peak RSS
+and its disk reads and writes (from /proc, so Linux only). --output writes
+the results as JSON, along with the commit and the options used, so runs
+can be compared between commits.
+
+    python benchmarks/bench_load.py --senders 8 --receivers 4 --sizes 256K:4 4M:2 32M:1
+    python benchmarks/bench_load.py --gunicorn "-w 4 --threads 8" --output load.json
+"""
+import argparse
+import http.client
+import json
+import os
+import queue
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.upper().rstrip('B')
+    unit = text[-1] if text and text[-1] in UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def parse_sizes(specs):
+    """Turn SIZE[:WEIGHT] specs into (sizes, weights)"""
+    sizes, weights = [], []
+    for spec in specs:
+        size, _, weight = spec.partition(':')
+        sizes.append(parse_size(size))
+        weights.append(float(weight or 1))
+    return sizes, weights
+
+
+def multipart(fields, chunk):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="chunk"; filename="blob"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+    parts.append(chunk)
+    parts.append(f'\r\n--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+# Times a request turned away with 503 and Retry-After is sent again
+MAX_RETRIES = 10
+
+
+def request(conn, method, path, body=None, headers=None, stats=None):
+    """Send a request, waiting out 503s that carry Retry-After as the upload page does"""
+    for attempt in range(MAX_RETRIES + 1):
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        data = response.read()
+        retry_after = response.getheader('Retry-After')
+        if response.status != 503 or retry_after is None or attempt == MAX_RETRIES:
+            break
+        if stats is not None:
+            stats.retry()
+        time.sleep(float(retry_after))
+    if response.status >= 400:
+        raise RuntimeError(f'{method} {path} failed with {response.status}: {data[:200]!r}')
+    return data
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Stats:
+    """Latencies and byte counts, collected from every client thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.bytes = {'uploaded': 0, 'downloaded': 0}
+        self.errors = 0
+        self.retries = 0
+
+    def record(self, kind, seconds, nbytes=0, direction=None):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            if direction:
+                self.bytes[direction] += nbytes
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    def retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def summary(self, elapsed):
+        latency = {}
+        for kind, values in self.latencies.items():
+            latency[kind] = {
+                'count': len(values),
+                'per_sec': round(len(values) / elapsed, 1),
+                'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 2)
+            }
+        return {
+            'seconds': round(elapsed, 3),
+            'errors': self.errors,
+            'retries': self.retries,
+            'upload_mb_per_sec': round(self.bytes['uploaded'] / elapsed / 1024 / 1024, 1),
+            'download_mb_per_sec': round(self.bytes['downloaded'] / elapsed / 1024 / 1024, 1),
+            'latency': latency
+        }
+
+
+class Sampler:
+    """Tracks the peak RSS and disk I/O of a set of processes"""
+
+    def __init__(self, pids):
+        self.pids = pids
+        self.peak_rss = 0
+        self.stop = threading.Event()
+        self.start_io = self.io()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def processes(self):
+        pids = set(self.pids())
+        return [pid for pid in pids if os.path.exists(f'/proc/{pid}')]
+
+    def rss(self):
+        total = 0
+        for pid in self.processes():
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                pass
+        return total
+
+    def io(self):
+        totals = {'read_bytes': 0, 'write_bytes': 0}
+        for pid in self.processes():
+            try:
+                with open(f'/proc/{pid}/io') as f:
+                    for line in f:
+                        key, _, value = line.partition(':')
+                        if key in totals:
+                            totals[key] += int(value)
+            except OSError:
+                pass
+        return totals
+
+    def _run(self):
+        while not self.stop.wait(0.1):
+            self.peak_rss = max(self.peak_rss, self.rss())
+
+    def finish(self):
+        self.stop.set()
+        self.thread.join()
+        self.peak_rss = max(self.peak_rss, self.rss())
+        end_io = self.io()
+        return {
+            'peak_rss_mb': round(self.peak_rss / 1024 / 1024, 1),
+            'disk_read_mb': round((end_io['read_bytes'] - self.start_io['read_bytes']) / 1024 / 1024, 1),
+            'disk_write_mb': round((end_io['write_bytes'] - self.start_io['write_bytes']) / 1024 / 1024, 1)
+        }
+
+
+def timed(stats, kind, conn, method, path, body=None, headers=None, direction=None):
+    start = time.perf_counter()
+    data = request(conn, method, path, body, headers, stats)
+    nbytes = len(body or b'') if direction == 'uploaded' else len(data)
+    stats.record(kind, time.perf_counter() - start, nbytes, direction)
+    return data
+
+
+def send_transfer(conn, stats, args, files, payload):
+    body = json.dumps({'file_count': len(files), 'total_size': sum(files)})
+    created = json.loads(timed(stats, 'create_transfer', conn, 'POST', '/create_transfer', body,
+                               {'Content-Type': 'application/json'}))
+    transfer_id = created['transfer_id']
+    for file_index, file_size in enumerate(files):
+        file_id = str(uuid.uuid4())
+        total_chunks = -(-file_size // args.chunk_size)
+        if args.upload == 'put':
+            body = json.dumps({'file_id': file_id, 'file_index': file_index, 'file_name': f'file{file_index}.bin',
+                               'file_size': file_size, 'chunk_size': args.chunk_size})
+            timed(stats, 'add_file', conn, 'POST', f'/transfer/{transfer_id}/files', body,
+                  {'Content-Type': 'application/json'})
+        for chunk_index in range(total_chunks):
+            chunk = payload[:min(args.chunk_size, file_size - chunk_index * args.chunk_size)]
+            if args.upload == 'put':
+                timed(stats, 'upload_chunk', conn, 'PUT', f'/upload/{transfer_id}/{file_id}/{chunk_index}',
+                      chunk, {'Content-Type': 'application/octet-stream'}, 'uploaded')
+                continue
+            body, content_type = multipart({
+                'transfer_id': transfer_id,
+                'file_id': file_id,
+                'file_index': file_index,
+                'chunk_index': chunk_index,
+                'total_chunks': total_chunks,
+                'file_name': f'file{file_index}.bin',
+                'file_size': file_size,
+                'chunk_size': args.chunk_size
+            }, chunk)
+            start = time.perf_counter()
+            request(conn, 'POST', '/upload_chunk', body, {'Content-Type': content_type}, stats)
+            stats.record('upload_chunk', time.perf_counter() - start, len(chunk), 'uploaded')
+    return transfer_id
+
+
+def sender(host, port, stats, args, transfers, payload, completed):
+    conn = http.client.HTTPConnection(host, port, timeout=300)
+    for files in transfers:
+        try:
+            completed.put(send_transfer(conn, stats, args, files, payload))
+        except (OSError, RuntimeError) as e:
+            print(f'Sender failed: {e}', file=sys.stderr)
+            stats.error()
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=300)
+    conn.close()
+
+
+def receiver(host, port, stats, completed):
+    conn = http.client.HTTPConnection(host, port, timeout=300)
+    while True:
+        transfer_id = completed.get()
+        if transfer_id is None:
+            break
+        try:
+            # Archives may still be assembling in the background; the download
+            # streams one instead, so there is nothing to wait for
+            timed(stats, 'download_all', conn, 'GET', f'/download_all/{transfer_id}', direction='downloaded')
+        except (OSError, RuntimeError) as e:
+            print(f'Receiver failed: {e}', file=sys.stderr)
+            stats.error()
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=300)
+    conn.close()
+
+
+def run(host, port, args, pids):
+    # Draw every file size up front so runs with the same seed send the same files
+    sizes, weights = parse_sizes(args.sizes)
+    rng = random.Random(args.seed)
+    plans = [[rng.choices(sizes, weights, k=args.files_per_transfer) for _ in range(args.transfers_per_sender)]
+             for _ in range(args.senders)]
+    payload = os.urandom(args.chunk_size)
+    stats = Stats()
+    completed = queue.Queue()
+    senders = [threading.Thread(target=sender, args=(host, port, stats, args, plan, payload, completed))
+               for plan in plans]
+    receivers = [threading.Thread(target=receiver, args=(host, port, stats, completed))
+                 for _ in range(args.receivers)]
+
+    sampler = Sampler(pids)
+    start = time.perf_counter()
+    for t in senders + receivers:
+        t.start()
+    for t in senders:
+        t.join()
+    for _ in receivers:
+        completed.put(None)
+    for t in receivers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    results = stats.summary(elapsed)
+    results['server'] = sampler.finish()
+    return results
+
+
+def run_in_process(args):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    # The app keeps its uploads and registry relative to the working directory
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        import app as file_share
+        server = make_server('127.0.0.1', 0, file_share.app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            # RSS and disk I/O include the load generator, which shares the process
+            return run('127.0.0.1', server.server_port, args, lambda: [os.getpid()])
+        finally:
+            server.shutdown()
+            os.chdir(REPO)
+
+
+def children(pid):
+    """pid and all of its descendants"""
+    pids = [pid]
+    for child in pids:
+        try:
+            with open(f'/proc/{child}/task/{child}/children') as f:
+                pids.extend(int(p) for p in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def start_gunicorn(options, tmp, target='app:app', pythonpath=(), env=None):
+    """Start gunicorn with ``options`` on a free port, serving ``target`` from ``tmp``.
+
+    Returns (server, port) once it accepts connections; the caller
+    terminates the server.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    command = [sys.executable, '-m', 'gunicorn', *shlex.split(options), '--bind', f'127.0.0.1:{port}',
+               '--pythonpath', ','.join([os.path.abspath(REPO), *pythonpath]), '--chdir', tmp,
+               '--log-level', 'warning', target]
+    server = subprocess.Popen(command, env=env)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, port
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.terminate()
+                server.wait()
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.2)
+
+
+def run_gunicorn(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        server, port = start_gunicorn(args.gunicorn, tmp)
+        try:
+            return run('127.0.0.1', port, args, lambda: children(server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--receivers', type=int, default=2)
+    parser.add_argument('--transfers-per-sender', type=int, default=4)
+    parser.add_argument('--files-per-transfer', type=int, default=3)
+    parser.add_argument('--sizes', nargs='+', default=['64K:4', '1M:4', '8M:1'],
+                        help='file sizes as SIZE[:WEIGHT], e.g. 256K:4 4M:1')
+    parser.add_argument('--chunk-size', type=parse_size, default=5 * 1024 * 1024)
+    parser.add_argument('--upload', choices=['multipart', 'put'], default='multipart',
+                        help='/upload_chunk or the raw PUT endpoint')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the file size draws')
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--gunicorn', metavar='OPTIONS', help='start gunicorn with these options, e.g. "-w 4"')
+    target.add_argument('--url', help='use a server that is already running; RSS and disk I/O are not measured')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    if args.gunicorn is not None:
+        results = run_gunicorn(args)
+    elif args.url:
+        url = urllib.parse.urlsplit(args.url)
+        results = run(url.hostname, url.port or 80, args, lambda: [])
+        del results['server']
+    else:
+        results = run_in_process(args)
+    results = {'commit': git_commit(), 'options': vars(args), 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    r = results['results']
+    print(f"{r['seconds']}s, {r['errors']} errors, {r['retries']} retries, upload {r['upload_mb_per_sec']} MB/s, "
+          f"download {r['download_mb_per_sec']} MB/s")
+    if 'server' in r:
+        s = r['server']
+        print(f"server peak RSS {s['peak_rss_mb']} MB, disk read {s['disk_read_mb']} MB, "
+              f"write {s['disk_write_mb']} MB")
+    print(f"{'request':>16} {'count':>7} {'per sec':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for kind, l in r['latency'].items():
+        print(f"{kind:>16} {l['count']:>7} {l['per_sec']:>8} {l['p50_ms']:>8} {l['p99_ms']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+
+class Overloaded(Exception):
+    """Raised when a limiter's slots and wait queue are all taken"""
+
+    def __init__(self, limiter):
+        super().__init__(f'{limiter.name} is overloaded')
+        self.limiter = limiter
+
+
+class ConcurrencyLimiter:
+    """Let at most ``limit`` callers in at once, with a bounded wait queue.
+
+    Up to ``queue_size`` more callers wait, for at most ``timeout`` seconds,
+    for a slot to free up; anyone beyond that is turned away straight away.
+    Rejecting early keeps the latency of the admitted requests predictable
+    instead of letting every request slow down together under a burst.
+    """
+
+    def __init__(self, name, limit, queue_size, timeout):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, block=False):
+        """Take a slot; raises Overloaded if none frees up in time.
+
+        With ``block`` the caller waits for as long as it takes, outside the
+        bounded queue, as callers that have been admitted already do.
+        """
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return
+            if block:
+                while self.active >= self.limit:
+                    self._cond.wait()
+                self.active += 1
+                return
+            if self.waiting >= self.queue_size:
+                raise Overloaded(self)
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Overloaded(self)
+                    self._cond.wait(remaining)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+
+    def admit(self):
+        """Wait for a free slot like acquire(), without keeping it"""
+        self.acquire()
+        self.release()
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class GatedReader:
+    """Read a stream, holding a slot of ``limiter`` only while what was read is stored.
+
+    The slot is taken when a read returns data and given back at the next
+    read, so it covers the write of each buffer but not the wait for the
+    next one to arrive: a chunk still crossing the network doesn't keep
+    ready writers away from the disk.
+
+    Whether the stream is let in at all is decided once, up front: creating
+    the reader raises Overloaded like acquire() does, before any of the
+    body has been read, and after that each buffer waits for its slot.
+    """
+
+    def __init__(self, stream, limiter):
+        limiter.admit()
+        self.stream = stream
+        self.limiter = limiter
+        self._held = False
+
+    def read(self, size=-1):
+        self.release()
+        data = self.stream.read(size)
+        if data:
+            self.limiter.acquire(block=True)
+            self._held = True
+        return data
+
+    def release(self):
+        if self._held:
+            self._held = False
+            self.limiter.release()
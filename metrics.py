@@ -0,0 +1,229 @@
+import bisect
+import math
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+# Every metric created through this module, in creation order
+METRICS = []
+
+# Latency buckets in seconds, from 100µs to 1 minute
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Sharded:
+    """Base for metrics whose updates don't take a lock.
+
+    Each thread updates its own cell, found by thread ident; a lock is only
+    taken the first time a thread touches the metric. Idents are reused once
+    a thread exits, so the number of cells stays bounded by the number of
+    live threads. Readers add the cells up.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._cells = {}
+        self._lock = threading.Lock()
+
+    def _cell(self):
+        ident = threading.get_ident()
+        cell = self._cells.get(ident)
+        if cell is None:
+            with self._lock:
+                cell = self._cells.setdefault(ident, [0] * self._size)
+        return cell
+
+    def _totals(self):
+        totals = [0] * self._size
+        for cell in list(self._cells.values()):
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+class _Counter(_Sharded):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        self._cell()[0] += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self._totals()[0]
+
+
+class _Histogram(_Sharded):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One cell per bucket plus +Inf, then the sum
+        super().__init__(len(buckets) + 2)
+
+    def observe(self, value):
+        cell = self._cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def samples(self, name, labels):
+        totals = self._totals()
+        count = 0
+        for bound, value in zip(self.buckets + (math.inf,), totals):
+            count += value
+            le = '+Inf' if bound == math.inf else repr(float(bound))
+            yield name + '_bucket', labels + (('le', le),), count
+        yield name + '_sum', labels, totals[-1]
+        yield name + '_count', labels, count
+
+
+class Metric:
+    """A named metric, optionally split by labels.
+
+    Without label names the metric's own inc()/observe() are used directly;
+    otherwise labels() returns the child for one combination of values.
+    """
+
+    def __init__(self, kind, name, help, labelnames=(), **kwargs):
+        self.kind = kind
+        # A counter's family is named like its sample, as client_python does,
+        # so strict text-format parsers match the two up
+        self.name = name + '_total' if kind == 'counter' and not name.endswith('_total') else name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._child(())
+            for method in ('inc', 'observe'):
+                if hasattr(self._default, method):
+                    setattr(self, method, getattr(self._default, method))
+        METRICS.append(self)
+
+    def _child(self, values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                if values not in self._children:
+                    if self.kind == 'counter':
+                        self._children[values] = _Counter()
+                    else:
+                        self._children[values] = _Histogram(**self._kwargs)
+                child = self._children[values]
+        return child
+
+    def labels(self, *values):
+        return self._child(tuple(str(v) for v in values))
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield from child.samples(self.name, tuple(zip(self.labelnames, values)))
+
+
+class Gauge:
+    """A value read from a callback at scrape time"""
+
+    def __init__(self, name, help, callback):
+        self.kind = 'gauge'
+        self.name = name
+        self.help = help
+        self.callback = callback
+        METRICS.append(self)
+
+    def samples(self):
+        yield self.name, (), self.callback()
+
+
+def counter(name, help, labelnames=()):
+    return Metric('counter', name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=TIME_BUCKETS):
+    return Metric('histogram', name, help, labelnames, buckets=tuple(buckets))
+
+
+def gauge(name, help, callback):
+    return Gauge(name, help, callback)
+
+
+_local = threading.local()
+
+
+class StageTimer:
+    """Durations of the stages of one request, in the order they first ran.
+
+    While a timer is active in a thread, stage() and add_to_stage() add to it,
+    so code that knows nothing about the request (like the registry's locks)
+    can still report where its time went.
+    """
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def activate(self):
+        _local.timer = self
+
+    def deactivate(self):
+        if getattr(_local, 'timer', None) is self:
+            _local.timer = None
+
+    def elapsed(self):
+        return perf_counter() - self.started
+
+    def server_timing(self):
+        """The stages as a Server-Timing header value, durations in ms"""
+        stages = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.stages.items()]
+        stages.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(stages)
+
+    def summary(self):
+        return ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in self.stages.items())
+
+
+def add_to_stage(name, seconds):
+    """Add time to a stage of the request running in this thread, if any"""
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+@contextmanager
+def stage(name, histogram=None):
+    """Time a block as a stage of the current request and into ``histogram``"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        add_to_stage(name, elapsed)
+        if histogram is not None:
+            histogram.observe(elapsed)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        try:
+            samples = list(metric.samples())
+        except Exception as e:
+            print(f"Failed to collect metric {metric.name}: {e}")
+            continue
+        for name, labels, value in samples:
+            if labels:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                name = f'{name}{{{label_text}}}'
+            lines.append(f'{name} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
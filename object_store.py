@@ -0,0 +1,281 @@
+"""A small S3-compatible object store, for running STORAGE=s3 locally.
+
+Implements the part of the S3 REST API that storage.ObjectStorage uses:
+PUT/GET/HEAD/DELETE of objects with Range requests, multipart uploads
+(initiate, upload part, list parts, complete, abort), ListObjectsV2 and
+ListMultipartUploads. Buckets are created on first use and requests are
+not authenticated. Like S3, it refuses to complete uploads whose parts
+(all but the last) are smaller than --min-part-size.
+
+    python object_store.py --root /tmp/objects --port 9000
+    STORAGE=s3 S3_ENDPOINT=http://localhost:9000 python app.py
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from werkzeug.serving import run_simple
+from werkzeug.wrappers import Request, Response
+from werkzeug.wsgi import wrap_file
+
+COPY_SIZE = 1024 * 1024  # 1MB
+
+# Largest page of keys, uploads or parts a listing returns
+MAX_LISTING = 1000
+
+XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class S3Error(Exception):
+    def __init__(self, status, code, message=''):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+def xml_response(tag, body, status=200):
+    return Response(f'<?xml version="1.0" encoding="UTF-8"?><{tag} xmlns="{XMLNS}">{body}</{tag}>',
+                    status, mimetype='application/xml')
+
+
+def elements(**fields):
+    return ''.join(f'<{name}>{escape(str(value))}</{name}>' for name, value in fields.items())
+
+
+def timestamp(mtime):
+    return datetime.fromtimestamp(mtime, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def etag(st):
+    """An entity tag that changes whenever a file is replaced"""
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+class ObjectStore:
+    """Objects and uploads as files: <root>/<bucket>/<quoted key> for objects
+    and <root>/<bucket>/.uploads/<upload id>/<part number> for parts"""
+
+    def __init__(self, root, min_part_size):
+        self.root = root
+        self.min_part_size = min_part_size
+
+    def _bucket(self, bucket):
+        path = os.path.join(self.root, bucket)
+        os.makedirs(os.path.join(path, '.uploads'), exist_ok=True)
+        return path
+
+    def _object(self, bucket, key):
+        return os.path.join(self._bucket(bucket), quote(key, safe=''))
+
+    def _upload(self, bucket, upload_id):
+        path = os.path.join(self._bucket(bucket), '.uploads', os.path.basename(upload_id))
+        if not upload_id or not os.path.isdir(path):
+            raise S3Error(404, 'NoSuchUpload', 'The specified upload does not exist')
+        return path
+
+    def _receive(self, request, path):
+        """Store the request body at ``path``, replacing whatever is there"""
+        if request.content_length is None:
+            raise S3Error(411, 'MissingContentLength')
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(request.stream, f, COPY_SIZE)
+                size = f.tell()
+            if size != request.content_length:
+                raise S3Error(400, 'IncompleteBody')
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return Response(headers={'ETag': etag(os.stat(path))})
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        try:
+            response = self.dispatch(request)
+        except S3Error as e:
+            response = xml_response('Error', elements(Code=e.code, Message=e.message), e.status)
+        except FileNotFoundError:
+            response = xml_response('Error', elements(Code='NoSuchKey'), 404)
+        return response(environ, start_response)
+
+    def dispatch(self, request):
+        # The path arrives percent-decoded
+        bucket, _, key = request.path.lstrip('/').partition('/')
+        args = request.args
+        if not bucket:
+            raise S3Error(400, 'InvalidRequest', 'Only path-style requests are supported')
+        if not key:
+            if request.method == 'GET' and 'uploads' in args:
+                return self.list_uploads(bucket, args)
+            if request.method == 'GET':
+                return self.list_objects(bucket, args)
+            raise S3Error(405, 'MethodNotAllowed')
+
+        if request.method == 'POST' and 'uploads' in args:
+            upload_id = uuid.uuid4().hex
+            path = os.path.join(self._bucket(bucket), '.uploads', upload_id)
+            os.mkdir(path)
+            with open(os.path.join(path, 'key'), 'w', encoding='utf-8') as f:
+                f.write(key)
+            return xml_response('InitiateMultipartUploadResult',
+                                elements(Bucket=bucket, Key=key, UploadId=upload_id))
+        if 'uploadId' in args:
+            upload = self._upload(bucket, args['uploadId'])
+            if request.method == 'PUT':
+                number = args.get('partNumber', type=int)
+                if number is None or not 1 <= number <= 10000:
+                    raise S3Error(400, 'InvalidArgument', 'Part number must be between 1 and 10000')
+                return self._receive(request, os.path.join(upload, str(number)))
+            if request.method == 'GET':
+                return self.list_parts(upload, bucket, key, args)
+            if request.method == 'POST':
+                return self.complete(upload, bucket, key, request.get_data())
+            if request.method == 'DELETE':
+                shutil.rmtree(upload, ignore_errors=True)
+                return Response(status=204)
+            raise S3Error(405, 'MethodNotAllowed')
+
+        path = self._object(bucket, key)
+        if request.method == 'PUT':
+            return self._receive(request, path)
+        if request.method == 'DELETE':
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return Response(status=204)
+        if request.method in ('GET', 'HEAD'):
+            f = open(path, 'rb')
+            st = os.fstat(f.fileno())
+            response = Response(wrap_file(request.environ, f), mimetype='application/octet-stream',
+                                direct_passthrough=True)
+            response.content_length = st.st_size
+            response.last_modified = st.st_mtime
+            response.headers['ETag'] = etag(st)
+            return response.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+        raise S3Error(405, 'MethodNotAllowed')
+
+    def _parts(self, upload):
+        return sorted(int(name) for name in os.listdir(upload) if name.isdigit())
+
+    def list_parts(self, upload, bucket, key, args):
+        marker = args.get('part-number-marker', 0, type=int)
+        numbers = [number for number in self._parts(upload) if number > marker]
+        page = numbers[:MAX_LISTING]
+        parts = ''
+        for number in page:
+            st = os.stat(os.path.join(upload, str(number)))
+            parts += '<Part>' + elements(PartNumber=number, ETag=etag(st), Size=st.st_size,
+                                         LastModified=timestamp(st.st_mtime)) + '</Part>'
+        truncated = len(numbers) > len(page)
+        body = elements(Bucket=bucket, Key=key, UploadId=os.path.basename(upload),
+                        IsTruncated='true' if truncated else 'false')
+        if truncated:
+            body += elements(NextPartNumberMarker=page[-1])
+        return xml_response('ListPartsResult', body + parts)
+
+    def complete(self, upload, bucket, key, data):
+        try:
+            listed = [(int(part.findtext('{*}PartNumber')), part.findtext('{*}ETag'))
+                      for part in ElementTree.fromstring(data).iterfind('{*}Part')]
+        except (ElementTree.ParseError, TypeError, ValueError):
+            raise S3Error(400, 'MalformedXML')
+        if not listed:
+            raise S3Error(400, 'MalformedXML', 'At least one part must be specified')
+        if [number for number, _ in listed] != sorted({number for number, _ in listed}):
+            raise S3Error(400, 'InvalidPartOrder')
+        paths = []
+        for i, (number, tag) in enumerate(listed):
+            path = os.path.join(upload, str(number))
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                raise S3Error(400, 'InvalidPart', f'Part {number} has not been uploaded')
+            if tag.strip('"') != etag(st).strip('"'):
+                raise S3Error(400, 'InvalidPart', f'Part {number} has a different ETag')
+            if i < len(listed) - 1 and st.st_size < self.min_part_size:
+                raise S3Error(400, 'EntityTooSmall', f'Part {number} is smaller than the minimum')
+            paths.append(path)
+
+        target = self._object(bucket, key)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.tmp')
+        with os.fdopen(fd, 'wb') as out:
+            for path in paths:
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, out, COPY_SIZE)
+        os.replace(tmp, target)
+        shutil.rmtree(upload, ignore_errors=True)
+        return xml_response('CompleteMultipartUploadResult',
+                            elements(Bucket=bucket, Key=key, ETag=etag(os.stat(target))))
+
+    def list_objects(self, bucket, args):
+        prefix = args.get('prefix', '')
+        start_after = args.get('continuation-token') or args.get('start-after', '')
+        directory = self._bucket(bucket)
+        keys = sorted(key for key in (unquote(name) for name in os.listdir(directory)
+                                      if not name.startswith('.'))
+                      if key.startswith(prefix) and key > start_after)
+        page = keys[:MAX_LISTING]
+        contents = ''
+        for key in page:
+            try:
+                st = os.stat(os.path.join(directory, quote(key, safe='')))
+            except FileNotFoundError:
+                continue
+            contents += '<Contents>' + elements(Key=key, LastModified=timestamp(st.st_mtime), ETag=etag(st),
+                                                Size=st.st_size) + '</Contents>'
+        truncated = len(keys) > len(page)
+        body = elements(Name=bucket, Prefix=prefix, KeyCount=len(page),
+                        IsTruncated='true' if truncated else 'false')
+        if truncated:
+            body += elements(NextContinuationToken=page[-1])
+        return xml_response('ListBucketResult', body + contents)
+
+    def list_uploads(self, bucket, args):
+        prefix = args.get('prefix', '')
+        marker = (args.get('key-marker', ''), args.get('upload-id-marker', ''))
+        directory = os.path.join(self._bucket(bucket), '.uploads')
+        uploads = []
+        for upload_id in os.listdir(directory):
+            try:
+                with open(os.path.join(directory, upload_id, 'key'), encoding='utf-8') as f:
+                    key = f.read()
+                initiated = os.stat(os.path.join(directory, upload_id)).st_mtime
+            except FileNotFoundError:
+                continue
+            if key.startswith(prefix) and (key, upload_id) > marker:
+                uploads.append((key, upload_id, initiated))
+        uploads.sort()
+        page = uploads[:MAX_LISTING]
+        truncated = len(uploads) > len(page)
+        body = elements(Bucket=bucket, Prefix=prefix, IsTruncated='true' if truncated else 'false')
+        if truncated:
+            body += elements(NextKeyMarker=page[-1][0], NextUploadIdMarker=page[-1][1])
+        for key, upload_id, initiated in page:
+            body += '<Upload>' + elements(Key=key, UploadId=upload_id, Initiated=timestamp(initiated)) + '</Upload>'
+        return xml_response('ListMultipartUploadsResult', body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--root', default='objects', help='directory to keep buckets in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--min-part-size', type=int, default=5 * 1024 * 1024,
+                        help='smallest part allowed before the last one of an upload')
+    args = parser.parse_args()
+    os.makedirs(args.root, exist_ok=True)
+    run_simple(args.host, args.port, ObjectStore(args.root, args.min_part_size), threaded=True)
+
+
+if __name__ == '__main__':
+    main()
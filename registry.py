@@ -0,0 +1,611 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from time import perf_counter
+
+import metrics
+
+# Transfer fields returned by get()
+TRANSFER_FIELDS = ('total_size', 'file_count', 'created_at', 'expires_at', 'downloaded', 'archive_path', 'volume')
+
+# Byte counts returned by usage() and usage_by_volume(); archive_pending is
+# what prebuilt archives have yet to write of the space set aside for them
+USAGE_FIELDS = ('reserved', 'allocated', 'received', 'archive_pending')
+
+LOCK_STRIPES = 64
+
+LOCK_WAIT = metrics.histogram(
+    'file_share_transfer_lock_wait_seconds', 'Time spent waiting for a transfer lock', ('lock',))
+LOCK_HOLD = metrics.histogram(
+    'file_share_transfer_lock_hold_seconds', 'Time a transfer lock was held', ('lock',))
+
+
+class ReservationExceeded(Exception):
+    """A transfer's files add up to more than the size reserved for it"""
+
+
+def chunk_received(bitmap, chunk_index):
+    return bitmap[chunk_index >> 3] & (1 << (chunk_index & 7)) != 0
+
+
+def set_chunks(bitmap, first, last):
+    """Mark chunks first..last received; returns how many weren't already"""
+    added = 0
+    for chunk_index in range(first, last + 1):
+        if not chunk_received(bitmap, chunk_index):
+            bitmap[chunk_index >> 3] |= 1 << (chunk_index & 7)
+            added += 1
+    return added
+
+
+def received_bytes(file_info):
+    """Bytes of a file received so far; the last chunk may be short"""
+    return min(file_info['received_chunks'] * file_info['chunk_size'], file_info['file_size'])
+
+
+def public_file(file_id, info):
+    """The shape of a completed file as listed by files()"""
+    return {
+        'file_id': file_id,
+        'filename': info['file_name'],
+        'filepath': info['filepath'],
+        'filesize': info['file_size'],
+        'file_index': info['file_index']
+    }
+
+
+class TimedLock:
+    """A lock that records how long it was waited for and held"""
+
+    def __init__(self, name):
+        self._lock = threading.Lock()
+        self._wait = LOCK_WAIT.labels(name)
+        self._hold = LOCK_HOLD.labels(name)
+        self._acquired = 0
+
+    def __enter__(self):
+        start = perf_counter()
+        self._lock.acquire()
+        # Only the holder writes this, so it needs no protection of its own
+        self._acquired = perf_counter()
+        self._wait.observe(self._acquired - start)
+        metrics.add_to_stage('lock', self._acquired - start)
+        return self
+
+    def __exit__(self, *exc):
+        held = perf_counter() - self._acquired
+        self._lock.release()
+        self._hold.observe(held)
+
+
+class MemoryRegistry:
+    """Transfers kept in this process's memory.
+
+    Only suitable for a single worker process. The registry lock only covers
+    lookups and inserts in the dict; each transfer's record is guarded by one
+    of LOCK_STRIPES stripe locks, so one transfer never waits on another.
+    """
+
+    def __init__(self):
+        self.transfers = {}
+        self.lock = TimedLock('registry')
+        self.stripes = [TimedLock('stripe') for _ in range(LOCK_STRIPES)]
+        # Running totals per volume of reserved, allocated, received and
+        # pending archive bytes, so admission doesn't have to walk every file
+        self._usage = {}
+        self._usage_lock = threading.Lock()
+
+    def lock_for(self, transfer_id):
+        """Return the stripe lock guarding a transfer's record"""
+        return self.stripes[hash(transfer_id) % LOCK_STRIPES]
+
+    def _get(self, transfer_id):
+        with self.lock:
+            return self.transfers.get(transfer_id)
+
+    def create(self, transfer_id, total_size, file_count, created_at, expires_at, quota=None, volume=None,
+               archive_size=0):
+        """Register a transfer, reserving total_size bytes for it on ``volume``.
+
+        ``archive_size`` more is set aside for building its archive, which
+        add_segment() and set_archive() draw down. Returns False without
+        registering it if that would take the bytes reserved by all
+        transfers past ``quota``.
+        """
+        transfer = {
+            'total_size': total_size,
+            'file_count': file_count,
+            'created_at': created_at,
+            'expires_at': expires_at,
+            'downloaded': False,
+            'archive_path': None,
+            'archive_state': None,
+            'volume': volume,
+            'allocated': 0,
+            'received': 0,
+            'archive_pending': archive_size,
+            'deleted': False,
+            'files': [],
+            'chunks': {}
+        }
+        with self.lock:
+            if quota is not None and self.usage()['reserved'] + total_size > quota:
+                return False
+            self.transfers[transfer_id] = transfer
+            self._count(volume, total_size, 0, 0, archive_size)
+            return True
+
+    def _count(self, volume, reserved, allocated, received, archive_pending=0):
+        with self._usage_lock:
+            totals = self._usage.setdefault(volume, [0, 0, 0, 0])
+            totals[0] += reserved
+            totals[1] += allocated
+            totals[2] += received
+            totals[3] += archive_pending
+
+    def usage(self):
+        """Bytes reserved by transfers, allocated to their files, received so far
+        and still to be written to their archives"""
+        with self._usage_lock:
+            totals = [sum(column) for column in zip(*self._usage.values())] or [0, 0, 0, 0]
+        return dict(zip(USAGE_FIELDS, totals))
+
+    def usage_by_volume(self):
+        """usage() for the transfers on each volume"""
+        with self._usage_lock:
+            return {volume: dict(zip(USAGE_FIELDS, totals)) for volume, totals in self._usage.items()}
+
+    def get(self, transfer_id):
+        """Return a snapshot of a transfer's fields, or None if it doesn't exist"""
+        transfer = self._get(transfer_id)
+        if transfer is None:
+            return None
+        with self.lock_for(transfer_id):
+            return {field: transfer[field] for field in TRANSFER_FIELDS}
+
+    def delete(self, transfer_id):
+        # The stripe lock keeps add_file() and mark_chunks() from counting
+        # into a transfer whose totals have already been taken off
+        with self.lock_for(transfer_id):
+            with self.lock:
+                transfer = self.transfers.pop(transfer_id, None)
+            if transfer is None:
+                return False
+            transfer['deleted'] = True
+            self._count(transfer['volume'], -transfer['total_size'], -transfer['allocated'], -transfer['received'],
+                        -transfer['archive_pending'])
+            return True
+
+    def count(self):
+        with self.lock:
+            return len(self.transfers)
+
+    def expirations(self):
+        """Return (expires_at, transfer_id) for every transfer"""
+        with self.lock:
+            return [(transfer['expires_at'], transfer_id) for transfer_id, transfer in self.transfers.items()]
+
+    def next_expiry(self):
+        """When the next transfer expires, or None if there are none"""
+        with self.lock:
+            return min((transfer['expires_at'] for transfer in self.transfers.values()), default=None)
+
+    def add_file(self, transfer_id, file_id, info):
+        """Register a file unless it already is.
+
+        Returns (file, created), or (None, False) if the transfer is gone.
+        Raises ReservationExceeded if the file doesn't fit in what is left
+        of the transfer's reservation.
+        """
+        transfer = self._get(transfer_id)
+        if transfer is None:
+            return None, False
+        with self.lock_for(transfer_id):
+            if transfer['deleted']:
+                return None, False
+            file_info = transfer['chunks'].get(file_id)
+            if file_info is not None:
+                return dict(file_info, received=bytes(file_info['received'])), False
+            if transfer['allocated'] + info['file_size'] > transfer['total_size']:
+                raise ReservationExceeded(transfer_id)
+            transfer['allocated'] += info['file_size']
+            self._count(transfer['volume'], 0, info['file_size'], 0)
+            file_info = transfer['chunks'][file_id] = dict(
+                info,
+                received=bytearray((info['total_chunks'] + 7) // 8),
+                received_chunks=0,
+                complete=False,
+                segment=None
+            )
+            return dict(file_info, received=bytes(file_info['received'])), True
+
+    def get_file(self, transfer_id, file_id):
+        transfer = self._get(transfer_id)
+        if transfer is None:
+            return None
+        with self.lock_for(transfer_id):
+            file_info = transfer['chunks'].get(file_id)
+            if file_info is None:
+                return None
+            return dict(file_info, received=bytes(file_info['received']))
+
+    def mark_chunks(self, transfer_id, file_id, first, last):
+        """Record chunks first..last received; returns True if that was the last of them.
+
+        The file isn't complete until complete_file() records it, once it has
+        been finalized.
+        """
+        transfer = self._get(transfer_id)
+        if transfer is None:
+            return False
+        with self.lock_for(transfer_id):
+            file_info = transfer['chunks'].get(file_id)
+            if file_info is None or transfer['deleted']:
+                return False
+            # A concurrent retry of the same range may have beaten us to it
+            added = set_chunks(file_info['received'], first, last)
+            if not added:
+                return False
+            before = received_bytes(file_info)
+            file_info['received_chunks'] += added
+            received = received_bytes(file_info) - before
+            transfer['received'] += received
+            self._count(transfer['volume'], 0, 0, received)
+            return file_info['received_chunks'] == file_info['total_chunks']
+
+    def complete_file(self, transfer_id, file_id):
+        """Mark a file complete; returns True if it wasn't yet"""
+        transfer = self._get(transfer_id)
+        if transfer is None:
+            return False
+        with self.lock_for(transfer_id):
+            file_info = transfer['chunks'].get(file_id)
+            if file_info is None or transfer['deleted'] or file_info['complete']:
+                return False
+            file_info['complete'] = True
+            transfer['files'].append(public_file(file_id, file_info))
+            return True
+
+    def files(self, transfer_id):
+        """Return the transfer's completed files in the order they completed"""
+        transfer = self._get(transfer_id)
+        if transfer is None:
+            return []
+        with self.lock_for(transfer_id):
+            return list(transfer['files'])
+
+    def mark_downloaded(self, transfer_id):
+        """Flag the transfer as downloaded; returns False if it already was"""
+        transfer = self._get(transfer_id)
+        if transfer is None:
+            return False
+        with self.lock_for(transfer_id):
+            if transfer['downloaded']:
+                return False
+            transfer['downloaded'] = True
+            return True
+
+    def add_segment(self, transfer_id, file_id, segment):
+        """Record a file's archive segment, counting its size as written.
+
+        Once every file of the transfer has one, the first caller to notice
+        claims the archive assembly and gets all segments in file order;
+        everyone else gets None.
+        """
+        transfer = self._get(transfer_id)
+        if transfer is None:
+            return None
+        with self.lock_for(transfer_id):
+            if transfer['deleted']:
+                return None
+            transfer['chunks'][file_id]['segment'] = segment
+            self._settle_archive(transfer, min(segment['size'], transfer['archive_pending']))
+            segments = [(f['file_index'], f['segment']) for f in transfer['chunks'].values()
+                        if f['complete'] and f['segment'] is not None]
+            if len(segments) < transfer['file_count'] or transfer['archive_state'] is not None:
+                return None
+            transfer['archive_state'] = 'assembling'
+            return [segment for _, segment in sorted(segments, key=lambda s: s[0])]
+
+    def set_archive(self, transfer_id, path):
+        """Record the finished archive, or None if building it failed.
+
+        Either way nothing more is written for it, so what was set aside
+        and not used is given back.
+        """
+        transfer = self._get(transfer_id)
+        if transfer is None:
+            return
+        with self.lock_for(transfer_id):
+            transfer['archive_path'] = path
+            transfer['archive_state'] = 'ready' if path else 'failed'
+            if not transfer['deleted']:
+                self._settle_archive(transfer, transfer['archive_pending'])
+
+    def _settle_archive(self, transfer, size):
+        transfer['archive_pending'] -= size
+        self._count(transfer['volume'], 0, 0, 0, -size)
+
+
+class SQLiteRegistry:
+    """Transfers kept in an SQLite database in WAL mode.
+
+    Every worker process opens the same database, so any worker can serve
+    any transfer. Chunk accounting runs in short write transactions, which
+    SQLite serialises across processes; disk I/O for the chunks themselves
+    happens outside of them.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS transfers (
+            id TEXT PRIMARY KEY,
+            total_size INTEGER NOT NULL,
+            file_count INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            downloaded INTEGER NOT NULL DEFAULT 0,
+            archive_state TEXT,
+            archive_path TEXT,
+            volume TEXT,
+            archive_pending INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS transfers_expires_at ON transfers (expires_at);
+        CREATE TABLE IF NOT EXISTS files (
+            transfer_id TEXT NOT NULL REFERENCES transfers (id) ON DELETE CASCADE,
+            file_id TEXT NOT NULL,
+            file_index INTEGER NOT NULL,
+            file_name TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            total_chunks INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            filepath TEXT NOT NULL,
+            received BLOB NOT NULL,
+            received_chunks INTEGER NOT NULL DEFAULT 0,
+            completed_at REAL,
+            segment TEXT,
+            PRIMARY KEY (transfer_id, file_id)
+        );
+        -- Running totals per volume ('' for none), kept by the triggers below
+        CREATE TABLE IF NOT EXISTS usage (
+            volume TEXT PRIMARY KEY,
+            reserved INTEGER NOT NULL DEFAULT 0,
+            allocated INTEGER NOT NULL DEFAULT 0,
+            received INTEGER NOT NULL DEFAULT 0,
+            archive_pending INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TRIGGER IF NOT EXISTS usage_transfer_created AFTER INSERT ON transfers BEGIN
+            INSERT INTO usage (volume, reserved, archive_pending)
+                VALUES (COALESCE(new.volume, ''), new.total_size, new.archive_pending)
+                ON CONFLICT (volume) DO UPDATE SET reserved = reserved + excluded.reserved,
+                                                   archive_pending = archive_pending + excluded.archive_pending;
+        END;
+        CREATE TRIGGER IF NOT EXISTS usage_transfer_deleted BEFORE DELETE ON transfers BEGIN
+            UPDATE usage SET
+                reserved = reserved - old.total_size,
+                archive_pending = archive_pending - old.archive_pending,
+                allocated = allocated - (SELECT COALESCE(SUM(file_size), 0) FROM files WHERE transfer_id = old.id),
+                received = received - (SELECT COALESCE(SUM(MIN(received_chunks * chunk_size, file_size)), 0)
+                                       FROM files WHERE transfer_id = old.id)
+            WHERE volume = COALESCE(old.volume, '');
+        END;
+        CREATE TRIGGER IF NOT EXISTS usage_transfer_archive AFTER UPDATE OF archive_pending ON transfers BEGIN
+            UPDATE usage SET archive_pending = archive_pending + new.archive_pending - old.archive_pending
+            WHERE volume = COALESCE(new.volume, '');
+        END;
+        CREATE TRIGGER IF NOT EXISTS usage_file_insert AFTER INSERT ON files BEGIN
+            UPDATE usage SET allocated = allocated + new.file_size
+            WHERE volume = (SELECT COALESCE(volume, '') FROM transfers WHERE id = new.transfer_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS usage_file_received AFTER UPDATE OF received_chunks ON files BEGIN
+            UPDATE usage SET received = received + MIN(new.received_chunks * new.chunk_size, new.file_size)
+                                                 - MIN(old.received_chunks * old.chunk_size, old.file_size)
+            WHERE volume = (SELECT COALESCE(volume, '') FROM transfers WHERE id = new.transfer_id);
+        END;
+    """
+
+    FILE_COLUMNS = ('file_index', 'file_name', 'file_size', 'total_chunks', 'chunk_size', 'filepath')
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(self.SCHEMA)
+        # Databases from before transfers were placed on volumes, and from
+        # before archive space was counted
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(transfers)')}
+        if 'volume' not in columns:
+            conn.execute('ALTER TABLE transfers ADD COLUMN volume TEXT')
+        if 'archive_pending' not in columns:
+            conn.execute('ALTER TABLE transfers ADD COLUMN archive_pending INTEGER NOT NULL DEFAULT 0')
+        if 'archive_pending' not in {row['name'] for row in conn.execute('PRAGMA table_info(usage)')}:
+            conn.execute('ALTER TABLE usage ADD COLUMN archive_pending INTEGER NOT NULL DEFAULT 0')
+        # Recount the totals once at startup, which also fills them in for
+        # databases from before they were kept, and replaces the triggers
+        # that kept them before archive space was counted
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DROP TRIGGER IF EXISTS usage_transfer_insert')
+        conn.execute('DROP TRIGGER IF EXISTS usage_transfer_delete')
+        conn.execute('DELETE FROM usage')
+        conn.execute(
+            "INSERT INTO usage (volume, reserved, allocated, received, archive_pending) "
+            "SELECT COALESCE(volume, ''), SUM(total_size), SUM(COALESCE(allocated, 0)), SUM(COALESCE(received, 0)), "
+            "SUM(archive_pending) FROM transfers LEFT JOIN (SELECT transfer_id, SUM(file_size) AS allocated, "
+            "SUM(MIN(received_chunks * chunk_size, file_size)) AS received FROM files GROUP BY transfer_id) "
+            "ON transfer_id = id GROUP BY COALESCE(volume, '')")
+        conn.execute('COMMIT')
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    @property
+    def conn(self):
+        """This thread's connection, reopened after a fork"""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conn = self._connect()
+            local.pid = os.getpid()
+        return local.conn
+
+    @contextmanager
+    def _write(self):
+        """Run a write transaction that other processes wait on"""
+        conn = self.conn
+        start = perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        acquired = perf_counter()
+        LOCK_WAIT.labels('sqlite').observe(acquired - start)
+        metrics.add_to_stage('lock', acquired - start)
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            if conn.in_transaction:
+                conn.execute('COMMIT')
+            LOCK_HOLD.labels('sqlite').observe(perf_counter() - acquired)
+
+    def create(self, transfer_id, total_size, file_count, created_at, expires_at, quota=None, volume=None,
+               archive_size=0):
+        # The quota check and the insert are one statement, so workers
+        # admitting transfers at the same time can't overshoot it together
+        return self.conn.execute(
+            'INSERT INTO transfers (id, total_size, file_count, created_at, expires_at, volume, archive_pending) '
+            'SELECT ?, ?, ?, ?, ?, ?, ? WHERE ? IS NULL OR (SELECT COALESCE(SUM(reserved), 0) FROM usage) + ? <= ?',
+            (transfer_id, total_size, file_count, created_at, expires_at, volume, archive_size,
+             quota, total_size, quota)).rowcount > 0
+
+    def usage(self):
+        row = self.conn.execute('SELECT COALESCE(SUM(reserved), 0), COALESCE(SUM(allocated), 0), '
+                                'COALESCE(SUM(received), 0), COALESCE(SUM(archive_pending), 0) FROM usage').fetchone()
+        return dict(zip(USAGE_FIELDS, row))
+
+    def usage_by_volume(self):
+        rows = self.conn.execute('SELECT volume, reserved, allocated, received, archive_pending FROM usage')
+        return {row[0] or None: dict(zip(USAGE_FIELDS, row[1:])) for row in rows}
+
+    def get(self, transfer_id):
+        row = self.conn.execute(
+            f"SELECT {', '.join(TRANSFER_FIELDS)} FROM transfers WHERE id = ?", (transfer_id,)).fetchone()
+        if row is None:
+            return None
+        transfer = dict(row)
+        transfer['downloaded'] = bool(transfer['downloaded'])
+        return transfer
+
+    def delete(self, transfer_id):
+        return self.conn.execute('DELETE FROM transfers WHERE id = ?', (transfer_id,)).rowcount > 0
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM transfers').fetchone()[0]
+
+    def expirations(self):
+        return [tuple(row) for row in self.conn.execute('SELECT expires_at, id FROM transfers')]
+
+    def next_expiry(self):
+        return self.conn.execute('SELECT MIN(expires_at) FROM transfers').fetchone()[0]
+
+    def _file(self, row):
+        file_info = dict(row)
+        file_info['received'] = bytes(file_info['received'])
+        file_info['complete'] = file_info.pop('completed_at') is not None
+        file_info['segment'] = json.loads(file_info['segment']) if file_info['segment'] else None
+        return file_info
+
+    def add_file(self, transfer_id, file_id, info):
+        with self._write() as conn:
+            transfer = conn.execute('SELECT total_size FROM transfers WHERE id = ?', (transfer_id,)).fetchone()
+            if transfer is None:
+                return None, False
+            row = conn.execute('SELECT * FROM files WHERE transfer_id = ? AND file_id = ?',
+                               (transfer_id, file_id)).fetchone()
+            if row is not None:
+                return self._file(row), False
+            allocated = conn.execute('SELECT COALESCE(SUM(file_size), 0) FROM files WHERE transfer_id = ?',
+                                     (transfer_id,)).fetchone()[0]
+            if allocated + info['file_size'] > transfer['total_size']:
+                raise ReservationExceeded(transfer_id)
+            conn.execute(
+                f"INSERT INTO files (transfer_id, file_id, {', '.join(self.FILE_COLUMNS)}, received) "
+                f"VALUES (?, ?, {', '.join('?' * len(self.FILE_COLUMNS))}, ?)",
+                (transfer_id, file_id, *(info[c] for c in self.FILE_COLUMNS),
+                 bytes((info['total_chunks'] + 7) // 8)))
+            row = conn.execute('SELECT * FROM files WHERE transfer_id = ? AND file_id = ?',
+                               (transfer_id, file_id)).fetchone()
+        return self._file(row), True
+
+    def get_file(self, transfer_id, file_id):
+        row = self.conn.execute('SELECT * FROM files WHERE transfer_id = ? AND file_id = ?',
+                                (transfer_id, file_id)).fetchone()
+        return None if row is None else self._file(row)
+
+    def mark_chunks(self, transfer_id, file_id, first, last):
+        with self._write() as conn:
+            row = conn.execute(
+                'SELECT received, received_chunks, total_chunks FROM files WHERE transfer_id = ? AND file_id = ?',
+                (transfer_id, file_id)).fetchone()
+            if row is None:
+                return False
+            received = bytearray(row['received'])
+            added = set_chunks(received, first, last)
+            if not added:
+                return False
+            conn.execute(
+                'UPDATE files SET received = ?, received_chunks = received_chunks + ? '
+                'WHERE transfer_id = ? AND file_id = ?',
+                (bytes(received), added, transfer_id, file_id))
+            return row['received_chunks'] + added == row['total_chunks']
+
+    def complete_file(self, transfer_id, file_id):
+        return self.conn.execute(
+            'UPDATE files SET completed_at = ? WHERE transfer_id = ? AND file_id = ? AND completed_at IS NULL',
+            (time.time(), transfer_id, file_id)).rowcount > 0
+
+    def files(self, transfer_id):
+        rows = self.conn.execute(
+            'SELECT file_id, file_name, filepath, file_size, file_index FROM files '
+            'WHERE transfer_id = ? AND completed_at IS NOT NULL ORDER BY completed_at, rowid',
+            (transfer_id,)).fetchall()
+        return [public_file(row['file_id'], row) for row in rows]
+
+    def mark_downloaded(self, transfer_id):
+        return self.conn.execute(
+            'UPDATE transfers SET downloaded = 1 WHERE id = ? AND downloaded = 0', (transfer_id,)).rowcount > 0
+
+    def add_segment(self, transfer_id, file_id, segment):
+        with self._write() as conn:
+            conn.execute('UPDATE files SET segment = ? WHERE transfer_id = ? AND file_id = ?',
+                         (json.dumps(segment), transfer_id, file_id))
+            conn.execute('UPDATE transfers SET archive_pending = MAX(archive_pending - ?, 0) WHERE id = ?',
+                         (segment['size'], transfer_id))
+            transfer = conn.execute('SELECT file_count, archive_state FROM transfers WHERE id = ?',
+                                    (transfer_id,)).fetchone()
+            rows = conn.execute(
+                'SELECT segment FROM files WHERE transfer_id = ? AND completed_at IS NOT NULL '
+                'AND segment IS NOT NULL ORDER BY file_index', (transfer_id,)).fetchall()
+            if transfer is None or transfer['archive_state'] is not None or len(rows) < transfer['file_count']:
+                return None
+            conn.execute("UPDATE transfers SET archive_state = 'assembling' WHERE id = ?", (transfer_id,))
+            return [json.loads(row['segment']) for row in rows]
+
+    def set_archive(self, transfer_id, path):
+        self.conn.execute('UPDATE transfers SET archive_path = ?, archive_state = ?, archive_pending = 0 WHERE id = ?',
+                          (path, 'ready' if path else 'failed', transfer_id))
+
+
+def make_registry(backend, path=None):
+    """Create the registry named by the REGISTRY setting"""
+    if backend == 'memory':
+        return MemoryRegistry()
+    if backend == 'sqlite':
+        return SQLiteRegistry(path)
+    raise ValueError(f'Unknown registry backend: {backend}')
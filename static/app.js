@@ -0,0 +1,587 @@
+// DOM Elements
+const dropArea = document.getElementById('dropArea');
+const fileInput = document.getElementById('fileInput');
+const browseBtn = document.getElementById('browseBtn');
+const sendBtn = document.getElementById('sendBtn');
+const compressOption = document.getElementById('compressOption');
+const compressChunks = document.getElementById('compressChunks');
+const progressContainer = document.getElementById('progressContainer');
+const totalProgressBar = document.getElementById('totalProgressBar');
+const totalFiles = document.getElementById('totalFiles');
+const totalSize = document.getElementById('totalSize');
+const fileList = document.getElementById('fileList');
+const idContainer = document.getElementById('idContainer');
+const transferId = document.getElementById('transferId');
+const idText = document.getElementById('idText');
+
+const peerIdInput = document.getElementById('peerId');
+const receiveBtn = document.getElementById('receiveBtn');
+const receiveFileList = document.getElementById('receiveFileList');
+const receiveProgress = document.getElementById('receiveProgress');
+const receiveBar = document.getElementById('receiveBar');
+const receiveStatusText = document.getElementById('receiveStatusText');
+const receiveStatus = document.getElementById('receiveStatus');
+const downloadBtn = document.getElementById('downloadBtn');
+
+// Variables
+let selectedFiles = [];
+let transferIdValue = null;
+let pendingResume = null;
+const CHUNK_SIZE = 5 * 1024 * 1024; // 5MB, the first chunk size tried
+const TARGET_CHUNK_SECONDS = 2; // how long sending one chunk should take
+const MAX_RETRIES = 5; // attempts per chunk before giving up
+const COMPRESSION_FORMAT = 'gzip'; // CompressionStream format, sent as the Content-Encoding
+
+// Event Listeners
+browseBtn.addEventListener('click', () => fileInput.click());
+fileInput.addEventListener('change', handleFileSelect);
+dropArea.addEventListener('dragover', (e) => {
+    e.preventDefault();
+    dropArea.classList.add('active');
+});
+dropArea.addEventListener('dragleave', () => {
+    dropArea.classList.remove('active');
+});
+dropArea.addEventListener('drop', (e) => {
+    e.preventDefault();
+    dropArea.classList.remove('active');
+    if (e.dataTransfer.files.length) {
+        fileInput.files = e.dataTransfer.files;
+        handleFileSelect();
+    }
+});
+
+sendBtn.addEventListener('click', generateTransferId);
+transferId.addEventListener('click', copyTransferId);
+receiveBtn.addEventListener('click', connectToPeer);
+
+// Handle file selection
+function handleFileSelect() {
+    if (fileInput.files.length === 0) return;
+    
+    selectedFiles = Array.from(fileInput.files);
+    pendingResume = null;
+    sendBtn.textContent = 'Generate Transfer ID';
+    updateFileList(selectedFiles);
+    sendBtn.disabled = false;
+}
+
+// Update file list display
+function updateFileList(files) {
+    fileList.innerHTML = '';
+    fileList.style.display = 'block';
+    progressContainer.style.display = 'block';
+    
+    let totalSizeBytes = 0;
+    
+    files.forEach((file, index) => {
+        totalSizeBytes += file.size;
+        
+        const fileItem = document.createElement('div');
+        fileItem.className = 'file-item';
+        fileItem.innerHTML = `
+            <div class="file-name">${file.name}</div>
+            <div class="file-size">${formatFileSize(file.size)}</div>
+            <div class="file-progress">
+                <div class="progress-bar">
+                    <div class="progress" id="fileProgress-${index}" style="width: 0%"></div>
+                </div>
+            </div>
+        `;
+        fileList.appendChild(fileItem);
+    });
+    
+    totalFiles.textContent = `${files.length} file${files.length > 1 ? 's' : ''}`;
+    totalSize.textContent = formatFileSize(totalSizeBytes);
+    totalProgressBar.style.width = '0%';
+}
+
+// Format file size
+function formatFileSize(bytes) {
+    if (bytes < 1024) return bytes + ' bytes';
+    else if (bytes < 1048576) return (bytes / 1024).toFixed(1) + ' KB';
+    else if (bytes < 1073741824) return (bytes / 1048576).toFixed(1) + ' MB';
+    else return (bytes / 1073741824).toFixed(1) + ' GB';
+}
+
+// Generate transfer ID
+function generateTransferId() {
+    if (selectedFiles.length === 0) return;
+    
+    // Carry on with an interrupted upload instead of starting over
+    if (pendingResume) {
+        const resume = pendingResume;
+        pendingResume = null;
+        resume();
+        return;
+    }
+    
+    // Show progress
+    totalProgressBar.style.width = '10%';
+    
+    // Create a new transfer on the server
+    fetch('/create_transfer', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            file_count: selectedFiles.length,
+            total_size: selectedFiles.reduce((sum, file) => sum + file.size, 0)
+        })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            transferIdValue = data.transfer_id;
+            // Upload files in chunks, as many at once as the server allows
+            uploadFiles(transferIdValue, data);
+        } else {
+            showStatus('Error: ' + data.error, 'error');
+            totalProgressBar.style.width = '0%';
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        showStatus('Error creating transfer', 'error');
+        totalProgressBar.style.width = '0%';
+    });
+}
+
+// Pick chunk sizes from the throughput chunks actually get. Each chunk
+// should take about TARGET_CHUNK_SECONDS, or ten round trips if that is
+// longer, so request overhead stays small on fast links and a retry stays
+// cheap on slow ones. Sizes are multiples of the server's minimum.
+function createChunkSizer(minSize, maxSize) {
+    let size = Math.min(maxSize, Math.max(minSize, Math.floor(CHUNK_SIZE / minSize) * minSize));
+    let throughput = 0;
+    let rtt = 0;
+    
+    function setSize(wanted) {
+        // Move at most a factor of two at a time so one odd chunk can't swing it
+        wanted = Math.min(size * 2, Math.max(size / 2, wanted));
+        size = Math.min(maxSize, Math.max(minSize, Math.floor(wanted / minSize) * minSize));
+    }
+    
+    return {
+        size: () => size,
+        // Round trip of a request without a body
+        roundTrip(seconds) {
+            rtt = rtt ? Math.min(rtt, seconds) : seconds;
+        },
+        sent(bytes, seconds) {
+            const rate = bytes / Math.max(seconds, 0.001);
+            throughput = throughput ? 0.7 * throughput + 0.3 * rate : rate;
+            setSize(throughput * Math.max(TARGET_CHUNK_SECONDS, 10 * rtt));
+        },
+        failed() {
+            setSize(size / 2);
+        }
+    };
+}
+
+// Compress a chunk if the user asked for it and it gets smaller. The
+// server decodes it by its Content-Encoding, and needs the original length
+// to place it.
+function chunkBody(blob) {
+    if (!compressChunks.checked || typeof CompressionStream === 'undefined') {
+        return Promise.resolve({ body: blob, headers: {} });
+    }
+    return new Response(blob.stream().pipeThrough(new CompressionStream(COMPRESSION_FORMAT))).blob()
+        .then(compressed => {
+            if (compressed.size >= blob.size) {
+                return { body: blob, headers: {} };
+            }
+            return {
+                body: compressed,
+                headers: {
+                    'Content-Encoding': COMPRESSION_FORMAT,
+                    'Upload-Chunk-Length': String(blob.size)
+                }
+            };
+        });
+}
+
+// Upload files in chunks. Each file keeps a list of byte ranges still to
+// send; chunks are cut from the front of them at the current chunk size,
+// and at most `upload_window` are in flight at any time across all files.
+// If the upload fails, the send button offers to resume it: only the ranges
+// the server reports as missing are sent again.
+function uploadFiles(transferId, limits) {
+    let uploadedCount = 0;
+    let inFlight = 0;
+    let failed = false;
+    // Bumped on every (re)start; chunks sent before a resume don't count
+    // towards progress, the server's report of missing data covers them
+    let attemptId = 0;
+    const totalCount = selectedFiles.length;
+    const uploadWindow = limits.upload_window || 1;
+    const unit = limits.min_chunk_size || CHUNK_SIZE;
+    const sizer = createChunkSizer(unit, limits.max_chunk_size || CHUNK_SIZE);
+    
+    const uploads = selectedFiles.map((file, fileIndex) => ({
+        file: file,
+        fileIndex: fileIndex,
+        fileId: uuidv4(),
+        pending: [],
+        // Storage may count this file's chunks in a larger unit
+        unit: unit,
+        doneBytes: 0,
+        finished: false
+    }));
+    
+    function chunkDone(upload, bytes) {
+        upload.doneBytes += bytes;
+        
+        // Update progress for this file
+        const progress = upload.file.size ? (upload.doneBytes / upload.file.size) * 100 : 100;
+        document.getElementById(`fileProgress-${upload.fileIndex}`).style.width = `${progress}%`;
+        if (upload.doneBytes === upload.file.size) {
+            fileDone(upload);
+        }
+    }
+    
+    function fileDone(upload) {
+        if (upload.finished) return;
+        upload.finished = true;
+        uploadedCount++;
+        updateTotalProgress(uploadedCount, totalCount);
+        if (uploadedCount === totalCount) {
+            showTransferId(transferId);
+        }
+    }
+    
+    function fail(upload, message, resumable) {
+        if (failed) return;
+        failed = true;
+        showStatus(`Error uploading ${upload.file.name}: ${message}`, 'error');
+        if (resumable) {
+            pendingResume = resume;
+            sendBtn.textContent = 'Resume Upload';
+            sendBtn.disabled = false;
+        }
+    }
+    
+    // The current chunk size, in whole units of the file
+    function chunkSize(upload) {
+        return Math.max(upload.unit, Math.floor(sizer.size() / upload.unit) * upload.unit);
+    }
+    
+    // Cut the next chunk off the first file with data left to send
+    function nextChunk() {
+        const upload = uploads.find(upload => upload.pending.length);
+        if (!upload) return null;
+        const range = upload.pending[0];
+        const end = Math.min(range[1], range[0] + chunkSize(upload));
+        const chunk = { upload: upload, start: range[0], end: end, attemptId: attemptId };
+        if (end === range[1]) {
+            upload.pending.shift();
+        } else {
+            range[0] = end;
+        }
+        return chunk;
+    }
+    
+    // Start chunks until the window is full
+    function pump() {
+        let chunk;
+        while (!failed && inFlight < uploadWindow && (chunk = nextChunk())) {
+            inFlight++;
+            sendChunk(chunk, 0);
+        }
+    }
+    
+    function sendChunk(chunk, attempt) {
+        const upload = chunk.upload;
+        const started = performance.now();
+        
+        chunkBody(upload.file.slice(chunk.start, chunk.end))
+        .then(({ body, headers }) => fetch(`/upload/${transferId}/${upload.fileId}`, {
+            method: 'PATCH',
+            headers: Object.assign({
+                'Content-Type': 'application/offset+octet-stream',
+                'Upload-Offset': String(chunk.start)
+            }, headers),
+            body: body
+        }))
+        .then(response => {
+            // Client errors won't go away by retrying
+            if (!response.ok && response.status < 500 && response.status !== 408 && response.status !== 429) {
+                return response.json().then(data => {
+                    throw { fatal: true, message: data.error };
+                });
+            }
+            // An overloaded server says when to come back
+            const retryAfter = parseFloat(response.headers.get('Retry-After'));
+            if ((response.status === 503 || response.status === 429) && retryAfter >= 0) {
+                throw { fatal: false, retryAfter: retryAfter, message: 'server busy' };
+            }
+            if (!response.ok) {
+                throw { fatal: false, message: `server returned ${response.status}` };
+            }
+            return response.json();
+        })
+        .then(() => {
+            inFlight--;
+            sizer.sent(chunk.end - chunk.start, (performance.now() - started) / 1000);
+            if (chunk.attemptId === attemptId) {
+                chunkDone(upload, chunk.end - chunk.start);
+            }
+            pump();
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            if (!failed && error.retryAfter !== undefined) {
+                // Not the chunk's fault, so it doesn't use up an attempt or
+                // shrink the chunk; jitter keeps clients from coming back at once
+                const delay = error.retryAfter * 1000 * (1 + Math.random() / 2);
+                setTimeout(() => sendChunk(chunk, attempt), delay);
+                return;
+            }
+            if (failed || error.fatal || attempt + 1 >= MAX_RETRIES) {
+                inFlight--;
+                fail(upload, error.message || 'network error', !error.fatal);
+                return;
+            }
+            // Retry a smaller chunk with exponential backoff and jitter,
+            // keeping the slot; the rest goes back to the front of the file
+            sizer.failed();
+            if (chunk.end - chunk.start > chunkSize(upload)) {
+                const split = chunk.start + chunkSize(upload);
+                upload.pending.unshift([split, chunk.end]);
+                chunk = { upload: upload, start: chunk.start, end: split, attemptId: chunk.attemptId };
+            }
+            const delay = Math.min(30000, 500 * 2 ** attempt) * (0.5 + Math.random() / 2);
+            setTimeout(() => sendChunk(chunk, attempt + 1), delay);
+        });
+    }
+    
+    // Register a file (which is idempotent) and queue its data. When
+    // resuming, ask the server which parts it still needs first.
+    function prepare(upload, resuming) {
+        const started = performance.now();
+        return fetch(`/transfer/${transferId}/files`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                file_id: upload.fileId,
+                file_index: upload.fileIndex,
+                file_name: upload.file.name,
+                file_size: upload.file.size,
+                chunk_size: unit
+            })
+        })
+        .then(response => response.json())
+        .then(data => {
+            sizer.roundTrip((performance.now() - started) / 1000);
+            if (!data.success) {
+                throw { fatal: true, message: data.error };
+            }
+            upload.unit = data.chunk_size || unit;
+            if (!resuming) {
+                return upload.file.size ? [[0, upload.file.size]] : [];
+            }
+            // The server counts missing data in units of the chunk size
+            return fetch(`/upload/${transferId}/${upload.fileId}`)
+                .then(response => response.json())
+                .then(status => status.missing.map(([first, last]) => [
+                    first * status.chunk_size,
+                    Math.min(upload.file.size, (last + 1) * status.chunk_size)
+                ]));
+        })
+        .then(missing => {
+            upload.pending = missing;
+            upload.doneBytes = 0;
+            chunkDone(upload, missing.reduce((left, [start, end]) => left - (end - start), upload.file.size));
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            fail(upload, error.message || 'network error', !error.fatal);
+        });
+    }
+    
+    function start(resuming) {
+        failed = false;
+        attemptId++;
+        uploads.forEach(upload => upload.pending = []);
+        Promise.all(uploads.filter(upload => !upload.finished).map(upload => prepare(upload, resuming)))
+        .then(pump);
+    }
+    
+    function resume() {
+        sendBtn.textContent = 'Generate Transfer ID';
+        sendBtn.disabled = true;
+        showStatus('Resuming upload...', 'success');
+        start(true);
+    }
+    
+    start(false);
+}
+
+// Show the transfer ID once every file is uploaded
+function showTransferId(transferId) {
+    idContainer.style.display = 'block';
+    idText.textContent = transferId;
+    sendBtn.disabled = true;
+    showStatus('All files uploaded! Share the transfer ID.', 'success');
+    
+    // Animate ID container
+    idContainer.style.opacity = '0';
+    idContainer.style.transform = 'translateY(20px)';
+    setTimeout(() => {
+        idContainer.style.transition = 'all 0.5s ease';
+        idContainer.style.opacity = '1';
+        idContainer.style.transform = 'translateY(0)';
+    }, 100);
+}
+
+// Update total progress
+function updateTotalProgress(uploadedCount, totalCount) {
+    const progress = (uploadedCount / totalCount) * 100;
+    totalProgressBar.style.width = `${progress}%`;
+}
+
+// Simple UUID generator for file chunks
+function uuidv4() {
+    return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
+        const r = Math.random() * 16 | 0, v = c === 'x' ? r : (r & 0x3 | 0x8);
+        return v.toString(16);
+    });
+}
+
+// Copy transfer ID to clipboard
+function copyTransferId() {
+    const textArea = document.createElement('textarea');
+    textArea.value = transferIdValue;
+    document.body.appendChild(textArea);
+    textArea.select();
+    document.execCommand('copy');
+    document.body.removeChild(textArea);
+    
+    // Show visual feedback
+    const originalText = idText.textContent;
+    idText.textContent = 'Copied to clipboard!';
+    idText.style.color = '#10b981';
+    
+    setTimeout(() => {
+        idText.textContent = originalText;
+        idText.style.color = '';
+    }, 2000);
+}
+
+// Connect to peer
+function connectToPeer() {
+    const transferId = peerIdInput.value.trim();
+    if (!transferId) return;
+    
+    receiveBtn.disabled = true;
+    receiveStatus.textContent = 'Connecting to peer...';
+    receiveStatus.className = 'status';
+    receiveStatus.style.display = 'block';
+    
+    // Animate status appearance
+    receiveStatus.style.opacity = '0';
+    receiveStatus.style.transform = 'translateY(10px)';
+    setTimeout(() => {
+        receiveStatus.style.transition = 'all 0.3s ease';
+        receiveStatus.style.opacity = '1';
+        receiveStatus.style.transform = 'translateY(0)';
+    }, 100);
+    
+    // Check if transfer exists
+    fetch(`/transfer/${transferId}`)
+    .then(response => response.json())
+    .then(data => {
+        if (data.exists) {
+            receiveStatus.textContent = 'Transfer found! Preparing download...';
+            
+            // Get file list
+            fetch(`/transfer/${transferId}/files`)
+            .then(response => response.json())
+            .then(fileData => {
+                if (fileData.success) {
+                    displayReceiveFiles(transferId, fileData.files);
+                    receiveStatus.textContent = `Ready to download ${fileData.files.length} files`;
+                    receiveStatus.className = 'status success';
+                    
+                    // Show download button
+                    downloadBtn.href = `/download_all/${transferId}`;
+                    downloadBtn.textContent = `Download All Files (${formatFileSize(fileData.total_size)})`;
+                    downloadBtn.style.display = 'inline-block';
+                    
+                    // Animate download button appearance
+                    downloadBtn.style.opacity = '0';
+                    downloadBtn.style.transform = 'translateY(10px)';
+                    setTimeout(() => {
+                        downloadBtn.style.transition = 'all 0.4s ease';
+                        downloadBtn.style.opacity = '1';
+                        downloadBtn.style.transform = 'translateY(0)';
+                    }, 100);
+                } else {
+                    receiveStatus.textContent = 'Error: ' + fileData.error;
+                    receiveStatus.className = 'status error';
+                }
+            });
+        } else {
+            receiveStatus.textContent = 'Transfer not found. Please check the ID.';
+            receiveStatus.className = 'status error';
+            receiveBtn.disabled = false;
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        receiveStatus.textContent = 'Error connecting to server';
+        receiveStatus.className = 'status error';
+        receiveBtn.disabled = false;
+    });
+}
+
+// Display files for receiving
+function displayReceiveFiles(transferId, files) {
+    receiveFileList.innerHTML = '';
+    receiveFileList.style.display = 'block';
+    
+    // Animate file list appearance
+    receiveFileList.style.opacity = '0';
+    receiveFileList.style.transform = 'translateY(10px)';
+    setTimeout(() => {
+        receiveFileList.style.transition = 'all 0.4s ease';
+        receiveFileList.style.opacity = '1';
+        receiveFileList.style.transform = 'translateY(0)';
+    }, 100);
+    
+    files.forEach(file => {
+        const fileItem = document.createElement('div');
+        fileItem.className = 'file-item';
+        fileItem.innerHTML = `
+            <div class="file-name"><a href="/transfer/${transferId}/file/${file.index}" download>${file.filename}</a></div>
+            <div class="file-size">${formatFileSize(file.filesize)}</div>
+        `;
+        receiveFileList.appendChild(fileItem);
+    });
+}
+
+// Show status message
+function showStatus(message, type) {
+    // In a real implementation, this would show a status message
+    console.log(`${type}: ${message}`);
+}
+
+// Initialize
+function init() {
+    // Compression needs CompressionStream, which older browsers lack
+    if (typeof CompressionStream === 'undefined') {
+        compressOption.style.display = 'none';
+    }
+    
+    // Check if we have a transfer ID in the URL
+    const pathParts = window.location.pathname.split('/');
+    if (pathParts.length > 2 && pathParts[1] === 'receive') {
+        peerIdInput.value = pathParts[2];
+    }
+}
+
+// Start the app
+init();
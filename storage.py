@@ -0,0 +1,1068 @@
+import errno
+import hashlib
+import hmac
+import http.client
+import io
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+import metrics
+from registry import ReservationExceeded
+
+# Size of the pieces copied while writing and reading files
+BUFFER_SIZE = 1024 * 1024  # 1MB
+
+# S3 multipart limits: every part but the last must be at least
+# MIN_PART_SIZE, and an upload has at most MAX_PARTS parts
+MIN_PART_SIZE = 5 * 1024 * 1024  # 5MB
+MAX_PARTS = 10000
+
+# Archives and segments are written to object storage in parts of this size
+WRITER_PART_SIZE = 8 * 1024 * 1024  # 8MB
+
+# What stat() returns; etag is None where the backend has none to offer
+Stat = namedtuple('Stat', 'st_size st_mtime etag')
+
+# What disk_usage() returns, as shutil.disk_usage() does
+DiskUsage = namedtuple('DiskUsage', 'total used free')
+
+# The volume MemoryTier places small transfers on, and the prefix of the
+# locations of their files
+MEMORY_VOLUME = ':memory:'
+MEMORY_PREFIX = 'memory:'
+
+MEMORY_SPILLS = metrics.counter('file_share_memory_tier_spills',
+                                'Transfers moved out of memory to make room for new ones')
+
+
+class StorageError(Exception):
+    """The storage backend failed a request"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def preallocate(fd, size):
+    """Reserve disk space for a file up front, falling back to a sparse file"""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            # Filesystems without fallocate support get a sparse file instead
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    os.ftruncate(fd, size)
+
+
+class LocalStorage:
+    """Transfers as directories of files under one of ``roots`` on this host.
+
+    Each root is a volume, usually the mount point of its own disk, and a
+    transfer's files all live on the volume place() picked for it. A
+    file's location is its path, so downloads can go out through
+    sendfile() and archives can read members straight from disk.
+    """
+
+    def __init__(self, roots, headroom=0):
+        # Normalised, so that they match the volumes worked out from paths
+        self.roots = [os.path.normpath(root) for root in roots]
+        # Bytes place() and room() keep free on every volume
+        self.headroom = headroom
+        for root in self.roots:
+            os.makedirs(root, exist_ok=True)
+        # Chunk writes in progress in this process, per volume
+        self._writes = dict.fromkeys(self.roots, 0)
+        self._writes_lock = threading.Lock()
+
+    def _path(self, transfer_id, volume, name=''):
+        # Transfers registered before volumes were recorded are on the first
+        return os.path.join(volume or self.roots[0], transfer_id, name)
+
+    def _volume(self, location):
+        return os.path.normpath(os.path.dirname(os.path.dirname(location)))
+
+    def _tally(self, by_volume):
+        """Add up per-volume byte counts from the registry for each root"""
+        tally = dict.fromkeys(self.roots, 0)
+        for volume, size in by_volume.items():
+            root = os.path.normpath(volume) if volume else self.roots[0]
+            if root in tally:
+                tally[root] += size
+        return tally
+
+    def chunk_unit(self, file_size, chunk_size):
+        """The unit a file's chunks are counted in; any size works on disk"""
+        return chunk_size
+
+    def place(self, size, outstanding, pending):
+        """Pick the volume for a new transfer of ``size`` bytes.
+
+        ``outstanding`` maps volumes to the bytes their transfers have
+        reserved but not yet allocated, ``pending`` to the bytes they have
+        yet to receive. Volumes with room for the transfer on top of the
+        outstanding bytes and the headroom come first; among them the one
+        with the fewest chunk writes in progress wins, then the one with
+        the least data still to come, so new transfers spread over the
+        disks instead of piling onto one.
+        """
+        outstanding = self._tally(outstanding)
+        pending = self._tally(pending)
+
+        def load(root):
+            room = shutil.disk_usage(root).free - outstanding[root] - size - self.headroom
+            return room < 0, self._writes[root], pending[root], -room
+        return min(self.roots, key=load)
+
+    def room(self, volume, size, outstanding):
+        """Bytes ``volume`` would have free beyond the headroom once a
+        transfer of ``size`` and the outstanding reservations are written"""
+        root = os.path.normpath(volume) if volume else self.roots[0]
+        return shutil.disk_usage(root).free - self._tally(outstanding)[root] - size - self.headroom
+
+    def create_transfer(self, transfer_id, volume=None, size=0):
+        """Returns the volume the transfer was created on"""
+        os.makedirs(self._path(transfer_id, volume), exist_ok=True)
+        return volume
+
+    def delete_transfer(self, transfer_id, volume=None):
+        shutil.rmtree(self._path(transfer_id, volume), ignore_errors=True)
+
+    def transfers(self):
+        """Yield (transfer_id, volume, mtime) for every transfer with files stored"""
+        for root in self.roots:
+            for entry in os.scandir(root):
+                if entry.is_dir():
+                    yield entry.name, root, entry.stat().st_mtime
+
+    def create_file(self, transfer_id, name, size, volume=None):
+        """Create a file at its final size for chunks to be written into.
+
+        Returns the file's location. Raises FileNotFoundError if the
+        transfer has been deleted.
+        """
+        path = self._path(transfer_id, volume, name)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            preallocate(fd, size)
+        finally:
+            os.close(fd)
+        return path
+
+    def write(self, location, offset, stream, limit, unit):
+        """Copy ``stream`` into the file starting at ``offset``.
+
+        At most ``limit`` bytes are accepted; returns the number of bytes
+        written, or -1 if the stream holds more than that.
+        """
+        volume = self._volume(location)
+        with self._writes_lock:
+            self._writes[volume] = self._writes.get(volume, 0) + 1
+        fd = os.open(location, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            written = 0
+            while True:
+                data = stream.read(BUFFER_SIZE)
+                if not data:
+                    return written
+                if written + len(data) > limit:
+                    return -1
+                os.pwrite(fd, data, offset + written)
+                written += len(data)
+        finally:
+            os.close(fd)
+            with self._writes_lock:
+                self._writes[volume] -= 1
+
+    def finalize(self, location, size, unit):
+        """Called once every chunk of the file has been written"""
+
+    def create(self, transfer_id, name, volume=None):
+        """A writer for a file written from start to end, like an archive"""
+        return LocalWriter(self._path(transfer_id, volume, name))
+
+    def open(self, location):
+        return open(location, 'rb')
+
+    def stat(self, location):
+        st = os.stat(location)
+        return Stat(st.st_size, st.st_mtime, None)
+
+    def source(self, location):
+        """The file as an archive member; see archive.zip_members()"""
+        return location
+
+    def local_path(self, location):
+        return os.path.abspath(location)
+
+    def delete(self, location):
+        try:
+            os.remove(location)
+        except FileNotFoundError:
+            pass
+
+    def disk_usage(self):
+        """Space on the volumes' filesystems, each counted once"""
+        devices = {os.stat(root).st_dev: root for root in self.roots}
+        usages = [shutil.disk_usage(root) for root in devices.values()]
+        return DiskUsage(*(sum(column) for column in zip(*usages)))
+
+
+class LocalWriter:
+    """Write a file under a temporary name, renamed into place once complete"""
+
+    def __init__(self, path):
+        self.location = path
+        self._part_path = path + '.part'
+        self._file = open(self._part_path, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self._part_path, self.location)
+        else:
+            os.remove(self._part_path)
+
+
+def _xml(data):
+    return ElementTree.fromstring(data)
+
+
+def _text(element, tag, default=None):
+    """The text of ``element``'s first ``tag`` child, ignoring namespaces"""
+    child = element.find(f'{{*}}{tag}')
+    return default if child is None else child.text
+
+
+class S3Client:
+    """Just enough of the S3 REST API for ObjectStorage, over path-style URLs.
+
+    Requests are signed with AWS Signature Version 4 when credentials are
+    given. Payloads are left unsigned so chunks can be streamed through.
+    Small requests reuse a connection per thread; streamed ones get their
+    own, closed along with the response.
+    """
+
+    def __init__(self, endpoint, bucket, region='us-east-1', access_key=None, secret_key=None, timeout=60):
+        url = urlsplit(endpoint)
+        self.secure = url.scheme == 'https'
+        self.host = url.netloc
+        self.base_path = f"{url.path.rstrip('/')}/{bucket}"
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        return cls(self.host, timeout=self.timeout, blocksize=BUFFER_SIZE)
+
+    def _sign(self, method, path, query_string, headers):
+        headers['host'] = self.host
+        headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
+        if not self.access_key:
+            return
+        amz_date = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        headers['x-amz-date'] = amz_date
+        names = sorted(headers)
+        canonical = '\n'.join([
+            method, path, query_string,
+            ''.join(f"{name}:{' '.join(headers[name].split())}\n" for name in names),
+            ';'.join(names), 'UNSIGNED-PAYLOAD'])
+        scope = f'{amz_date[:8]}/{self.region}/s3/aws4_request'
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()])
+        key = ('AWS4' + self.secret_key).encode()
+        for part in (amz_date[:8], self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers['authorization'] = (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                                    f"SignedHeaders={';'.join(names)}, Signature={signature}")
+
+    def request(self, method, key='', query=None, headers=None, body=None, stream=False):
+        """Send a request and return the response.
+
+        The response body is read into ``response.data``, unless ``stream``
+        is set or ``body`` is a file, in which case a connection of its own
+        is used; with ``stream`` the caller reads and closes the response.
+        Raises FileNotFoundError on 404 and StorageError on other failures.
+        """
+        path = quote(f'{self.base_path}/{key}' if key else self.base_path, safe='/-_.~')
+        query_string = '&'.join(f"{quote(name, safe='-_.~')}={quote(str(value), safe='-_.~')}"
+                                for name, value in sorted((query or {}).items()))
+        headers = {name.lower(): str(value) for name, value in (headers or {}).items()}
+        self._sign(method, path, query_string, headers)
+        url = f'{path}?{query_string}' if query_string else path
+
+        dedicated = stream or not (body is None or isinstance(body, bytes))
+        if dedicated:
+            headers['connection'] = 'close'
+            conn = self._connect()
+        else:
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = self._connect()
+        try:
+            try:
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if dedicated:
+                    raise
+                # The server closed an idle keep-alive connection; try once more
+                conn.close()
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+
+        if stream and response.status < 300:
+            return response
+        response.data = response.read()
+        response.close()
+        if dedicated:
+            conn.close()
+        if response.status == 404:
+            raise FileNotFoundError(f'{method} {key}: not found')
+        if response.status >= 300:
+            raise StorageError(f'{method} {key} failed with {response.status}: {response.data[:200]!r}',
+                               response.status)
+        return response
+
+
+class ObjectStorage:
+    """Transfers as objects in a bucket of an S3-compatible object store.
+
+    Each file is a multipart upload in which every unit of the file is one
+    part, so a chunk covering several units uploads several parts, and
+    writers of the same unit just replace its part with the same bytes.
+    The upload is completed once the last chunk is in. A file's location is
+    its key, followed by '?uploadId=' and the upload's ID until then; names
+    are percent-encoded in keys, so a key never holds a '?' itself.
+
+    Keys start with ``prefix``, and only objects under it are listed, so
+    hosts that share a bucket with their own registries each see (and
+    reclaim) only their own transfers.
+    """
+
+    def __init__(self, client, prefix='', part_size=WRITER_PART_SIZE):
+        self.client = client
+        prefix = prefix.strip('/')
+        self.prefix = f"{quote(prefix, safe='/')}/" if prefix else ''
+        self.part_size = part_size
+
+    def _key(self, transfer_id, name):
+        return f"{self.prefix}{transfer_id}/{quote(name, safe='')}"
+
+    @staticmethod
+    def _split(location):
+        key, _, upload_id = location.partition('?uploadId=')
+        return key, upload_id
+
+    def chunk_unit(self, file_size, chunk_size):
+        """The unit a file's chunks are counted in, a multiple of ``chunk_size``.
+
+        Units are parts, so they have to meet S3's minimum part size and
+        keep the file within the part limit.
+        """
+        unit = max(chunk_size, MIN_PART_SIZE, -(-file_size // MAX_PARTS))
+        return -(-unit // chunk_size) * chunk_size
+
+    def place(self, size, outstanding, pending):
+        """A bucket is a single volume"""
+        return None
+
+    def room(self, volume, size, outstanding):
+        """Object stores have no local disk to run out of"""
+        return None
+
+    def create_transfer(self, transfer_id, volume=None, size=0):
+        """Keys need no directory; objects appear as files are created"""
+        return volume
+
+    def delete_transfer(self, transfer_id, volume=None):
+        prefix = f'{self.prefix}{transfer_id}/'
+        for key, _ in self._objects(prefix):
+            self.client.request('DELETE', key)
+        for key, upload_id, _ in self._uploads(prefix):
+            self._abort(key, upload_id)
+
+    def transfers(self):
+        """Yield (transfer_id, volume, mtime) for every transfer with objects or uploads under the prefix"""
+        latest = {}
+        start = len(self.prefix)
+        for key, mtime in self._objects(self.prefix):
+            transfer_id = key[start:].partition('/')[0]
+            latest[transfer_id] = max(mtime, latest.get(transfer_id, 0))
+        for key, _, mtime in self._uploads(self.prefix):
+            transfer_id = key[start:].partition('/')[0]
+            latest[transfer_id] = max(mtime, latest.get(transfer_id, 0))
+        for transfer_id, mtime in latest.items():
+            yield transfer_id, None, mtime
+
+    def _objects(self, prefix):
+        """Yield (key, mtime) for the objects whose keys start with ``prefix``"""
+        query = {'list-type': 2, 'prefix': prefix}
+        while True:
+            result = _xml(self.client.request('GET', query=query).data)
+            for item in result.iterfind('{*}Contents'):
+                yield _text(item, 'Key'), datetime.fromisoformat(_text(item, 'LastModified')).timestamp()
+            if _text(result, 'IsTruncated') != 'true':
+                return
+            query['continuation-token'] = _text(result, 'NextContinuationToken')
+
+    def _uploads(self, prefix):
+        """Yield (key, upload_id, initiated) for unfinished multipart uploads"""
+        query = {'uploads': '', 'prefix': prefix}
+        while True:
+            result = _xml(self.client.request('GET', query=query).data)
+            for item in result.iterfind('{*}Upload'):
+                yield (_text(item, 'Key'), _text(item, 'UploadId'),
+                       datetime.fromisoformat(_text(item, 'Initiated')).timestamp())
+            if _text(result, 'IsTruncated') != 'true':
+                return
+            query['key-marker'] = _text(result, 'NextKeyMarker')
+            query['upload-id-marker'] = _text(result, 'NextUploadIdMarker')
+
+    def _initiate(self, key):
+        return _text(_xml(self.client.request('POST', key, {'uploads': ''}).data), 'UploadId')
+
+    def _upload_part(self, key, upload_id, part_number, body, size):
+        response = self.client.request('PUT', key, {'partNumber': part_number, 'uploadId': upload_id},
+                                       {'content-length': size}, body)
+        return response.getheader('ETag')
+
+    def _complete(self, key, upload_id, parts):
+        body = ''.join(f'<Part><PartNumber>{number}</PartNumber><ETag>{escape(etag)}</ETag></Part>'
+                       for number, etag in parts)
+        response = self.client.request('POST', key, {'uploadId': upload_id},
+                                       body=f'<CompleteMultipartUpload>{body}</CompleteMultipartUpload>'.encode())
+        # Completion can fail after the 200 status has been sent
+        if _xml(response.data).tag.endswith('Error'):
+            raise StorageError(f'Completing {key} failed: {response.data[:200]!r}')
+
+    def _abort(self, key, upload_id):
+        try:
+            self.client.request('DELETE', key, {'uploadId': upload_id})
+        except FileNotFoundError:
+            pass
+
+    def _parts(self, key, upload_id):
+        """The (part_number, etag) of every part uploaded so far, in order"""
+        parts = []
+        query = {'uploadId': upload_id}
+        while True:
+            result = _xml(self.client.request('GET', key, query).data)
+            parts.extend((int(_text(part, 'PartNumber')), _text(part, 'ETag'))
+                         for part in result.iterfind('{*}Part'))
+            if _text(result, 'IsTruncated') != 'true':
+                return parts
+            query['part-number-marker'] = _text(result, 'NextPartNumberMarker')
+
+    def create_file(self, transfer_id, name, size, volume=None):
+        """Start the multipart upload a file's chunks are written into.
+
+        Empty files have no parts, so they are stored straight away.
+        Returns the file's location.
+        """
+        key = self._key(transfer_id, name)
+        if size == 0:
+            self.client.request('PUT', key, body=b'')
+            return key
+        return f'{key}?uploadId={self._initiate(key)}'
+
+    def write(self, location, offset, stream, limit, unit):
+        """Upload ``stream`` as the parts of the units starting at ``offset``.
+
+        Parts are streamed, one request per unit. Returns the number of
+        bytes stored, short if the stream ends early, or -1 if it holds
+        more than ``limit`` bytes.
+        """
+        key, upload_id = self._split(location)
+        part_number = offset // unit + 1
+        written = 0
+        while written < limit:
+            size = min(unit, limit - written)
+            body = _ExactReader(stream, size)
+            try:
+                self._upload_part(key, upload_id, part_number, body, size)
+            except _ShortBody:
+                return written + body.count
+            written += size
+            part_number += 1
+        return -1 if stream.read(1) else written
+
+    def finalize(self, location, size, unit):
+        """Complete the upload once every unit has been received"""
+        key, upload_id = self._split(location)
+        if not upload_id:
+            return
+        parts = self._parts(key, upload_id)
+        if [number for number, _ in parts] != list(range(1, -(-size // unit) + 1)):
+            raise StorageError(f'Parts of {key} are missing')
+        self._complete(key, upload_id, parts)
+
+    def create(self, transfer_id, name, volume=None):
+        """A writer for a file written from start to end, like an archive"""
+        return ObjectWriter(self, self._key(transfer_id, name))
+
+    def open(self, location, position=0):
+        return ObjectReader(self.client, self._split(location)[0], position)
+
+    def stat(self, location):
+        key = self._split(location)[0]
+        response = self.client.request('HEAD', key)
+        return Stat(int(response.getheader('Content-Length')),
+                    parsedate_to_datetime(response.getheader('Last-Modified')).timestamp(),
+                    response.getheader('ETag', '').strip('"') or None)
+
+    def source(self, location):
+        """The object as an archive member; see archive.zip_members()"""
+        return StoredObject(self, location, self._split(location)[0])
+
+    def local_path(self, location):
+        return None
+
+    def delete(self, location):
+        key, upload_id = self._split(location)
+        if upload_id:
+            self._abort(key, upload_id)
+        else:
+            try:
+                self.client.request('DELETE', key)
+            except FileNotFoundError:
+                pass
+
+    def disk_usage(self):
+        """Object stores have no local disk to run out of"""
+        return None
+
+
+class _ShortBody(Exception):
+    """The request body ended before its Content-Length"""
+
+
+class _ExactReader:
+    """Read exactly ``size`` bytes of ``stream`` as a request body.
+
+    A stream that ends early raises _ShortBody, abandoning the request
+    rather than leaving the server waiting for the rest.
+    """
+
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.remaining = size
+        self.count = 0
+
+    def read(self, size=-1):
+        if not self.remaining:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        if not data:
+            raise _ShortBody()
+        self.remaining -= len(data)
+        self.count += len(data)
+        return data
+
+
+class ObjectWriter:
+    """Write an object from start to end as a multipart upload.
+
+    Data is buffered into parts of the storage's part_size; objects that
+    fit in one part are stored with a single PUT instead.
+    """
+
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.location = key
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.storage.part_size:
+            self._upload(bytes(self._buffer[:self.storage.part_size]))
+            del self._buffer[:self.storage.part_size]
+
+    def _upload(self, data):
+        if self._upload_id is None:
+            self._upload_id = self.storage._initiate(self.location)
+        number = len(self._parts) + 1
+        self._parts.append((number, self.storage._upload_part(self.location, self._upload_id, number,
+                                                              data, len(data))))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            if self._upload_id is not None:
+                self.storage._abort(self.location, self._upload_id)
+            return
+        if self._upload_id is None:
+            self.storage.client.request('PUT', self.location, body=bytes(self._buffer))
+            return
+        if self._buffer:
+            self._upload(bytes(self._buffer))
+        self.storage._complete(self.location, self._upload_id, self._parts)
+
+
+class ObjectReader:
+    """A seekable file over an object, read with ranged GETs.
+
+    Nothing is requested until the first read, and seeking drops the
+    response being read, so serving a Range only fetches the bytes from
+    its start onwards.
+    """
+
+    def __init__(self, client, key, position=0):
+        self.client = client
+        self.key = key
+        self.position = position
+        self._response = None
+
+    def read(self, size=-1):
+        if self._response is None:
+            headers = {'range': f'bytes={self.position}-'} if self.position else {}
+            try:
+                self._response = self.client.request('GET', self.key, headers=headers, stream=True)
+            except StorageError as e:
+                # Reading from the end of the object
+                if e.status == 416:
+                    return b''
+                raise
+        data = self._response.read(size if size >= 0 else None)
+        self.position += len(data)
+        return data
+
+    def seekable(self):
+        return True
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self.position
+        elif whence != os.SEEK_SET:
+            raise OSError('ObjectReader can only seek from the start or current position')
+        if position != self.position:
+            self._drop()
+            self.position = position
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.read(BUFFER_SIZE)
+        if not data:
+            raise StopIteration
+        return data
+
+    def _drop(self):
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+    def close(self):
+        self._drop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StoredObject:
+    """An object as an archive member: something with a name, stat() and open()"""
+
+    def __init__(self, storage, location, name):
+        self.storage = storage
+        self.location = location
+        self.name = name
+
+    def stat(self):
+        return self.storage.stat(self.location)
+
+    def open(self):
+        return self.storage.open(self.location)
+
+
+class MemoryTier:
+    """Keeps small transfers in this process's memory, in front of ``backing``.
+
+    Transfers of up to ``max_transfer`` bytes are placed on MEMORY_VOLUME
+    as long as their reservations fit in ``budget`` bytes. Their files are
+    byte strings, so a small transfer is created, uploaded, archived,
+    downloaded and deleted without touching a filesystem. To make room for
+    new ones, the least recently used transfers whose files are all
+    complete spill to ``backing``, and their locations resolve to where
+    the files went from then on. Other transfers go straight to ``backing``.
+
+    The memory belongs to one process, so every request for a transfer
+    has to reach the same one: use it with a single worker process.
+    """
+
+    def __init__(self, backing, budget, max_transfer):
+        self.backing = backing
+        self.budget = budget
+        self.max_transfer = max_transfer
+        # Bytes reserved by the transfers in memory
+        self.used = 0
+        # Transfers in memory, least recently used first
+        self._transfers = OrderedDict()
+        # transfer_id -> (volume, {memory location: location in backing})
+        self._spilled = {}
+        self._lock = threading.Lock()
+
+    def _location(self, transfer_id, name):
+        return f'{MEMORY_PREFIX}{transfer_id}/{name}'
+
+    def _resolve(self, location, acquire=False):
+        """Find a file: (transfer_id, _MemoryFile) while it's in memory,
+        otherwise (None, its location in backing).
+
+        With ``acquire`` the transfer is kept from spilling until _release().
+        Raises FileNotFoundError if the file or its transfer is gone.
+        """
+        if not location.startswith(MEMORY_PREFIX):
+            return None, location
+        transfer_id, _, name = location[len(MEMORY_PREFIX):].partition('/')
+        with self._lock:
+            transfer = self._transfers.get(transfer_id)
+            if transfer is not None and name in transfer.files:
+                self._transfers.move_to_end(transfer_id)
+                if acquire:
+                    transfer.active += 1
+                return transfer_id, transfer.files[name]
+            spilled = self._spilled.get(transfer_id)
+        if spilled is None or location not in spilled[1]:
+            raise FileNotFoundError(location)
+        return None, spilled[1][location]
+
+    def _release(self, transfer_id):
+        with self._lock:
+            transfer = self._transfers.get(transfer_id)
+            if transfer is not None:
+                transfer.active -= 1
+
+    def _spilled_volume(self, transfer_id):
+        """The volume a transfer no longer in memory spilled to.
+
+        Raises FileNotFoundError if it was deleted instead.
+        """
+        with self._lock:
+            spilled = self._spilled.get(transfer_id)
+        if spilled is None:
+            raise FileNotFoundError(transfer_id)
+        return spilled[0]
+
+    def _make_room(self, size):
+        """Spill transfers until ``size`` more bytes fit in the budget.
+
+        Victims are picked under the lock and copied outside it, so other
+        transfers in memory carry on meanwhile.
+        """
+        victims = []
+        with self._lock:
+            freed = sum(transfer.size for transfer in self._transfers.values() if transfer.spilling)
+            for transfer_id, transfer in self._transfers.items():
+                if self.used - freed + size <= self.budget:
+                    break
+                if (not transfer.spilling and transfer.active == 0
+                        and all(file.etag is not None for file in transfer.files.values())):
+                    transfer.spilling = True
+                    freed += transfer.size
+                    victims.append((transfer_id, transfer, dict(transfer.files)))
+        for victim in victims:
+            self._spill(*victim)
+        with self._lock:
+            return self.used + size <= self.budget
+
+    def _spill(self, transfer_id, transfer, files):
+        """Copy a transfer's files to backing, then drop them from memory.
+
+        If the transfer was used while its files were being copied, the
+        copy is thrown away and it stays in memory.
+        """
+        volume = self.backing.place(transfer.size, {}, {})
+        locations = {}
+        try:
+            self.backing.create_transfer(transfer_id, volume, transfer.size)
+            for name, file in files.items():
+                with self.backing.create(transfer_id, name, volume) as out:
+                    out.write(file.data)
+                locations[self._location(transfer_id, name)] = out.location
+        except (OSError, StorageError) as e:
+            print(f"Failed to spill transfer {transfer_id} from memory: {e}")
+            copied = False
+        else:
+            with self._lock:
+                transfer.spilling = False
+                copied = (self._transfers.get(transfer_id) is transfer and transfer.active == 0
+                          and transfer.files == files)
+                if copied:
+                    del self._transfers[transfer_id]
+                    self.used -= transfer.size
+                    self._spilled[transfer_id] = volume, locations
+        if not copied:
+            transfer.spilling = False
+            self.backing.delete_transfer(transfer_id, volume)
+            return
+        MEMORY_SPILLS.inc()
+
+    def chunk_unit(self, file_size, chunk_size):
+        return self.backing.chunk_unit(file_size, chunk_size)
+
+    def place(self, size, outstanding, pending):
+        """MEMORY_VOLUME for a small transfer there is room for, otherwise
+        whichever volume backing picks"""
+        if size <= self.max_transfer and self._make_room(size):
+            return MEMORY_VOLUME
+        outstanding = {volume: n for volume, n in outstanding.items() if volume != MEMORY_VOLUME}
+        pending = {volume: n for volume, n in pending.items() if volume != MEMORY_VOLUME}
+        return self.backing.place(size, outstanding, pending)
+
+    def room(self, volume, size, outstanding):
+        """Memory transfers are bounded by the budget, not by disk space"""
+        if volume == MEMORY_VOLUME:
+            return None
+        return self.backing.room(volume, size, outstanding)
+
+    def create_transfer(self, transfer_id, volume=None, size=0):
+        """Reserve ``size`` bytes of the budget for a transfer in memory.
+
+        If other transfers took the room place() found, the transfer goes
+        to backing instead; returns the volume it ended up on.
+        """
+        if volume == MEMORY_VOLUME:
+            with self._lock:
+                if self.used + size <= self.budget:
+                    self._transfers[transfer_id] = _MemoryTransfer(size)
+                    self.used += size
+                    return volume
+            volume = self.backing.place(size, {}, {})
+        return self.backing.create_transfer(transfer_id, volume, size)
+
+    def delete_transfer(self, transfer_id, volume=None):
+        if volume != MEMORY_VOLUME:
+            return self.backing.delete_transfer(transfer_id, volume)
+        with self._lock:
+            transfer = self._transfers.pop(transfer_id, None)
+            if transfer is not None:
+                self.used -= transfer.size
+            spilled = self._spilled.pop(transfer_id, None)
+        if spilled is not None:
+            self.backing.delete_transfer(transfer_id, spilled[0])
+
+    def transfers(self):
+        """Only spilled transfers are stored anywhere a restart would find them"""
+        return self.backing.transfers()
+
+    def create_file(self, transfer_id, name, size, volume=None):
+        """Raises ReservationExceeded for a file bigger than what is left
+        of the transfer's reservation, before allocating it"""
+        if volume != MEMORY_VOLUME:
+            return self.backing.create_file(transfer_id, name, size, volume)
+        location = self._location(transfer_id, name)
+        with self._lock:
+            transfer = self._transfers.get(transfer_id)
+            if transfer is not None:
+                self._transfers.move_to_end(transfer_id)
+                # Another request for the same file may have written to it already
+                if name not in transfer.files:
+                    if transfer.allocated + size > transfer.size:
+                        raise ReservationExceeded(transfer_id)
+                    transfer.files[name] = _MemoryFile(bytearray(size))
+                    transfer.allocated += size
+                return location
+        return self.backing.create_file(transfer_id, name, size, self._spilled_volume(transfer_id))
+
+    def write(self, location, offset, stream, limit, unit):
+        transfer_id, file = self._resolve(location, acquire=True)
+        if transfer_id is None:
+            return self.backing.write(file, offset, stream, limit, unit)
+        try:
+            written = 0
+            while True:
+                data = stream.read(BUFFER_SIZE)
+                if not data:
+                    return written
+                if written + len(data) > limit:
+                    return -1
+                # A chunk repeated after the file completed holds the same
+                # bytes, so writing it again, even while it completes, is harmless
+                if file.etag is None:
+                    file.data[offset + written:offset + written + len(data)] = data
+                written += len(data)
+        finally:
+            self._release(transfer_id)
+
+    def finalize(self, location, size, unit):
+        transfer_id, file = self._resolve(location)
+        if transfer_id is None:
+            return self.backing.finalize(file, size, unit)
+        file.complete()
+
+    def create(self, transfer_id, name, volume=None):
+        if volume != MEMORY_VOLUME:
+            return self.backing.create(transfer_id, name, volume)
+        with self._lock:
+            transfer = self._transfers.get(transfer_id)
+            if transfer is not None:
+                self._transfers.move_to_end(transfer_id)
+                transfer.active += 1
+                return MemoryWriter(self, transfer_id, name)
+        return self.backing.create(transfer_id, name, self._spilled_volume(transfer_id))
+
+    def _store(self, transfer_id, name, data):
+        """Add a file written by a MemoryWriter, unless the transfer is gone"""
+        file = _MemoryFile(data)
+        file.complete()
+        with self._lock:
+            transfer = self._transfers.get(transfer_id)
+            if transfer is not None:
+                transfer.files[name] = file
+
+    def open(self, location):
+        transfer_id, file = self._resolve(location)
+        if transfer_id is None:
+            return self.backing.open(file)
+        return MemoryReader(file.data)
+
+    def stat(self, location):
+        transfer_id, file = self._resolve(location)
+        if transfer_id is None:
+            return self.backing.stat(file)
+        return Stat(len(file.data), file.mtime, file.etag)
+
+    def source(self, location):
+        transfer_id, file = self._resolve(location)
+        if transfer_id is None:
+            return self.backing.source(file)
+        return StoredObject(self, location, location.partition('/')[2])
+
+    def local_path(self, location):
+        transfer_id, file = self._resolve(location)
+        if transfer_id is None:
+            return self.backing.local_path(file)
+        return None
+
+    def delete(self, location):
+        try:
+            transfer_id, file = self._resolve(location)
+        except FileNotFoundError:
+            return
+        if transfer_id is None:
+            return self.backing.delete(file)
+        name = location.partition('/')[2]
+        with self._lock:
+            transfer = self._transfers.get(transfer_id)
+            if transfer is not None and transfer.files.get(name) is file:
+                del transfer.files[name]
+
+    def disk_usage(self):
+        return self.backing.disk_usage()
+
+
+class _MemoryTransfer:
+    __slots__ = ('size', 'allocated', 'files', 'active', 'spilling')
+
+    def __init__(self, size):
+        self.size = size
+        # Bytes of the uploaded files, which have to fit in size
+        self.allocated = 0
+        self.files = {}
+        # Writes and writers in progress, which keep it from spilling
+        self.active = 0
+        # Set while _make_room() copies it to backing
+        self.spilling = False
+
+
+class _MemoryFile:
+    """A file's bytes, with an etag once complete.
+
+    The data stays a bytearray throughout, so a write racing complete()
+    never finds it swapped for something immutable; readers get a copy.
+    """
+    __slots__ = ('data', 'mtime', 'etag')
+
+    def __init__(self, data):
+        self.data = data
+        self.mtime = time.time()
+        self.etag = None
+
+    def complete(self):
+        self.mtime = time.time()
+        self.etag = hashlib.md5(self.data).hexdigest()
+
+
+class MemoryWriter:
+    """Collect a file written from start to end, added to the transfer once complete"""
+
+    def __init__(self, tier, transfer_id, name):
+        self.tier = tier
+        self.transfer_id = transfer_id
+        self.name = name
+        self.location = tier._location(transfer_id, name)
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.tier._store(self.transfer_id, self.name, self._buffer)
+        finally:
+            self.tier._release(self.transfer_id)
+
+
+class MemoryReader(io.BytesIO):
+    """A file in memory, iterated in BUFFER_SIZE pieces rather than lines"""
+
+    def __next__(self):
+        data = self.read(BUFFER_SIZE)
+        if not data:
+            raise StopIteration
+        return data
+
+
+def make_storage(backend, roots=None, endpoint=None, bucket=None, region=None, access_key=None, secret_key=None,
+                 memory_budget=0, memory_max_transfer=0, headroom=0, prefix=''):
+    """Create the storage backend named by the STORAGE setting, behind a
+    MemoryTier if given a budget"""
+    if backend == 'local':
+        storage = LocalStorage(roots, headroom)
+    elif backend == 's3':
+        storage = ObjectStorage(S3Client(endpoint, bucket, region, access_key, secret_key), prefix)
+    else:
+        raise ValueError(f'Unknown storage backend: {backend}')
+    if memory_budget > 0:
+        storage = MemoryTier(storage, memory_budget, memory_max_transfer)
+    return storage